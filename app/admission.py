@@ -0,0 +1,183 @@
+import asyncio
+import math
+import re
+import threading
+import time
+from collections import OrderedDict, deque
+from typing import Union
+from fastapi import HTTPException, status
+from fastapi.responses import JSONResponse
+from app import metrics
+from app.settings import Settings, settings
+
+AUTH, READS, WRITES, ADMIN = "auth", "reads", "writes", "admin"
+
+# (class, methods or None for any, path) rules, first match wins; anything
+# else is a read if it is a GET or HEAD and a write otherwise. Routing has
+# not happened yet when a request is admitted, so these match raw paths.
+ROUTE_CLASSES = [
+    (AUTH, {"POST"}, re.compile(r"^/(auth|register)$")),
+    (ADMIN, None, re.compile(r"^/(stats|moderation/.*|advertisements/(export|state))$")),
+    (ADMIN, None, re.compile(r"^/users/\d+/advertisements/export$")),
+    (ADMIN, {"POST", "PUT", "DELETE"}, re.compile(r"^/users/(\d+)?$")),
+]
+# Never queued or shed, so overload stays observable.
+EXEMPT_PATHS = frozenset({"/metrics"})
+
+
+def route_class(method: str, path: str) -> str:
+    for name, methods, pattern in ROUTE_CLASSES:
+        if (methods is None or method in methods) and pattern.match(path):
+            return name
+    return READS if method in ("GET", "HEAD") else WRITES
+
+
+class Gate:
+    """At most `concurrency` holders at a time and `queue_size` waiters.
+
+    Only used from the event loop, so it needs no lock. A released slot is
+    handed straight to the oldest waiter, so waiters are served in order and
+    a newcomer cannot overtake them.
+    """
+
+    def __init__(self, name: str, concurrency: int, queue_size: int,
+                 registry: metrics.Registry = metrics.registry):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.registry = registry
+        self.active = 0
+        self._waiters = deque()
+
+    def _record(self):
+        self.registry.record_admission(self.name, self.active,
+                                       len(self._waiters))
+
+    async def acquire(self, timeout: float):
+        """None once a slot is held, or why the request is shed."""
+        if self.active < self.concurrency and not self._waiters:
+            self.active += 1
+            self._record()
+            return None
+        if len(self._waiters) >= self.queue_size:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._record()
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except BaseException as exc:
+            if waiter.done() and not waiter.cancelled():
+                # The slot arrived as the wait ended; pass it on.
+                self.release()
+            else:
+                self._waiters.remove(waiter)
+                self._record()
+            if isinstance(exc, asyncio.TimeoutError):
+                return "queue_timeout"
+            raise
+        return None
+
+    def release(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self._record()
+                return
+        self.active -= 1
+        self._record()
+
+
+def gates_from_settings(settings: Settings = settings) -> dict:
+    return {name: Gate(name,
+                       getattr(settings, f"admission_{name}_concurrency"),
+                       getattr(settings, f"admission_{name}_queue"))
+            for name in (AUTH, READS, WRITES, ADMIN)}
+
+
+class AdmissionMiddleware:
+    """Bounds the requests running and waiting per route class.
+
+    Over capacity a request is answered 503 with Retry-After right away
+    instead of piling onto the event loop, the threadpool and the database
+    pool, so a flood of logins or bulk writes cannot starve the feed.
+    """
+
+    def __init__(self, app, gates: dict = None,
+                 timeout: float = settings.admission_queue_timeout,
+                 retry_after: int = settings.admission_retry_after):
+        self.app = app
+        self.gates = gates_from_settings() if gates is None else gates
+        self.timeout = timeout
+        self.retry_after = retry_after
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in EXEMPT_PATHS:
+            return await self.app(scope, receive, send)
+        gate = self.gates[route_class(scope["method"], scope["path"])]
+        reason = await gate.acquire(self.timeout)
+        if reason is not None:
+            gate.registry.record_shed(gate.name, reason)
+            response = JSONResponse(
+                {"detail": "Server busy, retry later"},
+                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={"Retry-After": str(self.retry_after)})
+            return await response(scope, receive, send)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            gate.release()
+
+
+class TokenBuckets:
+    """Per-key token buckets holding up to `burst` tokens, refilled at
+    `rate` per second; each request takes one."""
+
+    def __init__(self, rate: float, burst: int, maxsize: int = 100000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # key -> (tokens, monotonic time of the last refill)
+        self._buckets = OrderedDict()
+        # Also taken from the threadpool by sync dependencies.
+        self._lock = threading.Lock()
+
+    def take(self, key) -> float:
+        """0 if a token was taken, otherwise seconds until one is free."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            # Least recently seen keys go first; a forgotten bucket is a
+            # full one, which is what it would have refilled to anyway
+            # unless it was seen within burst/rate seconds.
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+# Set by the running app when RATE_LIMIT_PER_SECOND is.
+user_buckets: Union[TokenBuckets, None] = None
+
+
+def set_user_buckets(buckets: Union[TokenBuckets, None]):
+    global user_buckets
+    user_buckets = buckets
+
+
+def check_rate_limit(user_id: int):
+    if user_buckets is None:
+        return
+    wait = user_buckets.take(user_id)
+    if wait:
+        metrics.registry.record_shed("user", "rate_limited")
+        raise HTTPException(status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+                            detail="Too many requests",
+                            headers={"Retry-After": str(math.ceil(wait))})
@@ -0,0 +1,57 @@
+"""full-text search index for advertisements
+
+Revision ID: 0002
+Revises: 0001
+Create Date: 2026-10-18 09:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0002'
+down_revision = '0001'
+branch_labels = None
+depends_on = None
+
+FTS_DDL = [
+    """CREATE VIRTUAL TABLE advertisements_fts USING fts5(
+        title, body, content='advertisements', content_rowid='id')""",
+    """CREATE TRIGGER advertisements_fts_ai AFTER INSERT ON advertisements
+    WHEN new.state = 'active' BEGIN
+        INSERT INTO advertisements_fts(rowid, title, body)
+        VALUES (new.id, new.title, new.body);
+    END""",
+    """CREATE TRIGGER advertisements_fts_ad AFTER DELETE ON advertisements
+    WHEN old.state = 'active' BEGIN
+        INSERT INTO advertisements_fts(advertisements_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+    END""",
+    """CREATE TRIGGER advertisements_fts_au
+    AFTER UPDATE OF title, body, state ON advertisements BEGIN
+        INSERT INTO advertisements_fts(advertisements_fts, rowid, title, body)
+        SELECT 'delete', old.id, old.title, old.body WHERE old.state = 'active';
+        INSERT INTO advertisements_fts(rowid, title, body)
+        SELECT new.id, new.title, new.body WHERE new.state = 'active';
+    END""",
+    """INSERT INTO advertisements_fts(rowid, title, body)
+    SELECT id, title, body FROM advertisements WHERE state = 'active'""",
+]
+
+
+def upgrade() -> None:
+    op.drop_index('ix_advertisements_body', table_name='advertisements')
+    if op.get_context().dialect.name != 'sqlite':
+        return
+    for statement in FTS_DDL:
+        op.execute(statement)
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == 'sqlite':
+        op.execute("DROP TRIGGER IF EXISTS advertisements_fts_au")
+        op.execute("DROP TRIGGER IF EXISTS advertisements_fts_ad")
+        op.execute("DROP TRIGGER IF EXISTS advertisements_fts_ai")
+        op.execute("DROP TABLE IF EXISTS advertisements_fts")
+    op.create_index('ix_advertisements_body', 'advertisements', ['body'], unique=False)
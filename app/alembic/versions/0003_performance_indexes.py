@@ -0,0 +1,54 @@
+"""composite indexes for hot queries
+
+Revision ID: 0003
+Revises: 0002
+Create Date: 2026-10-18 09:20:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003'
+down_revision = '0002'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    # Feed and per-owner listings are keyset-paginated on (created_at, id).
+    op.create_index('ix_advertisements_created_at_id', 'advertisements',
+                    ['created_at', 'id'], unique=False)
+    op.create_index('ix_advertisements_owner_id_state_created_at',
+                    'advertisements',
+                    ['owner_id', 'state', 'created_at', 'id'], unique=False)
+    # Token lookups filter on token and expiry and join on user_id; this
+    # covers them without touching the table.
+    op.create_index('ix_tokens_token_expires', 'tokens',
+                    ['token', 'expires', 'user_id'], unique=False)
+
+    op.execute("""DELETE FROM user_groups WHERE id NOT IN (
+        SELECT MIN(id) FROM user_groups GROUP BY user_id, group_id)""")
+    op.create_index('uq_user_groups_user_id_group_id', 'user_groups',
+                    ['user_id', 'group_id'], unique=True)
+    op.create_index('ix_user_groups_group_id_user_id', 'user_groups',
+                    ['group_id', 'user_id'], unique=False)
+
+    # Primary keys are already indexed, and nothing filters on title.
+    op.drop_index('ix_users_id', table_name='users')
+    op.drop_index('ix_groups_id', table_name='groups')
+    op.drop_index('ix_advertisements_id', table_name='advertisements')
+    op.drop_index('ix_advertisements_title', table_name='advertisements')
+
+
+def downgrade() -> None:
+    op.create_index('ix_advertisements_title', 'advertisements', ['title'], unique=False)
+    op.create_index('ix_advertisements_id', 'advertisements', ['id'], unique=False)
+    op.create_index('ix_groups_id', 'groups', ['id'], unique=False)
+    op.create_index('ix_users_id', 'users', ['id'], unique=False)
+    op.drop_index('ix_user_groups_group_id_user_id', table_name='user_groups')
+    op.drop_index('uq_user_groups_user_id_group_id', table_name='user_groups')
+    op.drop_index('ix_tokens_token_expires', table_name='tokens')
+    op.drop_index('ix_advertisements_owner_id_state_created_at', table_name='advertisements')
+    op.drop_index('ix_advertisements_created_at_id', table_name='advertisements')
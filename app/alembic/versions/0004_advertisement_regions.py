@@ -0,0 +1,153 @@
+"""denormalized advertisement regions for the regional feed
+
+Revision ID: 0004
+Revises: 0003
+Create Date: 2026-10-18 09:30:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004'
+down_revision = '0003'
+branch_labels = None
+depends_on = None
+
+TRIGGERS = [
+    """CREATE TRIGGER advertisement_regions_ad_ai AFTER INSERT ON advertisements
+    BEGIN
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, new.created_at, new.id FROM user_groups ug
+        JOIN groups g ON g.id = ug.group_id
+        WHERE ug.user_id = new.owner_id AND g.region IS NOT NULL
+        AND new.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER advertisement_regions_ad_ad AFTER DELETE ON advertisements
+    BEGIN
+        DELETE FROM advertisement_regions WHERE advertisement_id = old.id;
+    END""",
+    """CREATE TRIGGER advertisement_regions_ad_au
+    AFTER UPDATE OF owner_id, created_at ON advertisements BEGIN
+        DELETE FROM advertisement_regions WHERE advertisement_id = old.id;
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, new.created_at, new.id FROM user_groups ug
+        JOIN groups g ON g.id = ug.group_id
+        WHERE ug.user_id = new.owner_id AND g.region IS NOT NULL
+        AND new.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER advertisement_regions_ug_ai AFTER INSERT ON user_groups
+    BEGIN
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, a.created_at, a.id FROM groups g
+        JOIN advertisements a ON a.owner_id = new.user_id
+        WHERE g.id = new.group_id AND g.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER advertisement_regions_ug_ad AFTER DELETE ON user_groups
+    BEGIN
+        DELETE FROM advertisement_regions
+        WHERE region = (SELECT region FROM groups WHERE id = old.group_id)
+        AND advertisement_id IN (SELECT id FROM advertisements WHERE owner_id = old.user_id)
+        AND NOT EXISTS (
+            SELECT 1 FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            JOIN groups g ON g.id = ug.group_id
+            WHERE a.id = advertisement_regions.advertisement_id
+            AND g.region = advertisement_regions.region);
+    END""",
+    """CREATE TRIGGER advertisement_regions_ug_au
+    AFTER UPDATE OF user_id, group_id ON user_groups BEGIN
+        DELETE FROM advertisement_regions
+        WHERE region = (SELECT region FROM groups WHERE id = old.group_id)
+        AND advertisement_id IN (SELECT id FROM advertisements WHERE owner_id = old.user_id)
+        AND NOT EXISTS (
+            SELECT 1 FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            JOIN groups g ON g.id = ug.group_id
+            WHERE a.id = advertisement_regions.advertisement_id
+            AND g.region = advertisement_regions.region);
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, a.created_at, a.id FROM groups g
+        JOIN advertisements a ON a.owner_id = new.user_id
+        WHERE g.id = new.group_id AND g.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER advertisement_regions_g_au AFTER UPDATE OF region ON groups
+    BEGIN
+        DELETE FROM advertisement_regions
+        WHERE region = old.region
+        AND advertisement_id IN (SELECT a.id FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            WHERE ug.group_id = old.id)
+        AND NOT EXISTS (
+            SELECT 1 FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            JOIN groups g ON g.id = ug.group_id
+            WHERE a.id = advertisement_regions.advertisement_id
+            AND g.region = advertisement_regions.region);
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT new.region, a.created_at, a.id FROM user_groups ug
+        JOIN advertisements a ON a.owner_id = ug.user_id
+        WHERE ug.group_id = new.id AND new.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER advertisement_regions_g_ad AFTER DELETE ON groups
+    BEGIN
+        DELETE FROM advertisement_regions
+        WHERE region = old.region
+        AND advertisement_id IN (SELECT a.id FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            WHERE ug.group_id = old.id)
+        AND NOT EXISTS (
+            SELECT 1 FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            JOIN groups g ON g.id = ug.group_id
+            WHERE a.id = advertisement_regions.advertisement_id
+            AND g.region = advertisement_regions.region);
+    END""",
+]
+
+TRIGGER_NAMES = [
+    'advertisement_regions_ad_ai',
+    'advertisement_regions_ad_ad',
+    'advertisement_regions_ad_au',
+    'advertisement_regions_ug_ai',
+    'advertisement_regions_ug_ad',
+    'advertisement_regions_ug_au',
+    'advertisement_regions_g_au',
+    'advertisement_regions_g_ad',
+]
+
+
+def upgrade() -> None:
+    op.create_table(
+        'advertisement_regions',
+        sa.Column('region', sa.String(), nullable=False),
+        sa.Column('created_at', sa.DateTime(), nullable=False),
+        sa.Column('advertisement_id', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['advertisement_id'], ['advertisements.id'], ),
+        sa.PrimaryKeyConstraint('region', 'created_at', 'advertisement_id'),
+        sqlite_with_rowid=False,
+    )
+    op.create_index('ix_advertisement_regions_advertisement_id',
+                    'advertisement_regions', ['advertisement_id'], unique=False)
+    if op.get_context().dialect.name != 'sqlite':
+        return
+    for statement in TRIGGERS:
+        op.execute(statement)
+    op.execute("""INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+    SELECT g.region, a.created_at, a.id FROM advertisements a
+    JOIN user_groups ug ON ug.user_id = a.owner_id
+    JOIN groups g ON g.id = ug.group_id
+    WHERE g.region IS NOT NULL AND a.created_at IS NOT NULL""")
+
+
+def downgrade() -> None:
+    if op.get_context().dialect.name == 'sqlite':
+        for name in reversed(TRIGGER_NAMES):
+            op.execute(f"DROP TRIGGER IF EXISTS {name}")
+    op.drop_index('ix_advertisement_regions_advertisement_id',
+                  table_name='advertisement_regions')
+    op.drop_table('advertisement_regions')
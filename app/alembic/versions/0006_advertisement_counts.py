@@ -0,0 +1,37 @@
+"""maintained advertisement counts per owner and state
+
+Revision ID: 0006
+Revises: 0005
+Create Date: 2026-10-18 10:10:00.000000
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0006'
+down_revision = '0005'
+branch_labels = None
+depends_on = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'advertisement_counts',
+        sa.Column('owner_id', sa.Integer(), autoincrement=False, nullable=False),
+        sa.Column('state', sa.String(length=10), nullable=False),
+        sa.Column('count', sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint('owner_id', 'state'),
+        sqlite_with_rowid=False,
+    )
+    # Owner 0 holds the totals per state.
+    op.execute("""INSERT INTO advertisement_counts(owner_id, state, count)
+        SELECT owner_id, state, COUNT(*) FROM advertisements
+        GROUP BY owner_id, state
+        UNION ALL
+        SELECT 0, state, COUNT(*) FROM advertisements GROUP BY state""")
+
+
+def downgrade() -> None:
+    op.drop_table('advertisement_counts')
@@ -0,0 +1,144 @@
+import threading
+import time
+from collections import OrderedDict, defaultdict
+from typing import Any, Iterable, Union
+from app.settings import settings
+
+
+class CacheBackend:
+    """Interface for tag-invalidated caches.
+
+    An external backend (Redis, memcached) implements the same methods; tags
+    map to the keys stored under them so writes can drop exactly the entries
+    they affect.
+    """
+
+    ttl: float = 60.0
+
+    def get(self, key: str) -> Any:
+        raise NotImplementedError
+
+    def set(self, key: str, value: Any, tags: Iterable[str] = (),
+            ttl: Union[float, None] = None):
+        raise NotImplementedError
+
+    def delete(self, key: str):
+        raise NotImplementedError
+
+    def invalidate_tags(self, *tags: str):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def stats(self) -> dict:
+        raise NotImplementedError
+
+
+class LRUCache(CacheBackend):
+    """In-process LRU cache with per-entry TTL and hit/miss counters."""
+
+    def __init__(self, maxsize: int = 256, ttl: float = 30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._tags = defaultdict(set)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, value, _ = entry
+            if expires_at <= time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, tags=(), ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        tags = frozenset(tags)
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (expires_at, value, tags)
+            for tag in tags:
+                self._tags[tag].add(key)
+            while len(self._entries) > self.maxsize:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_tags(self, *tags):
+        with self._lock:
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    if key in self._entries:
+                        self._remove(key)
+                        self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+# Built from the environment's settings for code running outside an app; a
+# running app puts its own in place with the setters below.
+feed_cache: CacheBackend = LRUCache(maxsize=settings.feed_cache_size,
+                                     ttl=settings.feed_cache_ttl)
+
+principal_cache: CacheBackend = LRUCache(
+    maxsize=settings.principal_cache_size,
+    ttl=settings.principal_cache_ttl)
+
+# Bearer tokens that wrote recently and must read from the primary.
+sticky_cache: CacheBackend = LRUCache(
+    maxsize=settings.principal_cache_size,
+    ttl=settings.replica_sticky_seconds)
+
+
+def set_feed_cache(backend: CacheBackend):
+    global feed_cache
+    feed_cache = backend
+
+
+def set_principal_cache(backend: CacheBackend):
+    global principal_cache
+    principal_cache = backend
+
+
+def set_sticky_cache(backend: CacheBackend):
+    global sticky_cache
+    sticky_cache = backend
@@ -0,0 +1,84 @@
+import hashlib
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Union
+from fastapi import Request, Response
+
+# Per-user resources: clients may keep them but must revalidate every time.
+PRIVATE = "private, no-cache"
+
+
+def make_etag(data: bytes) -> str:
+    return '"{}"'.format(hashlib.blake2b(data, digest_size=16).hexdigest())
+
+
+def as_utc(value: datetime) -> datetime:
+    # Timestamps are stored naive, in UTC (datetime.utcnow).
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+
+def http_date(value: datetime) -> str:
+    return format_datetime(as_utc(value), usegmt=True)
+
+
+def latest(*timestamps) -> Union[datetime, None]:
+    timestamps = [value for value in timestamps if value is not None]
+    return max(timestamps) if timestamps else None
+
+
+def is_conditional(request: Request) -> bool:
+    return ("if-none-match" in request.headers
+            or "if-modified-since" in request.headers)
+
+
+@dataclass(frozen=True)
+class Validators:
+    """ETag and Last-Modified of a representation, plus its caching policy."""
+    etag: str
+    last_modified: Union[datetime, None] = None
+    cache_control: str = PRIVATE
+    vary: Union[str, None] = None
+
+    @classmethod
+    def from_version(cls, *version, last_modified=None, **kwargs):
+        """Validators for a row whose representation is fully determined by
+        `version` (its id and timestamps), so it can be answered from a probe
+        of those columns instead of the full row."""
+        return cls(etag=make_etag(repr(version).encode()),
+                   last_modified=last_modified,
+                   **kwargs)
+
+    def headers(self) -> dict:
+        headers = {"ETag": self.etag, "Cache-Control": self.cache_control}
+        if self.last_modified is not None:
+            headers["Last-Modified"] = http_date(self.last_modified)
+        if self.vary:
+            headers["Vary"] = self.vary
+        return headers
+
+    def matches(self, request: Request) -> bool:
+        """Whether the client's copy is current (RFC 9110, section 13.2.2):
+        If-None-Match wins; If-Modified-Since is only used without it."""
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = {tag.strip() for tag in if_none_match.split(",")}
+            # If-None-Match uses the weak comparison.
+            return bool(tags & {"*", self.etag, "W/" + self.etag})
+        if_modified_since = request.headers.get("if-modified-since")
+        if if_modified_since is None or self.last_modified is None:
+            return False
+        try:
+            since = as_utc(parsedate_to_datetime(if_modified_since))
+        except (TypeError, ValueError):
+            return False
+        # HTTP dates have whole seconds.
+        return as_utc(self.last_modified).replace(microsecond=0) <= since
+
+    def apply(self, response: Response):
+        response.headers.update(self.headers())
+
+    def not_modified(self) -> Response:
+        return Response(status_code=304, headers=self.headers())
@@ -0,0 +1,5 @@
+from sqlalchemy.orm import declarative_base
+
+# The one declarative base. It lives apart from app.db.database so the
+# models can be imported without creating engines from the settings.
+Base = declarative_base()
@@ -1,10 +1,162 @@
-from sqlalchemy import create_engine
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker
+from typing import Union
+from sqlalchemy import create_engine, event
+from sqlalchemy.exc import InvalidRequestError
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.orm import Session, sessionmaker
+from sqlalchemy.pool import AsyncAdaptedQueuePool
+from app.db.base import Base  # noqa: F401
+from app.settings import Settings, settings
 
-SQLALCHEMY_DATABASE_URL = 'sqlite://'
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
 
-engine = create_engine(SQLALCHEMY_DATABASE_URL, echo=True)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
-Base = declarative_base()
+def async_url(url: str):
+    url = make_url(url)
+    return url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+
+
+def is_memory_sqlite(url) -> bool:
+    url = make_url(url)
+    return url.get_backend_name() == "sqlite" and url.database in (
+        None, "", ":memory:")
+
+
+def engine_options(url, settings: Settings, is_async: bool = False) -> dict:
+    options = {"echo": settings.db_echo}
+    if is_memory_sqlite(url):
+        return options
+    options.update(pool_size=settings.db_pool_size,
+                   max_overflow=settings.db_max_overflow,
+                   pool_recycle=settings.db_pool_recycle,
+                   pool_pre_ping=settings.db_pool_pre_ping)
+    if is_async and make_url(url).get_backend_name() == "sqlite":
+        # aiosqlite defaults to NullPool, which would reopen the file and
+        # rerun the connect-time PRAGMAs on every checkout.
+        options["poolclass"] = AsyncAdaptedQueuePool
+    return options
+
+
+def sqlite_pragmas(settings: Settings):
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+        cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+        cursor.execute(f"PRAGMA mmap_size={settings.sqlite_mmap_size:d}")
+        cursor.execute(f"PRAGMA cache_size={settings.sqlite_cache_size:d}")
+        cursor.execute(f"PRAGMA busy_timeout={settings.sqlite_busy_timeout:d}")
+        cursor.close()
+
+    return set_sqlite_pragmas
+
+
+def configure_engine(engine: Engine, settings: Settings):
+    if engine.dialect.name == "sqlite" and not is_memory_sqlite(engine.url):
+        event.listen(engine, "connect", sqlite_pragmas(settings))
+    return engine
+
+
+def make_async_engine(url: str, settings: Settings):
+    engine = create_async_engine(async_url(url),
+                                 **engine_options(url, settings, is_async=True))
+    configure_engine(engine.sync_engine, settings)
+    return engine
+
+
+class Database:
+    """The engines and session factories for one set of settings.
+
+    Building one connects to nothing; its pools fill on first use. The read
+    replica's are None unless REPLICA_DATABASE_URL is set; its sessions
+    carry info["replica"] and refuse to flush.
+    """
+
+    def __init__(self, settings: Settings):
+        url = settings.database_url
+        self.engine = configure_engine(
+            create_engine(url, **engine_options(url, settings)), settings)
+        # Sessions live for one request and the write helpers return the
+        # objects they just wrote, whose ids and defaults come back from the
+        # INSERT itself, so nothing is expired (and reloaded) on commit.
+        # Objects returned from async sessions are also serialized after the
+        # greenlet that ran the query has finished, where a reload could not
+        # run.
+        self.SessionLocal = sessionmaker(autocommit=False,
+                                         autoflush=False,
+                                         expire_on_commit=False,
+                                         bind=self.engine)
+        self.async_engine = make_async_engine(url, settings)
+        self.AsyncSessionLocal = async_sessionmaker(self.async_engine,
+                                                    autoflush=False,
+                                                    expire_on_commit=False)
+        self.async_replica_engine = self.AsyncReplicaSessionLocal = None
+        if settings.replica_database_url:
+            self.async_replica_engine = make_async_engine(
+                settings.replica_database_url, settings)
+            self.AsyncReplicaSessionLocal = async_sessionmaker(
+                self.async_replica_engine,
+                autoflush=False,
+                expire_on_commit=False,
+                info={"replica": True})
+
+    async def dispose(self):
+        await self.async_engine.dispose()
+        self.engine.dispose()
+        if self.async_replica_engine is not None:
+            await self.async_replica_engine.dispose()
+
+
+# The Database of the running app, put in place by its lifespan; outside an
+# app (scripts, benchmarks) one is built from the environment on first use.
+_current: Union[Database, None] = None
+RESOURCES = frozenset({"engine", "SessionLocal", "async_engine",
+                       "AsyncSessionLocal", "async_replica_engine",
+                       "AsyncReplicaSessionLocal"})
+
+
+def current() -> Database:
+    global _current
+    if _current is None:
+        _current = Database(settings)
+    return _current
+
+
+def use_database(db: Union[Database, None]) -> Union[Database, None]:
+    """Make `db` the current Database and return the one it replaces."""
+    global _current
+    previous, _current = _current, db
+    return previous
+
+
+def __getattr__(name: str):
+    # database.engine, database.AsyncSessionLocal, ... are looked up on the
+    # current Database at each access, so they follow the running app.
+    if name in RESOURCES:
+        return getattr(current(), name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@event.listens_for(Session, "before_flush")
+def refuse_replica_writes(session, flush_context, instances):
+    if session.info.get("replica"):
+        raise InvalidRequestError("Replica sessions are read-only")
+
+
+def as_async(function):
+    """Expose a sync query helper on an AsyncSession.
+
+    The helper runs through AsyncSession.run_sync, so the same query and
+    write logic serves both session types without blocking the event loop.
+    """
+
+    async def wrapper(db: AsyncSession, *args, **kwargs):
+        return await db.run_sync(function, *args, **kwargs)
+
+    wrapper.__name__ = f"{function.__name__}_async"
+    wrapper.__qualname__ = wrapper.__name__
+    wrapper.__doc__ = function.__doc__
+    return wrapper
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+from typing import Callable, Union
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+
+def bind(unit: Callable, *args, **kwargs) -> Callable:
+    return lambda session: unit(session, *args, **kwargs)
+
+
+def run_and_commit(session: Session, unit: Callable):
+    result = unit(session)
+    session.commit()
+    return result
+
+
+def run_all(units: list, session: Session) -> list:
+    return [unit(session) for unit in units]
+
+
+class GroupCommitter:
+    """Commits small writes from concurrent requests together.
+
+    A unit is a function that stages a write on the session it is given and
+    does not commit. The first unit waits up to `window` seconds (less if
+    `max_batch` units arrive) and then everything pending is committed in
+    one transaction, so on file-backed SQLite the batch shares one fsync
+    instead of paying one per request. Units that arrive during a commit
+    form the next batch. If a batch fails, its units are retried one
+    transaction each, so only the unit at fault sees the error.
+    """
+
+    def __init__(self, session_factory, window: float, max_batch: int):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_batch = max_batch
+        self._pending = []
+        self._full = None
+        self._flusher = None
+
+    async def run(self, unit: Callable, *args, **kwargs):
+        """Stage `unit(session, *args, **kwargs)` and return its result once
+        it is committed."""
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((bind(unit, *args, **kwargs), future))
+        if self._flusher is None or self._flusher.done():
+            self._full = asyncio.Event()
+            self._flusher = asyncio.ensure_future(self._flush_pending())
+        elif len(self._pending) >= self.max_batch:
+            self._full.set()
+        return await future
+
+    async def _flush_pending(self):
+        try:
+            await asyncio.wait_for(self._full.wait(), self.window)
+        except asyncio.TimeoutError:
+            pass
+        while self._pending:
+            batch = self._pending[:self.max_batch]
+            del self._pending[:self.max_batch]
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        if len(batch) > 1:
+            units = [unit for unit, _ in batch]
+            try:
+                async with self.session_factory() as session:
+                    results = await session.run_sync(
+                        run_and_commit, functools.partial(run_all, units))
+            except Exception:
+                pass  # retried one by one below
+            else:
+                for (_, future), result in zip(batch, results):
+                    if not future.done():
+                        future.set_result(result)
+                return
+        await self._flush_one_by_one(batch)
+
+    async def _flush_one_by_one(self, batch: list):
+        for unit, future in batch:
+            try:
+                async with self.session_factory() as session:
+                    result = await session.run_sync(run_and_commit, unit)
+            except Exception as exc:
+                if not future.done():
+                    future.set_exception(exc)
+            else:
+                if not future.done():
+                    future.set_result(result)
+
+    async def drain(self):
+        """Commit whatever is pending; call before the event loop stops."""
+        if self._flusher is not None and not self._flusher.done():
+            self._full.set()
+            await self._flusher
+
+
+# Set by the running app when GROUP_COMMIT is on.
+committer: Union[GroupCommitter, None] = None
+
+
+def set_committer(group_committer: Union[GroupCommitter, None]):
+    global committer
+    committer = group_committer
+
+
+async def commit(db: AsyncSession, unit: Callable, *args, **kwargs):
+    """Run the write `unit(session, *args, **kwargs)` and commit it: in the
+    shared group-commit transaction when GROUP_COMMIT is on, otherwise in
+    `db`."""
+    if committer is not None:
+        # Hand the request's connection back while waiting, or a burst of
+        # requests could hold every pooled connection the flush needs.
+        await db.commit()
+        return await committer.run(unit, *args, **kwargs)
+    return await db.run_sync(run_and_commit, bind(unit, *args, **kwargs))
@@ -1,16 +1,14 @@
 import datetime
-from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, text
+from sqlalchemy import Boolean, Column, ForeignKey, Integer, String, DateTime, Index, DDL, column, event, table, text
 from sqlalchemy.orm import relationship
-from sqlalchemy.ext.declarative import declarative_base
+from app.db.base import Base
 import uuid
 
-Base = declarative_base()
-
 
 class User(Base):
     __tablename__ = "users"
 
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     email = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     is_active = Column(Boolean, default=True)
@@ -20,7 +18,8 @@ class User(Base):
 
     advertisements = relationship("Advertisement", back_populates="owner")
     tokens = relationship("Token", back_populates="user")
-    groups = relationship("Group", secondary="user_groups", back_populates="user")
+    groups = relationship("Group", secondary="user_groups", back_populates="user",
+                          order_by="Group.id")
 
 
 class Token(Base):
@@ -32,7 +31,7 @@ class Token(Base):
     )
     token = Column(
         String,
-        server_default=str(uuid.uuid4()),
+        default=lambda: uuid.uuid4().hex,
         unique=True,
         nullable=False,
         index=True,
@@ -41,11 +40,15 @@ class Token(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     user = relationship("User", back_populates="tokens")
 
+    __table_args__ = (
+        Index("ix_tokens_token_expires", "token", "expires", "user_id"),
+    )
+
 
 class Group(Base):
     __tablename__ = "groups"
     region = Column(String)
-    id = Column(Integer, primary_key=True, index=True)
+    id = Column(Integer, primary_key=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
     user = relationship("User", secondary="user_groups", back_populates="groups")
@@ -59,15 +62,244 @@ class UserGroup(Base):
     user_id = Column(Integer, ForeignKey("users.id"))
     group_id = Column(Integer, ForeignKey("groups.id"))
 
+    __table_args__ = (
+        Index("uq_user_groups_user_id_group_id", "user_id", "group_id",
+              unique=True),
+        Index("ix_user_groups_group_id_user_id", "group_id", "user_id"),
+    )
+
 
 class Advertisement(Base):
     __tablename__ = "advertisements"
 
-    id = Column(Integer, primary_key=True, index=True)
-    title = Column(String(100), index=True, nullable=True)
-    body = Column(String(10000), index=True)
+    id = Column(Integer, primary_key=True)
+    title = Column(String(100), nullable=True)
+    body = Column(String(10000))
     owner_id = Column(Integer, ForeignKey("users.id"))
     state = Column(String(10))
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
     updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
     owner = relationship("User", back_populates="advertisements")
+    attachments = relationship("Attachment", back_populates="advertisement",
+                               order_by="Attachment.id")
+
+    __table_args__ = (
+        Index("ix_advertisements_created_at_id", "created_at", "id"),
+        Index("ix_advertisements_owner_id_state_created_at", "owner_id",
+              "state", "created_at", "id"),
+        Index("ix_advertisements_state_created_at", "state", "created_at",
+              "id"),
+    )
+
+
+# Full-text index over active advertisements. It is an external-content FTS5
+# table, so it stores only the inverted index and reads title/body back from
+# `advertisements`; triggers keep it in step with inserts, edits and state
+# changes so only searchable (active) ads are indexed.
+advertisements_fts = table("advertisements_fts", column("rowid"), column("rank"))
+
+ADVERTISEMENTS_FTS_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS advertisements_fts USING fts5(
+        title, body, content='advertisements', content_rowid='id')""",
+    """CREATE TRIGGER IF NOT EXISTS advertisements_fts_ai AFTER INSERT ON advertisements
+    WHEN new.state = 'active' BEGIN
+        INSERT INTO advertisements_fts(rowid, title, body)
+        VALUES (new.id, new.title, new.body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisements_fts_ad AFTER DELETE ON advertisements
+    WHEN old.state = 'active' BEGIN
+        INSERT INTO advertisements_fts(advertisements_fts, rowid, title, body)
+        VALUES ('delete', old.id, old.title, old.body);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisements_fts_au
+    AFTER UPDATE OF title, body, state ON advertisements BEGIN
+        INSERT INTO advertisements_fts(advertisements_fts, rowid, title, body)
+        SELECT 'delete', old.id, old.title, old.body WHERE old.state = 'active';
+        INSERT INTO advertisements_fts(rowid, title, body)
+        SELECT new.id, new.title, new.body WHERE new.state = 'active';
+    END""",
+]
+
+
+
+class AdvertisementRegion(Base):
+    """Ad-to-region mapping derived from the owner's groups.
+
+    Rows are maintained by the triggers below, never written by the app. The
+    primary key is the regional feed order, and the table is clustered on it
+    (WITHOUT ROWID), so a regional feed page is one range scan.
+    """
+    __tablename__ = "advertisement_regions"
+
+    region = Column(String, primary_key=True)
+    created_at = Column(DateTime, primary_key=True)
+    advertisement_id = Column(Integer, ForeignKey("advertisements.id"),
+                              primary_key=True)
+
+    __table_args__ = (
+        Index("ix_advertisement_regions_advertisement_id", "advertisement_id"),
+        {"sqlite_with_rowid": False},
+    )
+
+
+# Drops mappings for which the ad's owner no longer belongs to any group in
+# that region; used after memberships or group regions change.
+_PRUNE_ADVERTISEMENT_REGIONS = """
+        DELETE FROM advertisement_regions
+        WHERE region = {region}
+        AND advertisement_id IN ({advertisements})
+        AND NOT EXISTS (
+            SELECT 1 FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            JOIN groups g ON g.id = ug.group_id
+            WHERE a.id = advertisement_regions.advertisement_id
+            AND g.region = advertisement_regions.region);"""
+
+_USER_ADVERTISEMENTS = "SELECT id FROM advertisements WHERE owner_id = old.user_id"
+_GROUP_ADVERTISEMENTS = """SELECT a.id FROM advertisements a
+            JOIN user_groups ug ON ug.user_id = a.owner_id
+            WHERE ug.group_id = old.id"""
+
+ADVERTISEMENT_REGIONS_DDL = [
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ad_ai AFTER INSERT ON advertisements
+    BEGIN
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, new.created_at, new.id FROM user_groups ug
+        JOIN groups g ON g.id = ug.group_id
+        WHERE ug.user_id = new.owner_id AND g.region IS NOT NULL
+        AND new.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ad_ad AFTER DELETE ON advertisements
+    BEGIN
+        DELETE FROM advertisement_regions WHERE advertisement_id = old.id;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ad_au
+    AFTER UPDATE OF owner_id, created_at ON advertisements BEGIN
+        DELETE FROM advertisement_regions WHERE advertisement_id = old.id;
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, new.created_at, new.id FROM user_groups ug
+        JOIN groups g ON g.id = ug.group_id
+        WHERE ug.user_id = new.owner_id AND g.region IS NOT NULL
+        AND new.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ug_ai AFTER INSERT ON user_groups
+    BEGIN
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, a.created_at, a.id FROM groups g
+        JOIN advertisements a ON a.owner_id = new.user_id
+        WHERE g.id = new.group_id AND g.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ug_ad AFTER DELETE ON user_groups
+    BEGIN""" + _PRUNE_ADVERTISEMENT_REGIONS.format(
+        region="(SELECT region FROM groups WHERE id = old.group_id)",
+        advertisements=_USER_ADVERTISEMENTS) + """
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_ug_au
+    AFTER UPDATE OF user_id, group_id ON user_groups BEGIN""" +
+    _PRUNE_ADVERTISEMENT_REGIONS.format(
+        region="(SELECT region FROM groups WHERE id = old.group_id)",
+        advertisements=_USER_ADVERTISEMENTS) + """
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT g.region, a.created_at, a.id FROM groups g
+        JOIN advertisements a ON a.owner_id = new.user_id
+        WHERE g.id = new.group_id AND g.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_g_au AFTER UPDATE OF region ON groups
+    BEGIN""" + _PRUNE_ADVERTISEMENT_REGIONS.format(
+        region="old.region",
+        advertisements=_GROUP_ADVERTISEMENTS) + """
+        INSERT OR IGNORE INTO advertisement_regions(region, created_at, advertisement_id)
+        SELECT new.region, a.created_at, a.id FROM user_groups ug
+        JOIN advertisements a ON a.owner_id = ug.user_id
+        WHERE ug.group_id = new.id AND new.region IS NOT NULL
+        AND a.created_at IS NOT NULL;
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS advertisement_regions_g_ad AFTER DELETE ON groups
+    BEGIN""" + _PRUNE_ADVERTISEMENT_REGIONS.format(
+        region="old.region",
+        advertisements=_GROUP_ADVERTISEMENTS) + """
+    END""",
+]
+
+for statement in ADVERTISEMENTS_FTS_DDL:
+    event.listen(Advertisement.__table__, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+event.listen(Advertisement.__table__, "before_drop",
+             DDL("DROP TABLE IF EXISTS advertisements_fts").execute_if(
+                 dialect="sqlite"))
+# The triggers span users' groups and advertisements, so they are created
+# once every table exists.
+for statement in ADVERTISEMENT_REGIONS_DDL:
+    event.listen(Base.metadata, "after_create",
+                 DDL(statement).execute_if(dialect="sqlite"))
+
+
+class AdvertisementCount(Base):
+    """Number of ads per owner and state.
+
+    Updated in the same transaction as every state transition in
+    advertisement_functions, so totals are read from here instead of counted
+    over `advertisements`. Rows with owner_id ALL_OWNERS hold the totals.
+    """
+    __tablename__ = "advertisement_counts"
+
+    ALL_OWNERS = 0
+
+    owner_id = Column(Integer, primary_key=True, autoincrement=False)
+    state = Column(String(10), primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+    __table_args__ = ({"sqlite_with_rowid": False},)
+
+
+ATTACHMENT_EXTENSIONS = {
+    "image/jpeg": ".jpg",
+    "image/png": ".png",
+    "image/gif": ".gif",
+    "image/webp": ".webp",
+}
+
+
+def attachment_file_name(sha256: str, content_type: str) -> str:
+    return sha256 + ATTACHMENT_EXTENSIONS[content_type]
+
+
+def attachment_url(sha256: str, content_type: str) -> str:
+    return "/attachments/" + attachment_file_name(sha256, content_type)
+
+
+class Attachment(Base):
+    """An image attached to an advertisement.
+
+    Only metadata lives here; the bytes are stored once per content under
+    ATTACHMENTS_DIR, named by their SHA-256 (see app.functions.attachments).
+    Thumbnails are JPEGs stored the same way.
+    """
+    __tablename__ = "attachments"
+
+    THUMBNAIL_TYPE = "image/jpeg"
+
+    id = Column(Integer, primary_key=True)
+    advertisement_id = Column(Integer, ForeignKey("advertisements.id"),
+                              nullable=False, index=True)
+    sha256 = Column(String(64), nullable=False)
+    content_type = Column(String(20), nullable=False)
+    size = Column(Integer, nullable=False)
+    width = Column(Integer, nullable=True)
+    height = Column(Integer, nullable=True)
+    thumbnail_sha256 = Column(String(64), nullable=True)
+    created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    updated_at = Column(DateTime, onupdate=datetime.datetime.utcnow)
+    advertisement = relationship("Advertisement", back_populates="attachments")
+
+    @property
+    def url(self) -> str:
+        return attachment_url(self.sha256, self.content_type)
+
+    @property
+    def thumbnail_url(self):
+        if self.thumbnail_sha256 is None:
+            return None
+        return attachment_url(self.thumbnail_sha256, self.THUMBNAIL_TYPE)
@@ -0,0 +1,153 @@
+import contextvars
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Union
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+slow_query_logger = logging.getLogger("app.db.slow_query")
+
+_request_counter = contextvars.ContextVar("request_query_counter",
+                                          default=None)
+_global_counters = set()
+_global_lock = threading.Lock()
+
+
+class QueryCounter:
+
+    def __init__(self, record: bool = False, parent=None):
+        self.count = 0
+        # Seconds spent executing statements.
+        self.duration = 0.0
+        self.statements = [] if record else None
+        self.parent = parent
+
+    def add(self, statement: str):
+        self.count += 1
+        if self.statements is not None:
+            self.statements.append(statement)
+        if self.parent is not None:
+            self.parent.add(statement)
+
+    def add_duration(self, seconds: float):
+        self.duration += seconds
+        if self.parent is not None:
+            self.parent.add_duration(seconds)
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _count_statement(conn, cursor, statement, parameters, context,
+                     executemany):
+    if context is not None:
+        context.query_start = time.perf_counter()
+    counter = _request_counter.get()
+    if counter is not None:
+        counter.add(statement)
+    if _global_counters:
+        with _global_lock:
+            for global_counter in _global_counters:
+                global_counter.add(statement)
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _time_statement(conn, cursor, statement, parameters, context,
+                    executemany):
+    start = getattr(context, "query_start", None)
+    if start is None:
+        return
+    elapsed = time.perf_counter() - start
+    counter = _request_counter.get()
+    if counter is not None:
+        counter.add_duration(elapsed)
+    if (settings.slow_query_ms is not None
+            and elapsed * 1000 >= settings.slow_query_ms):
+        slow_query_logger.warning("%.1f ms%s: %s", elapsed * 1000,
+                                  " (executemany)" if executemany else "",
+                                  statement)
+
+
+def current_counter():
+    return _request_counter.get()
+
+
+@contextmanager
+def track_request_queries():
+    """Count statements issued by the current request (context-local).
+
+    Statements counted by a nested block also count towards the enclosing
+    one, so e.g. an ASGI wrapper around the app sees the request's total.
+    """
+    counter = QueryCounter(parent=_request_counter.get())
+    token = _request_counter.set(counter)
+    try:
+        yield counter
+    finally:
+        _request_counter.reset(token)
+
+
+@contextmanager
+def untracked():
+    """Leave the block's statements out of the current request's count,
+    e.g. background probes that happen to run inside a request."""
+    token = _request_counter.set(None)
+    try:
+        yield
+    finally:
+        _request_counter.reset(token)
+
+
+@contextmanager
+def count_queries(record: bool = True):
+    """Count every statement issued in the process while the block runs.
+
+    Unlike `track_request_queries` this is not bound to a context, so it also
+    sees statements issued from the threads a test client dispatches to.
+    """
+    counter = QueryCounter(record=record)
+    with _global_lock:
+        _global_counters.add(counter)
+    try:
+        yield counter
+    finally:
+        with _global_lock:
+            _global_counters.discard(counter)
+
+
+@contextmanager
+def assert_max_queries(max_queries: int):
+    with count_queries() as counter:
+        yield counter
+    if counter.count > max_queries:
+        statements = "\n".join(counter.statements)
+        raise QueryBudgetExceeded(
+            f"{counter.count} SQL statements issued, expected at most "
+            f"{max_queries}:\n{statements}")
+
+
+class QueryBudget:
+    """Route dependency that flags requests exceeding a statement budget."""
+
+    def __init__(self, max_queries: int, strict: Union[bool, None] = None):
+        self.max_queries = max_queries
+        # None follows QUERY_BUDGET_STRICT of the app serving the request.
+        self.strict = strict
+
+    def __call__(self):
+        counter = current_counter()
+        yield
+        if counter is None or counter.count <= self.max_queries:
+            return
+        message = (f"{counter.count} SQL statements issued, budget is "
+                   f"{self.max_queries}")
+        strict = settings.query_budget_strict if self.strict is None else self.strict
+        if strict:
+            raise QueryBudgetExceeded(message)
+        logger.warning(message)
@@ -0,0 +1,127 @@
+import hashlib
+import math
+import time
+from datetime import datetime
+from typing import Union
+from fastapi import Request
+from fastapi.security.utils import get_authorization_scheme_param
+from sqlalchemy import func, select, text
+from app import cache
+from app.db import models, query_counter
+from app.settings import settings
+
+SAFE_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+
+# Newest ad on each side; ads are the bulk of the writes, and the
+# (created_at, id) index answers this without a scan.
+NEWEST_ADVERTISEMENT = select(func.max(models.Advertisement.created_at))
+# A streaming replica knows its own replay delay; it is zero while it has
+# replayed everything it received, however long the primary has been idle.
+POSTGRESQL_REPLAY_LAG = text(
+    "SELECT CASE WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() "
+    "THEN 0 ELSE COALESCE(EXTRACT(EPOCH FROM now() - "
+    "pg_last_xact_replay_timestamp()), 0) END")
+
+
+def lag_between(on_primary: Union[datetime, None],
+                on_replica: Union[datetime, None]) -> float:
+    """Seconds of ads the replica is missing, from the newest `created_at`
+    on either side."""
+    if on_primary is None or on_replica is not None and on_replica >= on_primary:
+        return 0.0
+    if on_replica is None:
+        return math.inf
+    return (on_primary - on_replica).total_seconds()
+
+
+class ReplicaMonitor:
+    """Whether reads may go to the replica.
+
+    The replica is probed at most every `check_interval` seconds; requests
+    in between reuse the last answer. It is usable while the probe succeeds
+    and it is at most `max_lag` seconds behind the primary.
+    """
+
+    def __init__(self, primary, replica, max_lag: float,
+                 check_interval: float):
+        self.primary = primary
+        self.replica = replica
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.healthy = False
+        self.lag = None
+        self.checked_at = None
+
+    def _due(self) -> bool:
+        now = time.monotonic()
+        if self.checked_at is not None and now - self.checked_at < self.check_interval:
+            return False
+        # Claimed before probing, so concurrent requests keep using the last
+        # answer instead of probing too.
+        self.checked_at = now
+        return True
+
+    def _record(self, lag: float):
+        self.lag = lag
+        self.healthy = lag <= self.max_lag
+
+    def mark_down(self):
+        """Route reads to the primary until the next probe."""
+        self.healthy = False
+        self.checked_at = time.monotonic()
+
+    async def available_async(self) -> bool:
+        if self._due():
+            try:
+                with query_counter.untracked():
+                    self._record(await self._probe_async())
+            except Exception:
+                self.mark_down()
+        return self.healthy
+
+    async def _probe_async(self) -> float:
+        async with self.replica.connect() as replica:
+            if replica.dialect.name == "postgresql":
+                return await replica.scalar(POSTGRESQL_REPLAY_LAG)
+            async with self.primary.connect() as primary:
+                return lag_between(await primary.scalar(NEWEST_ADVERTISEMENT),
+                                   await replica.scalar(NEWEST_ADVERTISEMENT))
+
+
+# Set by the running app when it has a replica.
+monitor: Union[ReplicaMonitor, None] = None
+
+
+def set_monitor(replica_monitor: Union[ReplicaMonitor, None]):
+    global monitor
+    monitor = replica_monitor
+
+
+def sticky_key(request: Request) -> Union[str, None]:
+    scheme, token = get_authorization_scheme_param(
+        request.headers.get("authorization"))
+    if scheme.lower() != "bearer" or not token:
+        return None
+    return "sticky:" + hashlib.blake2b(token.encode(), digest_size=16).hexdigest()
+
+
+def mark_write(request: Request):
+    """Send this client's reads to the primary for REPLICA_STICKY_SECONDS,
+    so it sees its own write before the replica has it."""
+    key = sticky_key(request)
+    if key is not None and request.method not in SAFE_METHODS:
+        cache.sticky_cache.set(key, True)
+
+
+def is_sticky(request: Request) -> bool:
+    key = sticky_key(request)
+    return key is not None and cache.sticky_cache.get(key) is not None
+
+
+def read_ttl(session, ttl: float) -> float:
+    """Cache lifetime for something read through `session`: a write drops
+    the cached copy, but a lagging replica could put the old value back, so
+    replica reads are kept no longer than the lag the replica may have."""
+    if session.info.get("replica"):
+        return min(ttl, settings.replica_max_lag_seconds)
+    return ttl
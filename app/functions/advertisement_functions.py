@@ -1,38 +1,294 @@
+import base64
+from datetime import datetime
+from typing import Union
 from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from sqlalchemy import insert, or_, select, text, tuple_, update
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, Query, joinedload, selectinload
 from app.schemas import advertisement_schema
 from app.db import models
+from app.db import group_commit, replica
+from app.db.database import as_async
+from app.functions import counters, serialization
+from app import cache, conditional, permissions
+from app.settings import settings
 
+# Offset pages and the first cursor page shift whenever an ad is created;
+# pages behind a cursor only change when one of their own ads does.
+FEED_HEAD_TAG = "feed:head"
 
-def all_advertisements(db: Session, skip: int = 0, limit: int = 100):
-    return db.query(models.Advertisement).order_by(
-        models.Advertisement.created_at.desc()).offset(skip).limit(
-            limit).all()
+
+def encode_cursor(advertisement: models.Advertisement) -> str:
+    raw = f"{advertisement.created_at.isoformat()}|{advertisement.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, advertisement_id = raw.decode().split("|")
+        return datetime.fromisoformat(created_at), int(advertisement_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor")
+
+
+def next_cursor(advertisements: list, limit: int):
+    if limit and len(advertisements) == limit:
+        return encode_cursor(advertisements[-1])
+    return None
+
+
+def paginate(query: Query, skip: int, limit: int, after: Union[str, None],
+             keys=(models.Advertisement.created_at, models.Advertisement.id),
+             ascending: bool = False):
+    # Keyset pagination on (created_at, id): a cursor page is a range scan
+    # on the matching index instead of scanning and discarding `skip` rows.
+    if ascending:
+        query = query.order_by(*keys)
+    else:
+        query = query.order_by(*(key.desc() for key in keys))
+    if after:
+        cursor = decode_cursor(after)
+        query = query.filter(tuple_(*keys) > cursor if ascending
+                             else tuple_(*keys) < cursor)
+    else:
+        query = query.offset(skip)
+    return query.limit(limit)
+
+
+def feed_query(db: Session, rows: bool = False):
+    if rows:
+        return db.query(*serialization.FEED_COLUMNS).join(
+            models.Advertisement.owner)
+    return db.query(models.Advertisement).options(
+        joinedload(models.Advertisement.owner),
+        selectinload(models.Advertisement.attachments))
+
+
+def feed_attachments(db: Session, advertisement_ids: list) -> dict:
+    """Attachment rows of the given ads, keyed by ad id, for the fast
+    serialization path."""
+    attachments = {}
+    if advertisement_ids:
+        rows = db.execute(
+            select(*serialization.ATTACHMENT_COLUMNS).where(
+                models.Attachment.advertisement_id.in_(
+                    advertisement_ids)).order_by(models.Attachment.id))
+        for row in rows:
+            attachments.setdefault(row.advertisement_id, []).append(row)
+    return attachments
+
+
+def all_advertisements(db: Session,
+                       skip: int = 0,
+                       limit: int = 100,
+                       after: Union[str, None] = None,
+                       rows: bool = False):
+    query = feed_query(db, rows=rows)
+    return paginate(query, skip=skip, limit=limit, after=after).all()
+
+
+def region_advertisements(db: Session,
+                          region: str,
+                          skip: int = 0,
+                          limit: int = 100,
+                          after: Union[str, None] = None,
+                          rows: bool = False):
+    query = feed_query(db, rows=rows)
+    if db.get_bind().dialect.name == "sqlite":
+        # advertisement_regions is kept up to date by triggers and ordered
+        # like the feed, so the page is read off its primary key.
+        regions = models.AdvertisementRegion
+        query = query.join(
+            regions, regions.advertisement_id == models.Advertisement.id
+        ).filter(regions.region == region)
+        keys = (regions.created_at, regions.advertisement_id)
+    else:
+        owners = db.query(models.UserGroup.user_id).join(
+            models.Group, models.Group.id == models.UserGroup.group_id).filter(
+                models.Group.region == region)
+        query = query.filter(models.Advertisement.owner_id.in_(owners))
+        keys = (models.Advertisement.created_at, models.Advertisement.id)
+    return paginate(query, skip=skip, limit=limit, after=after,
+                    keys=keys).all()
+
+
+def default_region(user: Union[models.User, None]):
+    regions = sorted((group.id, group.region) for group in user.groups
+                     if group.region) if user else []
+    return regions[0][1] if regions else None
+
+
+def count_feed(db: Session, region: Union[str, None] = None) -> int:
+    if region:
+        return counters.count_owned_by(db, counters.region_owners(region))
+    return counters.count(db)
+
+
+def feed_page(db: Session,
+              skip: int = 0,
+              limit: int = 100,
+              after: Union[str, None] = None,
+              region: Union[str, None] = None):
+    # The total is read apart from the cached page: it changes with writes
+    # anywhere in the feed, not only on this page, and is a counter lookup.
+    total = count_feed(db, region=region)
+    key = f"feed:{region or ''}:{skip}:{limit}:{after or ''}"
+    page = cache.feed_cache.get(key)
+    if page is not None:
+        body, cursor, validators = page
+        return body, cursor, total, validators
+
+    rows = settings.fast_serialization
+    if region:
+        ads = region_advertisements(db, region=region, skip=skip, limit=limit,
+                                    after=after, rows=rows)
+    else:
+        ads = all_advertisements(db, skip=skip, limit=limit, after=after,
+                                 rows=rows)
+    if rows:
+        attachments = feed_attachments(
+            db, [ad.id for ad in ads if ad.state == 'active'])
+        body = serialization.dumps(serialization.feed_items(ads, attachments))
+        owners_updated_at = [ad.owner_updated_at for ad in ads]
+        attachments = [attachment for items in attachments.values()
+                       for attachment in items]
+    else:
+        items = [advertisement_schema.AdvertisementToFeed.from_orm(ad)
+                 for ad in ads]
+        body = JSONResponse(content=jsonable_encoder(items)).body
+        owners_updated_at = [ad.owner.updated_at for ad in ads]
+        attachments = [attachment for ad in ads if ad.state == 'active'
+                       for attachment in ad.attachments]
+    # The page is cached until a write that could change it, so the hash of
+    # the cached body is a validator that costs no query to check.
+    validators = conditional.Validators(
+        etag=conditional.make_etag(body),
+        last_modified=conditional.latest(
+            *(ad.created_at for ad in ads), *(ad.updated_at for ad in ads),
+            *owners_updated_at,
+            *(attachment.created_at for attachment in attachments),
+            *(attachment.updated_at for attachment in attachments)),
+        cache_control=f"max-age={settings.feed_max_age}, must-revalidate",
+        vary="Authorization")
+    cursor = next_cursor(ads, limit)
+
+    tags = {advertisement_tag(ad.id) for ad in ads}
+    tags.update(user_tag(ad.owner_id) for ad in ads)
+    if not after:
+        tags.add(FEED_HEAD_TAG)
+    cache.feed_cache.set(key, (body, cursor, validators), tags=tags,
+                         ttl=replica.read_ttl(db, cache.feed_cache.ttl))
+    return body, cursor, total, validators
+
+
+def fts_query(q: str) -> str:
+    # Quote every term so user input is matched literally instead of being
+    # parsed as FTS5 query syntax; the terms are implicitly AND-ed.
+    terms = q.split()
+    if not terms:
+        # An empty MATCH expression is an FTS5 syntax error.
+        raise ValueError("Search query has no terms")
+    return " ".join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+
+def search_advertisements(db: Session, q: str, skip: int = 0,
+                          limit: int = 100):
+    query = db.query(models.Advertisement).options(
+        joinedload(models.Advertisement.owner),
+        selectinload(models.Advertisement.attachments))
+    if db.get_bind().dialect.name == "sqlite":
+        fts = models.advertisements_fts
+        query = query.join(fts, fts.c.rowid == models.Advertisement.id).filter(
+            text("advertisements_fts MATCH :q")).params(
+                q=fts_query(q)).order_by(fts.c.rank)
+    else:
+        pattern = f"%{q}%"
+        query = query.filter(
+            models.Advertisement.state == 'active',
+            or_(models.Advertisement.title.ilike(pattern),
+                models.Advertisement.body.ilike(pattern))).order_by(
+                    models.Advertisement.created_at.desc())
+    return query.offset(skip).limit(limit).all()
+
+
+def advertisement_tag(advertisement_id: int) -> str:
+    return f"ad:{advertisement_id}"
+
+
+def user_tag(user_id: int) -> str:
+    return f"user:{user_id}"
 
 
 def get_drafts(db: Session,
                user_id: int,
                current_user: models.User,
                skip: int = 0,
-               limit: int = 100):
-    if user_id != current_user.id and current_user.role == 'client':
+               limit: int = 100,
+               after: Union[str, None] = None):
+    principal = permissions.principal_of(current_user)
+    if user_id != principal.id and principal.role == permissions.CLIENT:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="not found")
-    elif current_user.role == 'moderator':
-        query = db.query(models.Advertisement).join(models.User, models.Group,
-                                                    models.Advertisement)
-        return query.order_by(
-            models.Advertisement.id).filter_by(is_active=True)
-    return db.query(models.Advertisement).filter_by(
-        owner_id=user_id, state='draft').offset(skip).limit(limit).all()
+    query = db.query(models.Advertisement).filter_by(owner_id=user_id,
+                                                     state='draft')
+    return paginate(query, skip=skip, limit=limit, after=after).all()
+
+
+def moderation_queue_query(db: Session, current_user: models.User):
+    return db.query(models.Advertisement).filter_by(state='draft').filter(
+        permissions.managed_by(permissions.principal_of(current_user),
+                               models.Advertisement.owner_id))
+
+
+def get_moderation_queue(db: Session,
+                         current_user: models.User,
+                         limit: int = 100,
+                         after: Union[str, None] = None):
+    """Drafts awaiting moderation, oldest first, and the queue depth."""
+    query = moderation_queue_query(db, current_user)
+    drafts = paginate(query, skip=0, limit=limit, after=after,
+                      ascending=True).all()
+    principal = permissions.principal_of(current_user)
+    if principal.is_admin:
+        depth = counters.count(db, states=['draft'])
+    elif principal.is_moderator:
+        depth = counters.count_owned_by(db,
+                                        permissions.members_of(principal),
+                                        states=['draft'])
+    else:
+        depth = counters.count(db, owner_id=principal.id, states=['draft'])
+    return drafts, depth
 
 
 def get_advertisements(db: Session,
                        user_id: int,
                        skip: int = 0,
-                       limit: int = 100):
-    return db.query(models.Advertisement).filter_by(
-        owner_id=user_id, state='active').offset(skip).limit(limit).all()
+                       limit: int = 100,
+                       after: Union[str, None] = None,
+                       rows: bool = False):
+    query = db.query(models.Advertisement).filter_by(owner_id=user_id,
+                                                     state='active')
+    if rows:
+        query = query.with_entities(*serialization.ADVERTISEMENT_COLUMNS)
+    return paginate(query, skip=skip, limit=limit, after=after).all()
+
+
+def count_advertisements(db: Session, user_id: int, state: str = 'active'):
+    return counters.count(db, owner_id=user_id, states=[state])
+
+
+def get_stats(db: Session, user_id: Union[int, None] = None):
+    if user_id is not None:
+        by_state = counters.by_state(db, owner_id=user_id)
+        return {"total": sum(by_state.values()), "by_state": by_state}
+    by_state = counters.by_state(db)
+    return {"total": sum(by_state.values()),
+            "by_state": by_state,
+            "by_region": counters.by_region(db)}
 
 
 def get_advertisement(db: Session, advertisement_id: int, owner_id: int):
@@ -40,32 +296,133 @@ def get_advertisement(db: Session, advertisement_id: int, owner_id: int):
                                                     owner_id=owner_id).first()
 
 
+def advertisement_validators(advertisement) -> conditional.Validators:
+    # Every change to an ad sets updated_at, so the timestamps identify the
+    # representation.
+    return conditional.Validators.from_version(
+        "advertisement", advertisement.id, advertisement.owner_id,
+        advertisement.created_at, advertisement.updated_at,
+        last_modified=conditional.latest(advertisement.created_at,
+                                         advertisement.updated_at))
+
+
+def get_advertisement_validators(db: Session, advertisement_id: int,
+                                 owner_id: int):
+    """Validators of an ad from its version columns only."""
+    ads = models.Advertisement
+    row = db.execute(
+        select(ads.id, ads.owner_id, ads.created_at, ads.updated_at).where(
+            ads.id == advertisement_id, ads.owner_id == owner_id)).first()
+    return advertisement_validators(row) if row else None
+
+
 def get_draft(db: Session, draft_id: int, owner_id: int):
     return db.query(models.Advertisement).filter_by(id=draft_id,
                                                     owner_id=owner_id).first()
 
 
+def add_advertisement(db: Session, fields: dict, user_id: int, state: str):
+    db_ad = models.Advertisement(**fields, owner_id=user_id, state=state)
+    db.add(db_ad)
+    counters.record_transitions(db, [(user_id, None, state)])
+    return db_ad
+
+
 def create_user_advertisement(
         db: Session, advertisement: advertisement_schema.AdvertisementCreate,
         user_id: int, current_user: models.User):
-    db_ad = models.Advertisement(**advertisement.dict(),
-                                 owner_id=user_id,
-                                 state='active')
-    db.add(db_ad)
+    db_ad = add_advertisement(db, advertisement.dict(), user_id, 'active')
     db.commit()
-    db.refresh(db_ad)
+    cache.feed_cache.invalidate_tags(FEED_HEAD_TAG)
     return db_ad
 
 
+async def create_user_advertisement_async(
+        db: AsyncSession,
+        advertisement: advertisement_schema.AdvertisementCreate, user_id: int,
+        current_user: models.User):
+    db_ad = await group_commit.commit(db, add_advertisement,
+                                      advertisement.dict(), user_id, 'active')
+    cache.feed_cache.invalidate_tags(FEED_HEAD_TAG)
+    return db_ad
+
+
+def bulk_create_advertisements(db: Session, rows: list[dict], user_id: int,
+                               state: str = 'active') -> list[int]:
+    # One multi-row INSERT ... RETURNING per call and a single commit,
+    # instead of an add/commit/refresh round trip per advertisement.
+    # SQLAlchemy can only guarantee RETURNING order on SQLite by inserting
+    # row by row; SQLite hands out rowids in VALUES order within a
+    # statement, so sorting the ids restores parameter order instead.
+    sqlite = db.get_bind().dialect.name == "sqlite"
+    table = models.Advertisement.__table__
+    ids = db.scalars(
+        insert(table).returning(table.c.id,
+                                sort_by_parameter_order=not sqlite),
+        [dict(row, owner_id=user_id, state=state) for row in rows]).all()
+    if sqlite:
+        ids.sort()
+    counters.record_transitions(db, [(user_id, None, state)] * len(ids))
+    db.commit()
+    cache.feed_cache.invalidate_tags(FEED_HEAD_TAG)
+    return ids
+
+
+def change_advertisement_states(db: Session, ids: list[int], state: str,
+                                current_user: models.User):
+    """Move ads to `state` in one transaction and report what happened to
+    each id.
+
+    Ids are handled in chunks of STATE_CHANGE_BATCH_SIZE, one permission
+    SELECT and one UPDATE per chunk. Ads outside a moderator's groups are
+    reported as not_found, like the single-ad endpoints do.
+    """
+    table = models.Advertisement.__table__
+    allowed = permissions.managed_by(permissions.principal_of(current_user),
+                                     table.c.owner_id)
+    ids = list(dict.fromkeys(ids))
+    outcomes = dict.fromkeys(ids, 'not_found')
+    batch_size = settings.state_change_batch_size
+    for start in range(0, len(ids), batch_size):
+        chunk = ids[start:start + batch_size]
+        stmt = select(table.c.id, table.c.owner_id,
+                      table.c.state).where(table.c.id.in_(chunk), allowed)
+        changed = []
+        transitions = []
+        for advertisement_id, owner_id, current_state in db.execute(stmt):
+            if current_state == state:
+                outcomes[advertisement_id] = 'unchanged'
+            else:
+                outcomes[advertisement_id] = 'updated'
+                changed.append(advertisement_id)
+                transitions.append((owner_id, current_state, state))
+        if changed:
+            db.execute(update(table).where(table.c.id.in_(changed)).values(
+                state=state))
+            counters.record_transitions(db, transitions)
+    db.commit()
+    updated = [key for key, outcome in outcomes.items() if outcome == 'updated']
+    if updated:
+        cache.feed_cache.invalidate_tags(
+            *(advertisement_tag(advertisement_id) for advertisement_id in updated))
+    return [{"id": key, "outcome": outcome} for key, outcome in outcomes.items()]
+
+
 def create_user_draft(db: Session,
                       draft: advertisement_schema.AdvertisementCreate,
                       user_id: int, current_user: models.User):
-    db_draft = models.Advertisement(**draft.dict(),
-                                    owner_id=user_id,
-                                    state='draft')
-    db.add(db_draft)
+    db_draft = add_advertisement(db, draft.dict(), user_id, 'draft')
     db.commit()
-    db.refresh(db_draft)
+    cache.feed_cache.invalidate_tags(FEED_HEAD_TAG)
+    return db_draft
+
+
+async def create_user_draft_async(db: AsyncSession,
+                                  draft: advertisement_schema.AdvertisementCreate,
+                                  user_id: int, current_user: models.User):
+    db_draft = await group_commit.commit(db, add_advertisement, draft.dict(),
+                                         user_id, 'draft')
+    cache.feed_cache.invalidate_tags(FEED_HEAD_TAG)
     return db_draft
 
 
@@ -77,10 +434,11 @@ def update_draft(db: Session,
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="not found")
     db_draft.title, db_draft.body, db_draft.owner_id = draft_in.title, draft_in.body, owner_id
+    counters.record_transitions(db, [(owner_id, db_draft.state, 'draft')])
     db_draft.state = 'draft'
     db.add(db_draft)
     db.commit()
-    db.refresh(db_draft)
+    cache.feed_cache.invalidate_tags(advertisement_tag(db_draft.id))
     return db_draft
 
 
@@ -95,10 +453,12 @@ def update_advertisement(
                             detail="not found")
 
     db_advertisement.title, db_advertisement.body, db_advertisement.owner_id = advertisement_in.title, advertisement_in.body, owner_id
+    counters.record_transitions(
+        db, [(owner_id, db_advertisement.state, 'active')])
     db_advertisement.state = 'active'
     db.add(db_advertisement)
     db.commit()
-    db.refresh(db_advertisement)
+    cache.feed_cache.invalidate_tags(advertisement_tag(db_advertisement.id))
     return db_advertisement
 
 
@@ -106,22 +466,35 @@ def delete_advertisement(db: Session, advertisement_id: int, owner_id: int,
                          db_advertisement: models.Advertisement,
                          current_user: models.User):
 
-    if current_user.role == 'client' and owner_id != current_user.id:
+    if not permissions.can_manage_user(
+            db, permissions.principal_of(current_user), owner_id):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
                             detail="not found")
-    elif current_user.role == 'moderator':
-        query = db.query(models.User).join(models.User,
-                                           models.Group).filter_by(id=owner_id)
-        if current_user not in query:
-            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
-                                detail="not found")
-
-    db_advertisement = get_advertisement(db=db,
-                                         advertisement_id=advertisement_id,
-                                         owner_id=owner_id)
+
+    counters.record_transitions(
+        db, [(db_advertisement.owner_id, db_advertisement.state, 'removed')])
     db_advertisement.state = 'removed'
     db.add(db_advertisement)
     db.commit()
-    db.refresh(db_advertisement)
+    cache.feed_cache.invalidate_tags(advertisement_tag(db_advertisement.id))
 
     return db_advertisement
+
+
+all_advertisements_async = as_async(all_advertisements)
+region_advertisements_async = as_async(region_advertisements)
+feed_page_async = as_async(feed_page)
+search_advertisements_async = as_async(search_advertisements)
+get_drafts_async = as_async(get_drafts)
+get_moderation_queue_async = as_async(get_moderation_queue)
+get_advertisements_async = as_async(get_advertisements)
+count_advertisements_async = as_async(count_advertisements)
+get_stats_async = as_async(get_stats)
+get_advertisement_async = as_async(get_advertisement)
+get_advertisement_validators_async = as_async(get_advertisement_validators)
+get_draft_async = as_async(get_draft)
+bulk_create_advertisements_async = as_async(bulk_create_advertisements)
+change_advertisement_states_async = as_async(change_advertisement_states)
+update_draft_async = as_async(update_draft)
+update_advertisement_async = as_async(update_advertisement)
+delete_advertisement_async = as_async(delete_advertisement)
@@ -0,0 +1,286 @@
+"""Image attachments of advertisements.
+
+Files are content-addressed: ATTACHMENTS_DIR/<sha256[:2]>/<sha256><ext>. An
+image uploaded twice is stored once, and a stored file never changes, so it
+is served with an immutable Cache-Control and its hash as ETag.
+
+    python -m app.functions.attachments [--dry-run]
+
+deletes the files that no attachment refers to any more; run it from cron.
+"""
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+from typing import AsyncIterator, Union
+from fastapi import HTTPException, Request, Response, status
+from sqlalchemy import func, or_, select
+from sqlalchemy.orm import Session
+from app import cache, conditional, permissions, ranges
+from app.db import database, models
+from app.db.database import as_async
+from app.functions import advertisement_functions, thumbnails
+from app.settings import settings
+
+logger = logging.getLogger(__name__)
+
+IMMUTABLE = "public, max-age=31536000, immutable"
+EXTENSION_TYPES = {extension: content_type for content_type, extension
+                   in models.ATTACHMENT_EXTENSIONS.items()}
+SNIFF_BYTES = 12
+# Files younger than this are left alone by the garbage collector: their
+# row may not be committed yet.
+GC_GRACE_SECONDS = 3600
+
+
+def sniff(head: bytes) -> Union[str, None]:
+    """The image type of a file from its first bytes; the client's
+    Content-Type is not trusted."""
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if head[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "image/webp"
+    return None
+
+
+def storage_path(sha256: str, content_type: str) -> Path:
+    return Path(settings.attachments_dir, sha256[:2],
+                models.attachment_file_name(sha256, content_type))
+
+
+def path_of(file_name: str) -> Path:
+    return Path(settings.attachments_dir, file_name[:2], file_name)
+
+
+def media_type_of(file_name: str) -> str:
+    return EXTENSION_TYPES[os.path.splitext(file_name)[1]]
+
+
+def validators_of(file_name: str) -> conditional.Validators:
+    return conditional.Validators(etag=f'"{os.path.splitext(file_name)[0]}"',
+                                  cache_control=IMMUTABLE)
+
+
+async def file_response(request: Request, file_name: str) -> Response:
+    """Serve a stored file by name; raises FileNotFoundError."""
+    validators = validators_of(file_name)
+    media_type = media_type_of(file_name)
+    if settings.attachments_accel_redirect:
+        # nginx sends the file (with sendfile, ranges and conditionals).
+        location = settings.attachments_accel_redirect.rstrip("/")
+        return Response(media_type=media_type,
+                        headers={**validators.headers(),
+                                 "X-Accel-Redirect":
+                                 f"{location}/{file_name[:2]}/{file_name}"})
+    return await ranges.file_response(request, str(path_of(file_name)),
+                                      media_type, validators)
+
+
+def _store(temporary, path: Path):
+    temporary.flush()
+    os.fsync(temporary.fileno())
+    temporary.close()
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # Same name, same bytes: a concurrent upload of the same image may win.
+    os.replace(temporary.name, path)
+
+
+def _write(data: bytes, path: Path):
+    if path.exists():
+        return
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=path.parent,
+                                     delete=False) as temporary:
+        temporary.write(data)
+    os.replace(temporary.name, path)
+
+
+def _discard(temporary):
+    temporary.close()
+    try:
+        os.remove(temporary.name)
+    except FileNotFoundError:
+        pass
+
+
+def unsupported_type() -> HTTPException:
+    return HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                         detail="Attachments must be JPEG, PNG, GIF or WebP images")
+
+
+async def store_upload(chunks: AsyncIterator[bytes],
+                       max_bytes: int) -> tuple:
+    """Stream an upload to its content-addressed file, one chunk in memory
+    at a time. Returns (sha256, content_type, size)."""
+    spool_dir = Path(settings.attachments_dir, "tmp")
+    spool_dir.mkdir(parents=True, exist_ok=True)
+    temporary = tempfile.NamedTemporaryFile(dir=spool_dir, delete=False)
+    digest = hashlib.sha256()
+    head, size, content_type = b"", 0, None
+    try:
+        async for chunk in chunks:
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(
+                    status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                    detail=f"Attachments are limited to {max_bytes} bytes")
+            if content_type is None and len(head) < SNIFF_BYTES:
+                head += chunk[:SNIFF_BYTES - len(head)]
+                if len(head) == SNIFF_BYTES:
+                    content_type = sniff(head)
+                    if content_type is None:
+                        raise unsupported_type()
+            digest.update(chunk)
+            temporary.write(chunk)
+        if not size:
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                                detail="Empty attachment")
+        if content_type is None:
+            content_type = sniff(head)
+            if content_type is None:
+                raise unsupported_type()
+        sha256 = digest.hexdigest()
+        await asyncio.to_thread(_store, temporary,
+                                storage_path(sha256, content_type))
+    except BaseException:
+        _discard(temporary)
+        raise
+    return sha256, content_type, size
+
+
+def count_attachments(db: Session, advertisement_id: int) -> int:
+    return db.scalar(select(func.count()).where(
+        models.Attachment.advertisement_id == advertisement_id))
+
+
+def get_attachments(db: Session, advertisement_id: int, owner_id: int,
+                    current_user: models.User):
+    """Attachments of a published ad, or of any ad the user may manage."""
+    ads = models.Advertisement
+    visible = or_(ads.state == 'active', permissions.managed_by(
+        permissions.principal_of(current_user), ads.owner_id))
+    return db.scalars(select(models.Attachment).join(
+        models.Attachment.advertisement).where(
+            models.Attachment.advertisement_id == advertisement_id,
+            ads.owner_id == owner_id, visible).order_by(
+                models.Attachment.id)).all()
+
+
+def get_attachment(db: Session, attachment_id: int, advertisement_id: int,
+                   owner_id: int):
+    return db.scalar(select(models.Attachment).join(
+        models.Attachment.advertisement).where(
+            models.Attachment.id == attachment_id,
+            models.Attachment.advertisement_id == advertisement_id,
+            models.Advertisement.owner_id == owner_id))
+
+
+def create_attachment(db: Session, advertisement_id: int, sha256: str,
+                      content_type: str, size: int):
+    attachment = models.Attachment(advertisement_id=advertisement_id,
+                                   sha256=sha256,
+                                   content_type=content_type,
+                                   size=size)
+    db.add(attachment)
+    db.commit()
+    cache.feed_cache.invalidate_tags(
+        advertisement_functions.advertisement_tag(advertisement_id))
+    return attachment
+
+
+def delete_attachment(db: Session, attachment: models.Attachment):
+    # The file may be shared with other attachments; the collector removes
+    # it once nothing refers to it.
+    db.delete(attachment)
+    db.commit()
+    cache.feed_cache.invalidate_tags(
+        advertisement_functions.advertisement_tag(attachment.advertisement_id))
+    return attachment
+
+
+def record_thumbnail(db: Session, attachment_id: int, thumbnail_sha256: str,
+                     width: int, height: int):
+    attachment = db.get(models.Attachment, attachment_id)
+    if attachment is None:
+        return None
+    attachment.thumbnail_sha256 = thumbnail_sha256
+    attachment.width, attachment.height = width, height
+    db.commit()
+    cache.feed_cache.invalidate_tags(
+        advertisement_functions.advertisement_tag(attachment.advertisement_id))
+    return attachment
+
+
+async def generate_thumbnail(attachment_id: int, sha256: str,
+                             content_type: str):
+    """Background task run after an upload."""
+    try:
+        data, width, height = await thumbnails.make_thumbnail_async(
+            str(storage_path(sha256, content_type)), settings.thumbnail_size)
+    except Exception:
+        logger.exception("Could not make a thumbnail for attachment %s",
+                         attachment_id)
+        return
+    thumbnail_sha256 = hashlib.sha256(data).hexdigest()
+    await asyncio.to_thread(
+        _write, data,
+        storage_path(thumbnail_sha256, models.Attachment.THUMBNAIL_TYPE))
+    async with database.AsyncSessionLocal() as db:
+        await record_thumbnail_async(db, attachment_id, thumbnail_sha256,
+                                     width, height)
+
+
+def collect_garbage(db: Session, dry_run: bool = False) -> list:
+    """Delete stored files no attachment refers to, and abandoned uploads;
+    returns their paths."""
+    referenced = set()
+    for sha256, content_type, thumbnail_sha256 in db.execute(
+            select(models.Attachment.sha256, models.Attachment.content_type,
+                   models.Attachment.thumbnail_sha256)):
+        referenced.add(models.attachment_file_name(sha256, content_type))
+        if thumbnail_sha256 is not None:
+            referenced.add(models.attachment_file_name(
+                thumbnail_sha256, models.Attachment.THUMBNAIL_TYPE))
+    cutoff = time.time() - GC_GRACE_SECONDS
+    garbage = [path for path in Path(settings.attachments_dir).glob("*/*")
+               if path.name not in referenced
+               and path.stat().st_mtime < cutoff]
+    if not dry_run:
+        for path in garbage:
+            path.unlink(missing_ok=True)
+    return garbage
+
+
+count_attachments_async = as_async(count_attachments)
+get_attachments_async = as_async(get_attachments)
+get_attachment_async = as_async(get_attachment)
+create_attachment_async = as_async(create_attachment)
+delete_attachment_async = as_async(delete_attachment)
+record_thumbnail_async = as_async(record_thumbnail)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true",
+                        help="list unreferenced files without deleting them")
+    args = parser.parse_args()
+
+    from app.db.database import SessionLocal
+
+    with SessionLocal() as db:
+        garbage = collect_garbage(db, dry_run=args.dry_run)
+    for path in garbage:
+        print(path)
+    print(f"{len(garbage)} files {'unreferenced' if args.dry_run else 'deleted'}")
+
+
+if __name__ == "__main__":
+    main()
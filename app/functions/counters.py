@@ -0,0 +1,180 @@
+"""Maintained advertisement counts.
+
+    python -m app.functions.counters [--dry-run]
+
+reconciles `advertisement_counts` with `advertisements` and prints the rows
+that had drifted; run it from cron or after writing ads behind the app's
+back (bulk loads, manual SQL).
+"""
+import argparse
+import json
+from collections import Counter
+from typing import Iterable, Union
+from sqlalchemy import delete, func, insert, literal, select, union_all, update
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+from app.db import models
+
+ALL_OWNERS = models.AdvertisementCount.ALL_OWNERS
+UPSERT_INSERTS = {"sqlite": sqlite.insert, "postgresql": postgresql.insert}
+
+
+def transition_deltas(transitions: Iterable[tuple]) -> Counter:
+    """Count changes for (owner_id, old_state, new_state) transitions; the
+    old state is None for new ads."""
+    deltas = Counter()
+    for owner_id, old_state, new_state in transitions:
+        if old_state == new_state:
+            continue
+        for owner in (owner_id, ALL_OWNERS):
+            if old_state is not None:
+                deltas[owner, old_state] -= 1
+            deltas[owner, new_state] += 1
+    return deltas
+
+
+def apply_deltas(db: Session, deltas: Counter):
+    """Add `deltas` to the counters in the caller's transaction."""
+    rows = [{"owner_id": owner_id, "state": state, "count": delta}
+            for (owner_id, state), delta in sorted(deltas.items()) if delta]
+    if not rows:
+        return
+    table = models.AdvertisementCount.__table__
+    upsert = UPSERT_INSERTS.get(db.get_bind().dialect.name)
+    if upsert is not None:
+        stmt = upsert(table)
+        db.execute(stmt.on_conflict_do_update(
+            index_elements=[table.c.owner_id, table.c.state],
+            set_={"count": table.c.count + stmt.excluded["count"]}), rows)
+        return
+    for row in rows:
+        result = db.execute(update(table).where(
+            table.c.owner_id == row["owner_id"],
+            table.c.state == row["state"]).values(
+                count=table.c.count + row["count"]))
+        if not result.rowcount:
+            db.execute(insert(table), [row])
+
+
+def record_transitions(db: Session, transitions: Iterable[tuple]):
+    apply_deltas(db, transition_deltas(transitions))
+
+
+def count(db: Session, owner_id: int = ALL_OWNERS,
+          states: Union[Iterable[str], None] = None) -> int:
+    counts = models.AdvertisementCount
+    stmt = select(func.coalesce(func.sum(counts.count), 0)).where(
+        counts.owner_id == owner_id)
+    if states is not None:
+        stmt = stmt.where(counts.state.in_(states))
+    return db.scalar(stmt)
+
+
+def count_owned_by(db: Session, owners, states: Union[Iterable[str],
+                                                      None] = None) -> int:
+    """Total for the owners selected by the `owners` subquery of user ids."""
+    counts = models.AdvertisementCount
+    stmt = select(func.coalesce(func.sum(counts.count), 0)).where(
+        counts.owner_id.in_(owners))
+    if states is not None:
+        stmt = stmt.where(counts.state.in_(states))
+    return db.scalar(stmt)
+
+
+def region_owners(region: str):
+    return select(models.UserGroup.user_id).join(
+        models.Group, models.Group.id == models.UserGroup.group_id).where(
+            models.Group.region == region)
+
+
+def by_state(db: Session, owner_id: int = ALL_OWNERS) -> dict:
+    counts = models.AdvertisementCount
+    rows = db.execute(select(counts.state, counts.count).where(
+        counts.owner_id == owner_id, counts.count != 0).order_by(counts.state))
+    return dict(rows.all())
+
+
+def by_region(db: Session) -> dict:
+    counts = models.AdvertisementCount
+    # An owner in several groups of one region counts once for it.
+    members = select(models.Group.region, models.UserGroup.user_id).join(
+        models.Group, models.Group.id == models.UserGroup.group_id).where(
+            models.Group.region.is_not(None)).distinct().subquery()
+    rows = db.execute(
+        select(members.c.region, func.sum(counts.count)).join(
+            members, members.c.user_id == counts.owner_id).group_by(
+                members.c.region).order_by(members.c.region))
+    return {region: total for region, total in rows if total}
+
+
+def actual_selects(stored: bool = False):
+    """(owner_id, state, count) over `advertisements`, per owner and in
+    total, with an extra zero `stored` column when `stored` is set."""
+    ads = models.Advertisement
+    extra = [literal(0).label("stored")] if stored else []
+    per_owner = select(ads.owner_id, ads.state, func.count().label("count"),
+                       *extra).group_by(ads.owner_id, ads.state)
+    totals = select(literal(ALL_OWNERS).label("owner_id"), ads.state,
+                    func.count().label("count"), *extra).group_by(ads.state)
+    return per_owner, totals
+
+
+def drift_query():
+    # One statement, so the counters and the ads are read from the same
+    # snapshot even while writers are busy.
+    counts = models.AdvertisementCount
+    rows = union_all(
+        *actual_selects(stored=True),
+        select(counts.owner_id, counts.state, literal(0), counts.count)).subquery()
+    actual, stored = func.sum(rows.c.count), func.sum(rows.c.stored)
+    return select(rows.c.owner_id, rows.c.state, stored.label("stored"),
+                  actual.label("actual")).group_by(
+                      rows.c.owner_id, rows.c.state).having(
+                          actual != stored).order_by(rows.c.owner_id,
+                                                     rows.c.state)
+
+
+def reconcile(db: Session, dry_run: bool = False) -> list[dict]:
+    """Repair counters that drifted from `advertisements`.
+
+    Scans the whole table, so it is a job, never part of a request. Returns
+    the rows that differed; the repairs are committed unless `dry_run`.
+    """
+    drift = [dict(row) for row in db.execute(drift_query()).mappings()]
+    if drift and not dry_run:
+        # Apply the difference rather than overwrite with the value read,
+        # so transitions committed since then are kept.
+        apply_deltas(db, Counter({(row["owner_id"], row["state"]):
+                                  row["actual"] - row["stored"]
+                                  for row in drift}))
+        table = models.AdvertisementCount.__table__
+        db.execute(delete(table).where(table.c.count == 0))
+        db.commit()
+    return drift
+
+
+def rebuild(connection):
+    """Recompute every counter from scratch, e.g. after a bulk load."""
+    table = models.AdvertisementCount.__table__
+    connection.execute(delete(table))
+    connection.execute(insert(table).from_select(
+        ["owner_id", "state", "count"], union_all(*actual_selects())))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dry-run", action="store_true",
+                        help="report drift without repairing it")
+    args = parser.parse_args()
+
+    from app.db.database import SessionLocal
+
+    with SessionLocal() as db:
+        drift = reconcile(db, dry_run=args.dry_run)
+    for row in drift:
+        print(json.dumps(row))
+    print(f"{len(drift)} counters {'drifted' if args.dry_run else 'repaired'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,41 +1,91 @@
-from fastapi import HTTPException, Depends, status
+from fastapi import HTTPException, Depends, Request, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
-from app.db.database import SessionLocal
-from app.functions.user_functions import get_user_by_token
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import database, replica
+from app.functions.user_functions import get_cached_principal_async
 from app.db import models
+from app import admission, permissions
 
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth", auto_error=False)
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_async_db(request: Request):
+    replica.mark_write(request)
+    async with database.AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
+    # Again once the write is done, so the sticky window covers the time
+    # the replica needs to catch up with it.
+    replica.mark_write(request)
 
 
-def get_current_user(db: Session = Depends(get_db),
-                     token: str = Depends(oauth2_scheme)):
-    user = get_user_by_token(db=db, token=token)
-    if not user:
+async def get_async_read_db(request: Request):
+    db = None
+    if (replica.monitor is not None and not replica.is_sticky(request)
+            and await replica.monitor.available_async()):
+        db = database.AsyncReplicaSessionLocal()
+        try:
+            await db.connection()
+        except DBAPIError:
+            await db.close()
+            db = None
+            replica.monitor.mark_down()
+    if db is None:
+        db = database.AsyncSessionLocal()
+    async with db:
+        yield db
+
+
+def check_principal(principal: models.User):
+    if not principal:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
             headers={"WWW-Authenticate": "Bearer"},
         )
-    if not user.is_active:
+    if not principal.is_active:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
                             detail="Inactive user")
+
+
+async def get_current_user(db: AsyncSession = Depends(get_async_db),
+                           token: str = Depends(oauth2_scheme)):
+    principal = await get_cached_principal_async(
+        db, token=token) if token else None
+    check_principal(principal)
+    admission.check_rate_limit(principal.id)
+    return await attach_principal(db, principal)
+
+
+async def attach_principal(db: AsyncSession, principal: models.User):
+    # Attach a copy of the cached principal to this request's session
+    # without reloading it from the database.
+    user = await db.merge(principal, load=False)
+    user.principal = principal.principal
     return user
 
 
+async def get_optional_user(db: AsyncSession = Depends(get_async_db),
+                            token: str = Depends(oauth2_scheme)):
+    """The signed-in user, or None; for routes anyone may call, so an
+    unknown, expired or inactive user's token is treated as no token."""
+    principal = await get_cached_principal_async(
+        db, token=token) if token else None
+    if not principal or not principal.is_active:
+        return None
+    return await attach_principal(db, principal)
+
+
+def get_current_principal(user: models.User = Depends(get_current_user)):
+    return permissions.principal_of(user)
+
+
 class RoleChecker:
 
     def __init__(self, allowed_roles: list):
-        self.allowed_roles = allowed_roles
+        self.allowed_roles = frozenset(allowed_roles)
 
-    def __call__(self, user: models.User = Depends(get_current_user)):
-        if user.role not in self.allowed_roles:
+    def __call__(self, principal: permissions.Principal = Depends(
+            get_current_principal)):
+        if not principal.has_role(self.allowed_roles):
             raise HTTPException(status_code=403,
                                 detail="Operation not permitted")
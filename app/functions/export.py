@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+from datetime import datetime
+from typing import Union
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.db import models
+
+EXPORT_COLUMNS = ("id", "title", "body", "owner_id", "state", "created_at",
+                  "updated_at")
+EXPORT_MEDIA_TYPES = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+
+def export_statement(owner_id: Union[int, None] = None,
+                     state: Union[str, None] = None,
+                     created_from: Union[datetime, None] = None,
+                     created_to: Union[datetime, None] = None):
+    # Plain column tuples rather than ORM entities: nothing is added to the
+    # identity map, so memory stays flat however many rows are exported.
+    table = models.Advertisement.__table__
+    stmt = select(*(table.c[name] for name in EXPORT_COLUMNS))
+    if owner_id is not None:
+        stmt = stmt.where(table.c.owner_id == owner_id)
+    if state is not None:
+        stmt = stmt.where(table.c.state == state)
+    if created_from is not None:
+        stmt = stmt.where(table.c.created_at >= created_from)
+    if created_to is not None:
+        stmt = stmt.where(table.c.created_at < created_to)
+    return stmt.order_by(table.c.id)
+
+
+async def stream_partitions(db: AsyncSession, stmt, batch_size: int):
+    result = await db.stream(stmt.execution_options(yield_per=batch_size))
+    async for partition in result.partitions():
+        yield partition
+
+
+def encode_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return value
+
+
+async def iter_ndjson(partitions):
+    async for partition in partitions:
+        yield "".join(
+            json.dumps(dict(zip(EXPORT_COLUMNS, map(encode_value, row))),
+                       ensure_ascii=False) + "\n"
+            for row in partition).encode()
+
+
+async def iter_csv(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    async for partition in partitions:
+        for row in partition:
+            writer.writerow(map(encode_value, row))
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+
+def content_disposition(export_format: str) -> dict:
+    return {"Content-Disposition":
+            f'attachment; filename="advertisements.{export_format}"'}
+
+
+def export_advertisements(db: AsyncSession, export_format: str,
+                          batch_size: int, **filters):
+    partitions = stream_partitions(db, export_statement(**filters),
+                                   batch_size)
+    if export_format == "csv":
+        return iter_csv(partitions)
+    return iter_ndjson(partitions)
@@ -0,0 +1,82 @@
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from passlib.context import CryptContext
+from app.settings import settings
+
+
+def make_context(rounds: int) -> CryptContext:
+    # Hashes below the configured work factor are reported by
+    # verify_and_update so they get upgraded on the next successful login.
+    return CryptContext(schemes=["bcrypt"],
+                        deprecated="auto",
+                        bcrypt__rounds=rounds,
+                        bcrypt__min_rounds=rounds)
+
+
+pwd_context = make_context(settings.bcrypt_rounds)
+_executor = None
+
+
+def use_rounds(rounds: int):
+    """Hash with `rounds` from now on. Also run in each worker as it starts,
+    as spawned workers read their settings from the environment."""
+    global pwd_context
+    pwd_context = make_context(rounds)
+
+
+def get_executor() -> ProcessPoolExecutor:
+    # bcrypt holds the CPU for tens of milliseconds per call; running it in
+    # its own processes keeps it off the event loop and Starlette's
+    # threadpool. Workers are spawned rather than forked so they don't
+    # inherit open connections or threads.
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.hashing_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=use_rounds, initargs=(settings.bcrypt_rounds,))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def hash_password(password: str) -> str:
+    return pwd_context.hash(password)
+
+
+def verify_and_update(password: str, hashed_password: str):
+    return pwd_context.verify_and_update(password, hashed_password)
+
+
+async def hash_password_async(password: str) -> str:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), hash_password,
+                                      password)
+
+
+async def verify_and_update_async(password: str, hashed_password: str):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), verify_and_update,
+                                      password, hashed_password)
+
+
+def load_backend() -> int:
+    pwd_context.handler().get_backend()
+    return os.getpid()
+
+
+async def start_workers() -> set:
+    """Spawn the worker processes and load bcrypt in each now rather than
+    on the first logins; returns their pids."""
+    loop = asyncio.get_running_loop()
+    executor = get_executor()
+    return set(await asyncio.gather(*(
+        loop.run_in_executor(executor, load_backend)
+        for _ in range(settings.hashing_workers))))
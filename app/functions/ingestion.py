@@ -0,0 +1,178 @@
+import codecs
+import json
+import tempfile
+from typing import AsyncIterator
+from pydantic import ValidationError
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession
+from app.functions import advertisement_functions
+from app.schemas import advertisement_schema
+
+
+class PayloadError(ValueError):
+    pass
+
+
+async def iter_ndjson(chunks: AsyncIterator[bytes], max_line_bytes: int):
+    buffer = b""
+    line_no = 0
+    async for chunk in chunks:
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_no += 1
+            if len(line) > max_line_bytes:
+                raise PayloadError(f"line {line_no} exceeds {max_line_bytes} bytes")
+            if line.strip():
+                yield line_no, line
+        if len(buffer) > max_line_bytes:
+            raise PayloadError(f"line {line_no + 1} exceeds {max_line_bytes} bytes")
+    if buffer.strip():
+        yield line_no + 1, buffer
+
+
+async def iter_json_array(chunks: AsyncIterator[bytes], max_item_bytes: int):
+    # Decodes one array element at a time so a large array is never held in
+    # memory; only the element currently being received is buffered.
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder("utf-8")()
+    buffer = ""
+    started = finished = False
+    # Whether the next token has to be "," or "]" rather than an element.
+    separated = True
+    index = 0
+
+    def decode(chunk: bytes, final: bool = False) -> str:
+        try:
+            return text_decoder.decode(chunk, final)
+        except UnicodeDecodeError:
+            raise PayloadError("payload is not valid UTF-8")
+
+    async for chunk in chunks:
+        buffer += decode(chunk)
+        while not finished:
+            buffer = buffer.lstrip()
+            if not buffer:
+                break
+            if not started:
+                if buffer[0] != "[":
+                    raise PayloadError("expected a JSON array")
+                buffer, started = buffer[1:], True
+            elif buffer[0] == "]" and (index == 0 or not separated):
+                buffer, finished = buffer[1:], True
+            elif not separated:
+                if buffer[0] != ",":
+                    raise PayloadError(f"expected ',' or ']' after item {index}")
+                buffer, separated = buffer[1:], True
+            else:
+                try:
+                    item, end = decoder.raw_decode(buffer)
+                except json.JSONDecodeError:
+                    if len(buffer) > max_item_bytes:
+                        raise PayloadError(
+                            f"item {index + 1} exceeds {max_item_bytes} bytes")
+                    break
+                index += 1
+                buffer, separated = buffer[end:], False
+                yield index, item
+        if finished and buffer.strip():
+            raise PayloadError("unexpected data after the JSON array")
+    buffer += decode(b"", final=True)
+    if not finished:
+        try:
+            # Whatever is left could not be decoded even with all of it in.
+            if buffer.strip() and separated:
+                decoder.raw_decode(buffer.lstrip())
+        except json.JSONDecodeError as e:
+            raise PayloadError(f"item {index + 1} is not valid JSON: {e.msg}")
+        raise PayloadError("unterminated JSON array")
+    if buffer.strip():
+        raise PayloadError("unexpected data after the JSON array")
+
+
+def parse_advertisement(raw):
+    if isinstance(raw, bytes):
+        return advertisement_schema.AdvertisementCreate.parse_raw(raw)
+    return advertisement_schema.AdvertisementCreate.parse_obj(raw)
+
+
+async def ingest_advertisements(db: AsyncSession,
+                                user_id: int,
+                                chunks: AsyncIterator[bytes],
+                                json_array: bool,
+                                batch_size: int,
+                                max_item_bytes: int):
+    """Validate and insert a streamed payload, yielding one NDJSON result
+    per input line, in input order, once its batch is committed.
+
+    A payload that cannot be read any further (malformed or truncated JSON,
+    an oversized line) ends the results with one line without "line". The
+    lines reported before it were processed; their batches are committed.
+    """
+    if json_array:
+        items = iter_json_array(chunks, max_item_bytes)
+    else:
+        items = iter_ndjson(chunks, max_item_bytes)
+
+    # (line number, row to insert or None, validation errors or None)
+    batch = []
+    payload_error = None
+    try:
+        async for line_no, raw in items:
+            try:
+                batch.append((line_no, parse_advertisement(raw).dict(), None))
+            except ValidationError as e:
+                batch.append((line_no, None, e.errors()))
+            if len(batch) >= batch_size:
+                async for line in insert_batch(db, user_id, batch):
+                    yield line
+                batch = []
+    except PayloadError as e:
+        payload_error = e
+    async for line in insert_batch(db, user_id, batch):
+        yield line
+    if payload_error is not None:
+        yield result_line(errors=[{"msg": str(payload_error)}])
+
+
+async def insert_batch(db: AsyncSession, user_id: int, batch: list):
+    rows = [row for _, row, _ in batch if row is not None]
+    ids, insert_errors = iter(()), None
+    if rows:
+        try:
+            ids = iter(await advertisement_functions.bulk_create_advertisements_async(
+                db, rows=rows, user_id=user_id))
+        except SQLAlchemyError as e:
+            await db.rollback()
+            insert_errors = [{"msg": str(getattr(e, "orig", None) or e)}]
+    for line_no, row, errors in batch:
+        if row is None:
+            yield result_line(line=line_no, errors=errors)
+        elif insert_errors is not None:
+            yield result_line(line=line_no, errors=insert_errors)
+        else:
+            yield result_line(line=line_no, id=next(ids))
+
+
+def result_line(**result) -> bytes:
+    return json.dumps(result, default=str).encode() + b"\n"
+
+
+async def spool_results(results, max_memory_bytes: int = 1024 * 1024):
+    # Starlette's StreamingResponse listens for disconnects on the same
+    # receive channel the request body arrives on, so the body has to be
+    # fully consumed before the response starts. Results are spooled
+    # (to disk past max_memory_bytes) instead of being kept in a list.
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory_bytes)
+    async for line in results:
+        spool.write(line)
+    spool.seek(0)
+    return spool
+
+
+def iter_spool(spool, chunk_size: int = 64 * 1024):
+    try:
+        while chunk := spool.read(chunk_size):
+            yield chunk
+    finally:
+        spool.close()
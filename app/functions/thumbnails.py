@@ -0,0 +1,46 @@
+import asyncio
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from app.settings import settings
+
+_executor = None
+
+
+def get_executor() -> ProcessPoolExecutor:
+    # Decoding and resizing an image holds the CPU for far longer than a
+    # request may; like password hashing it runs in spawned processes, which
+    # import only this module.
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(
+            max_workers=settings.thumbnail_workers,
+            mp_context=multiprocessing.get_context("spawn"))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def make_thumbnail(source: str, size: int) -> tuple:
+    """A JPEG of the image at `source` fitting in `size` x `size`, with the
+    source's width and height."""
+    with Image.open(source) as image:
+        width, height = image.size
+        image.thumbnail((size, size))
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        buffer = io.BytesIO()
+        image.save(buffer, "JPEG", quality=85)
+    return buffer.getvalue(), width, height
+
+
+async def make_thumbnail_async(source: str, size: int) -> tuple:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), make_thumbnail, source,
+                                      size)
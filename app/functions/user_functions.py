@@ -1,11 +1,17 @@
 from datetime import datetime, timedelta
-from fastapi import HTTPException, status
-from sqlalchemy.orm import Session
-from passlib.context import CryptContext
+from typing import Union
+from fastapi import HTTPException
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, selectinload
 from app.schemas import user_schema
 from app.db import models
-
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+from app.db import group_commit
+from app.db.database import as_async
+from app.functions import serialization
+from app.functions.advertisement_functions import user_tag
+from app.functions.hashing import pwd_context
+from app import cache, conditional, permissions
 
 
 def verify_password(plain_password, hashed_password):
@@ -17,75 +23,140 @@ def get_password_hash(password):
 
 
 def get_user(db: Session, user_id: int):
-    return db.query(models.User).filter_by(id=user_id).first()
+    return db.query(models.User).options(selectinload(
+        models.User.groups)).filter_by(id=user_id).first()
+
+
+def user_validators(user, groups) -> conditional.Validators:
+    """`groups` are the user's (id, region) pairs, which are part of the
+    representation but do not touch users.updated_at."""
+    return conditional.Validators.from_version(
+        "user", user.id, user.created_at, user.updated_at, tuple(groups),
+        last_modified=conditional.latest(user.created_at, user.updated_at))
+
+
+def get_user_validators(db: Session, user_id: int):
+    """Validators of a user from its version columns only."""
+    rows = db.execute(
+        select(models.User.id, models.User.created_at, models.User.updated_at,
+               models.Group.id.label("group_id"), models.Group.region).
+        outerjoin(models.UserGroup,
+                  models.UserGroup.user_id == models.User.id).
+        outerjoin(models.Group, models.Group.id == models.UserGroup.group_id).
+        where(models.User.id == user_id).order_by(models.Group.id)).all()
+    if not rows:
+        return None
+    return user_validators(rows[0], ((row.group_id, row.region)
+                                     for row in rows
+                                     if row.group_id is not None))
+
+
+def get_groups(db: Session, group_ids: list[int]):
+    return db.query(models.Group).filter(
+        models.Group.id.in_(group_ids)).order_by(models.Group.id).all()
 
 
 def get_user_by_email(db: Session, email: str):
     return db.query(models.User).filter(models.User.email == email).first()
 
 
+def users_query(db: Session,
+                current_user: models.User,
+                skip: int = 0,
+                limit: int = 100):
+    principal = permissions.principal_of(current_user)
+    query = db.query(models.User)
+    if principal.is_moderator:
+        query = query.filter(models.User.id.in_(permissions.members_of(principal)))
+    elif not principal.is_admin:
+        return query.filter_by(id=principal.id).limit(1)
+    return query.order_by(models.User.id).filter_by(
+        is_active=True).offset(skip).limit(limit)
+
+
 def get_users(db: Session,
               current_user: models.User,
               skip: int = 0,
               limit: int = 100):
-    if current_user.role == 'moderator':
-        query = db.query(models.User).join(models.User, models.Group)
-        return query.order_by(models.User.id).filter_by(
-            is_active=True).offset(skip).limit(limit).all()
-    elif current_user.role == 'admin':
-        return db.query(models.User).order_by(models.User.id).filter_by(
-            is_active=True).offset(skip).limit(limit).all()
-    else:
-        return [db.query(models.User).filter_by(id=current_user.id).first()]
-
-
-def create_user(db: Session, user: user_schema.UserCreate):
-    hashed_password = get_password_hash(user.password)
+    return users_query(db, current_user, skip=skip, limit=limit).options(
+        selectinload(models.User.groups)).all()
+
+
+def get_user_rows(db: Session,
+                  current_user: models.User,
+                  skip: int = 0,
+                  limit: int = 100):
+    """Users as column tuples plus their (region, id) groups, keyed by user
+    id, for the fast serialization path."""
+    rows = users_query(db, current_user, skip=skip,
+                       limit=limit).with_entities(
+                           *serialization.USER_COLUMNS).all()
+    groups = {}
+    if rows:
+        memberships = db.execute(
+            select(models.UserGroup.user_id, models.Group.region,
+                   models.Group.id).join(
+                       models.Group,
+                       models.Group.id == models.UserGroup.group_id).where(
+                           models.UserGroup.user_id.in_(
+                               [row.id for row in rows])).order_by(
+                                   models.UserGroup.user_id, models.Group.id))
+        for user_id, region, group_id in memberships:
+            groups.setdefault(user_id, []).append((region, group_id))
+    return rows, groups
+
+
+def create_user(db: Session, user: user_schema.UserCreate,
+                hashed_password: Union[str, None] = None):
+    hashed_password = hashed_password or get_password_hash(user.password)
     db_user = models.User(
         email=user.email,
         hashed_password=hashed_password,
         role=user.role,
     )
     if user.groups:
-        for group_id in user.groups:
-            db_group = db.query(models.Group).filter_by(id=group_id).first()
-            db_user.groups.append(db_group)
+        db_user.groups = get_groups(db, user.groups)
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
-
     return db_user
 
 
-def register(db: Session, user: user_schema.UserRegister):
-    hashed_password = get_password_hash(user.password)
+def register(db: Session, user: user_schema.UserRegister,
+             hashed_password: Union[str, None] = None):
+    hashed_password = hashed_password or get_password_hash(user.password)
     db_user = models.User(
         email=user.email,
         hashed_password=hashed_password,
         role='client',
     )
-    for group_id in user.groups:
-        db_group = db.query(models.Group).filter_by(id=group_id).first()
-        if not db_group:
-            raise HTTPException(status_code=200, detail="Group must be from the list")
-        db_user.groups.append(db_group)
+    db_user.groups = get_groups(db, user.groups)
+    if len(db_user.groups) != len(set(user.groups)):
+        raise HTTPException(status_code=200, detail="Group must be from the list")
     db.add(db_user)
     db.commit()
-    db.refresh(db_user)
-
     return db_user
 
 
-def update_user(db: Session, user_id: int, user_in: user_schema.UserUpdate):
+def update_user(db: Session, user_id: int, user_in: user_schema.UserUpdate,
+                hashed_password: Union[str, None] = None):
     user = get_user(db=db, user_id=user_id)
-    hashed_password = get_password_hash(user_in.password)
+    hashed_password = hashed_password or get_password_hash(user_in.password)
     user.email = user_in.email
     user.hashed_password = hashed_password
     user.role = user_in.role
     user.is_active = user_in.is_active
     db.add(user)
     db.commit()
-    db.refresh(user)
+    cache.feed_cache.invalidate_tags(user_tag(user.id))
+    cache.principal_cache.invalidate_tags(principal_tag(user.id))
+    return user
+
+
+def update_password_hash(db: Session, user: models.User,
+                         hashed_password: str):
+    user.hashed_password = hashed_password
+    db.add(user)
+    db.commit()
     return user
 
 
@@ -93,35 +164,85 @@ def delete_user(db: Session, user: models.User):
     user.is_active = False
     db.add(user)
     db.commit()
-    db.refresh(user)
+    cache.principal_cache.invalidate_tags(principal_tag(user.id))
     return user
 
 
 def get_user_by_token(db: Session, token: str):
-    query = db.query(models.User).join(models.Token).filter(
+    query = db.query(models.User).options(selectinload(
+        models.User.groups)).join(models.Token).filter(
         models.Token.token == token,
         models.Token.expires > datetime.now()).first()
     return query
 
 
-def create_user_token(db: Session, user_id: int):
+def get_principal_by_token(db: Session, token: str):
+    return db.query(models.User, models.Token.expires).options(
+        selectinload(models.User.groups)).join(models.Token).filter(
+            models.Token.token == token,
+            models.Token.expires > datetime.now()).first()
+
+
+def principal_tag(user_id: int) -> str:
+    return f"principal:{user_id}"
+
+
+def get_cached_principal(db: Session, token: str):
+    # Cached users are loaded in a private session that is closed right
+    # away, so they stay detached with their columns and groups loaded and
+    # never get expired by a commit in some request's session.
+    principal = cache.principal_cache.get(token)
+    if principal is not None:
+        return principal
+    with Session(bind=db.get_bind()) as session:
+        row = get_principal_by_token(session, token=token)
+    if row is None:
+        return None
+    principal, expires = row
+    # Role and group ids are resolved once per cache fill, not per check.
+    principal.principal = permissions.Principal.from_user(principal)
+    ttl = min(cache.principal_cache.ttl,
+              (expires - datetime.now()).total_seconds())
+    if ttl > 0:
+        cache.principal_cache.set(token, principal,
+                                  tags=[principal_tag(principal.id)],
+                                  ttl=ttl)
+    return principal
+
+
+def add_token(db: Session, user_id: int):
     token = models.Token(expires=datetime.now() + timedelta(hours=1),
                          user_id=user_id)
     db.add(token)
+    return token
+
+
+def create_user_token(db: Session, user_id: int):
+    token = add_token(db, user_id)
     db.commit()
-    db.refresh(token)
-    token_dict = {"token": token.token, "expires": token.expires}
-    return token_dict
+    return {"token": token.token, "expires": token.expires}
+
+
+async def create_user_token_async(db: AsyncSession, user_id: int):
+    token = await group_commit.commit(db, add_token, user_id)
+    return {"token": token.token, "expires": token.expires}
 
 
 def check_moderator_access(db: Session, current_user: models.User,
                            user_id: int):
-    if current_user.role == 'moderator':
-        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN,
-                            detail="Operation not permitted")
-    user = get_user(db=db, user_id=user_id)
-    is_user_moderator = False
-    for group in current_user.groups:
-        if group in user.groups:
-            is_user_moderator = True
-    return is_user_moderator
+    return permissions.can_manage_user(
+        db, permissions.principal_of(current_user), user_id)
+
+
+get_user_async = as_async(get_user)
+get_user_validators_async = as_async(get_user_validators)
+get_user_by_email_async = as_async(get_user_by_email)
+get_users_async = as_async(get_users)
+get_user_rows_async = as_async(get_user_rows)
+create_user_async = as_async(create_user)
+register_async = as_async(register)
+update_user_async = as_async(update_user)
+update_password_hash_async = as_async(update_password_hash)
+delete_user_async = as_async(delete_user)
+get_cached_principal_async = as_async(get_cached_principal)
+check_moderator_access_async = as_async(check_moderator_access)
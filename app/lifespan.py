@@ -0,0 +1,154 @@
+import asyncio
+import contextlib
+import logging
+import time
+from dataclasses import dataclass
+from typing import Union
+from fastapi import FastAPI
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+from app import admission, cache
+from app.db import database, group_commit, replica
+from app.db.database import Database
+from app.functions import advertisement_functions, counters, hashing, thumbnails, user_functions
+from app.settings import Settings, settings, use_settings
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Resources:
+    """What an app builds from its settings.
+
+    create_app builds them and the app's lifespan puts them where the rest
+    of the code looks them up (the shared settings, database.current(), the
+    caches, replica.monitor, group_commit.committer and
+    admission.user_buckets), then puts back the ones it found.
+    """
+    settings: Settings
+    database: Database
+    feed_cache: cache.CacheBackend
+    principal_cache: cache.CacheBackend
+    sticky_cache: cache.CacheBackend
+    replica_monitor: Union[replica.ReplicaMonitor, None] = None
+    committer: Union[group_commit.GroupCommitter, None] = None
+    user_buckets: Union[admission.TokenBuckets, None] = None
+
+    @classmethod
+    def build(cls, settings: Settings) -> "Resources":
+        settings = settings.copy()
+        db = Database(settings)
+        resources = cls(
+            settings=settings,
+            database=db,
+            feed_cache=cache.LRUCache(maxsize=settings.feed_cache_size,
+                                      ttl=settings.feed_cache_ttl),
+            principal_cache=cache.LRUCache(
+                maxsize=settings.principal_cache_size,
+                ttl=settings.principal_cache_ttl),
+            sticky_cache=cache.LRUCache(
+                maxsize=settings.principal_cache_size,
+                ttl=settings.replica_sticky_seconds))
+        if db.async_replica_engine is not None:
+            resources.replica_monitor = replica.ReplicaMonitor(
+                db.async_engine, db.async_replica_engine,
+                max_lag=settings.replica_max_lag_seconds,
+                check_interval=settings.replica_check_interval)
+        if settings.group_commit:
+            resources.committer = group_commit.GroupCommitter(
+                db.AsyncSessionLocal,
+                window=settings.group_commit_window_ms / 1000,
+                max_batch=settings.group_commit_max_batch)
+        if settings.rate_limit_per_second:
+            resources.user_buckets = admission.TokenBuckets(
+                settings.rate_limit_per_second, settings.rate_limit_burst)
+        return resources
+
+    @classmethod
+    def in_place(cls) -> "Resources":
+        return cls(settings=settings.copy(),
+                   database=database.current(),
+                   feed_cache=cache.feed_cache,
+                   principal_cache=cache.principal_cache,
+                   sticky_cache=cache.sticky_cache,
+                   replica_monitor=replica.monitor,
+                   committer=group_commit.committer,
+                   user_buckets=admission.user_buckets)
+
+    def install(self):
+        use_settings(self.settings)
+        hashing.use_rounds(self.settings.bcrypt_rounds)
+        database.use_database(self.database)
+        cache.set_feed_cache(self.feed_cache)
+        cache.set_principal_cache(self.principal_cache)
+        cache.set_sticky_cache(self.sticky_cache)
+        replica.set_monitor(self.replica_monitor)
+        group_commit.set_committer(self.committer)
+        admission.set_user_buckets(self.user_buckets)
+
+
+async def open_pool(engine, connections: int):
+    """Check out `connections` connections at once and return them, so they
+    stay in the pool already connected (and, on SQLite, with the PRAGMAs
+    applied)."""
+    size = getattr(engine.pool, "size", lambda: 1)()
+    async with contextlib.AsyncExitStack() as stack:
+        for _ in range(min(connections, size)):
+            connection = await stack.enter_async_context(engine.connect())
+            await connection.execute(text("SELECT 1"))
+
+
+def run_hot_queries(db: Session):
+    """Compile the statements nearly every request runs into the engine's
+    statement cache, and put the first feed page in the feed cache."""
+    user_functions.get_principal_by_token(db, token="")
+    advertisement_functions.feed_page(db)
+    counters.count(db)
+
+
+async def warm_up(db: Database):
+    start = time.perf_counter()
+    steps = [("pool", open_pool(db.async_engine, settings.db_pool_size))]
+    if db.async_replica_engine is not None:
+        steps.append(("replica pool", open_pool(db.async_replica_engine,
+                                                settings.db_pool_size)))
+    steps.append(("hashing workers", hashing.start_workers()))
+    for name, step in steps:
+        # A cold start is slower, not broken: e.g. an unmigrated database
+        # must not keep the app from starting.
+        try:
+            await step
+        except Exception:
+            logger.warning("Warm-up step %r failed", name, exc_info=True)
+    try:
+        async with db.AsyncSessionLocal() as session:
+            await session.run_sync(run_hot_queries)
+    except Exception:
+        logger.warning("Warm-up step 'hot queries' failed", exc_info=True)
+    logger.info("Warmed up in %.1f ms", (time.perf_counter() - start) * 1000)
+
+
+async def shut_down(resources: Resources):
+    if resources.committer is not None:
+        await resources.committer.drain()
+    # Both wait for running jobs, so they run off the event loop. The pools
+    # were started with this app's settings, so they go with it.
+    await asyncio.to_thread(hashing.shutdown_executor)
+    await asyncio.to_thread(thumbnails.shutdown_executor)
+    await resources.database.dispose()
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app: FastAPI):
+    resources = app.state.resources
+    previous = Resources.in_place()
+    resources.install()
+    try:
+        if resources.settings.startup_warmup:
+            await warm_up(resources.database)
+        yield
+    finally:
+        try:
+            await shut_down(resources)
+        finally:
+            previous.install()
@@ -0,0 +1,212 @@
+import bisect
+import threading
+import time
+from collections import defaultdict
+from app import cache
+from app.db.query_counter import track_request_queries
+from app.settings import settings
+
+# Request latency buckets in seconds, and statement-count buckets per request.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+# Label for requests that did not match any route, so bad paths cannot blow
+# up the number of series.
+UNMATCHED_ROUTE = "<unmatched>"
+# Caches reported on /metrics, by their name in app.cache (<name>_cache).
+# They are looked up at render time because set_*_cache may replace them.
+CACHES = ("feed", "principal")
+
+
+def format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    pairs = ",".join('{}="{}"'.format(
+        name,
+        str(value).replace("\\", "\\\\").replace('"', '\\"').replace(
+            "\n", "\\n")) for name, value in labels)
+    return "{" + pairs + "}"
+
+
+class Counter:
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self._values = defaultdict(float)
+
+    def inc(self, labels: tuple, amount: float = 1):
+        self._values[labels] += amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{format_labels(labels)} {value!r}"
+
+
+class Gauge(Counter):
+
+    def set(self, labels: tuple, value: float):
+        self._values[labels] = value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} gauge"
+        for labels, value in sorted(self._values.items()):
+            yield f"{self.name}{format_labels(labels)} {value!r}"
+
+
+class Histogram:
+
+    def __init__(self, name: str, documentation: str, buckets: tuple):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = buckets
+        # labels -> [count per bucket..., +Inf count, sum]
+        self._values = {}
+
+    def observe(self, labels: tuple, value: float):
+        values = self._values.get(labels)
+        if values is None:
+            values = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def render(self):
+        yield f"# HELP {self.name} {self.documentation}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, values in sorted(self._values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                yield (f"{self.name}_bucket"
+                       f"{format_labels(labels + (('le', bound),))} {cumulative}")
+            yield f"{self.name}_count{format_labels(labels)} {cumulative}"
+            yield f"{self.name}_sum{format_labels(labels)} {values[-1]!r}"
+
+
+class Registry:
+    """Request metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter("http_requests_total",
+                                "HTTP requests by route and status.")
+        self.latency = Histogram("http_request_duration_seconds",
+                                 "HTTP request latency by route.",
+                                 LATENCY_BUCKETS)
+        self.statements = Histogram("http_request_sql_statements",
+                                    "SQL statements issued per request.",
+                                    STATEMENT_BUCKETS)
+        self.db_time = Counter("http_request_db_seconds_total",
+                               "Time spent executing SQL by route.")
+        self.admitted = Gauge("admission_active_requests",
+                              "Requests running, by route class.")
+        self.queued = Gauge("admission_queued_requests",
+                            "Requests waiting for a slot, by route class.")
+        self.shed = Counter("admission_shed_total",
+                            "Requests turned away, by route class and reason.")
+
+    def record(self, method: str, route: str, status: int, seconds: float,
+               statements: int, db_seconds: float):
+        labels = (("method", method), ("route", route))
+        with self._lock:
+            self.requests.inc(labels + (("status", status),))
+            self.latency.observe(labels, seconds)
+            self.statements.observe(labels, statements)
+            self.db_time.inc(labels, db_seconds)
+
+    def record_admission(self, route_class: str, active: int, queued: int):
+        labels = (("class", route_class),)
+        with self._lock:
+            self.admitted.set(labels, active)
+            self.queued.set(labels, queued)
+
+    def record_shed(self, route_class: str, reason: str):
+        with self._lock:
+            self.shed.inc((("class", route_class), ("reason", reason)))
+
+    def render(self) -> str:
+        with self._lock:
+            lines = [line for metric in (self.requests, self.latency,
+                                         self.statements, self.db_time,
+                                         self.admitted, self.queued,
+                                         self.shed)
+                     for line in metric.render()]
+        lines.extend(line for metric in cache_metrics(
+            {name: getattr(cache, f"{name}_cache") for name in CACHES})
+            for line in metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def cache_metrics(caches: dict):
+    """The counters of each cache backend's stats(), as metrics."""
+    size = Gauge("cache_entries", "Entries held, by cache.")
+    counters = {stat: Counter(f"cache_{stat}_total", documentation)
+                for stat, documentation in (
+                    ("hits", "Lookups that found a live entry, by cache."),
+                    ("misses", "Lookups that found no live entry, by cache."),
+                    ("evictions", "Entries dropped to stay under the size "
+                                  "limit, by cache."),
+                    ("invalidations", "Entries dropped by a write to one of "
+                                      "their tags, by cache."))}
+    for name, backend in caches.items():
+        labels = (("cache", name),)
+        stats = backend.stats()
+        size.set(labels, stats["size"])
+        for stat, counter in counters.items():
+            counter.inc(labels, stats[stat])
+    return [size, *counters.values()]
+
+
+registry = Registry()
+
+
+def server_timing(counter, seconds: float) -> bytes:
+    return (f'db;dur={counter.duration * 1000:.2f};desc="sql={counter.count}", '
+            f'app;dur={seconds * 1000:.2f}').encode()
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts its SQL statements.
+
+    A plain ASGI middleware rather than an @app.middleware("http") one, so
+    it adds no extra task or response wrapping per request. The totals go to
+    `registry` under the matched route template; the Server-Timing header
+    carries what is known when the response starts.
+    """
+
+    def __init__(self, app, registry: Registry = registry):
+        self.app = app
+        self.registry = registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                if settings.server_timing:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing",
+                         server_timing(counter, time.perf_counter() - start))]
+            await send(message)
+
+        with track_request_queries() as counter:
+            try:
+                await self.app(scope, receive, send_with_timing)
+            finally:
+                route = scope.get("route")
+                self.registry.record(
+                    method=scope["method"],
+                    route=getattr(route, "path", UNMATCHED_ROUTE),
+                    status=status,
+                    seconds=time.perf_counter() - start,
+                    statements=counter.count,
+                    db_seconds=counter.duration)
@@ -0,0 +1,79 @@
+from dataclasses import dataclass
+from sqlalchemy import exists, select, true
+from sqlalchemy.orm import Session
+from app.db import models
+
+ADMIN = 'admin'
+MODERATOR = 'moderator'
+CLIENT = 'client'
+
+
+@dataclass(frozen=True)
+class Principal:
+    """What authorization needs to know about the current user.
+
+    Built once when the user is loaded into the principal cache, so checks
+    are set operations on `group_ids` instead of walking relationships.
+    """
+    id: int
+    role: str
+    group_ids: frozenset = frozenset()
+
+    @classmethod
+    def from_user(cls, user) -> "Principal":
+        return cls(id=user.id,
+                   role=user.role,
+                   group_ids=frozenset(group.id for group in user.groups))
+
+    @property
+    def is_admin(self) -> bool:
+        return self.role == ADMIN
+
+    @property
+    def is_moderator(self) -> bool:
+        return self.role == MODERATOR
+
+    def has_role(self, roles) -> bool:
+        return self.role in roles
+
+    def shares_group(self, group_ids) -> bool:
+        return not self.group_ids.isdisjoint(group_ids)
+
+
+def principal_of(user) -> Principal:
+    # get_current_user attaches the cached Principal; anything else (users
+    # loaded by hand, scripts) gets one built on the spot.
+    principal = getattr(user, "principal", None)
+    if principal is None:
+        principal = Principal.from_user(user)
+    return principal
+
+
+def members_of(principal: Principal):
+    """Ids of the users in the principal's groups, as a subquery for IN
+    (answered from ix_user_groups_group_id_user_id)."""
+    return select(models.UserGroup.user_id).where(
+        models.UserGroup.group_id.in_(principal.group_ids))
+
+
+def managed_by(principal: Principal, user_id_column):
+    """Filter for rows whose user (e.g. an ad's owner) the principal may act
+    on: anyone for admins, members of their groups for moderators, and only
+    themselves otherwise."""
+    if principal.is_admin:
+        return true()
+    if principal.is_moderator:
+        return user_id_column.in_(members_of(principal))
+    return user_id_column == principal.id
+
+
+def can_manage_user(db: Session, principal: Principal, user_id: int) -> bool:
+    if principal.id == user_id or principal.is_admin:
+        return True
+    if not principal.is_moderator or not principal.group_ids:
+        return False
+    return db.query(
+        exists().where(
+            models.UserGroup.user_id == user_id,
+            models.UserGroup.group_id.in_(principal.group_ids))).scalar()
+
@@ -0,0 +1,121 @@
+import os
+from typing import Union
+import anyio
+from fastapi import Request, Response
+from starlette.types import Receive, Scope, Send
+from app import conditional
+
+CHUNK_SIZE = 64 * 1024
+
+
+class RangeNotSatisfiable(Exception):
+    pass
+
+
+def parse_range(header: str, size: int) -> Union[tuple, None]:
+    """The (start, end) bytes, inclusive, asked for by a single-range
+    `Range` header, or None when the whole file should be sent: for other
+    units and for several ranges, which servers may answer with 200."""
+    unit, _, spec = header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, dash, last = spec.strip().partition("-")
+    try:
+        if not dash:
+            return None
+        if not first:
+            # A suffix: the last `last` bytes.
+            length = int(last)
+            if length <= 0 or size == 0:
+                raise RangeNotSatisfiable(header)
+            return max(size - length, 0), size - 1
+        start = int(first)
+        end = int(last) if last else size - 1
+    except ValueError:
+        return None
+    if last and start > end:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable(header)
+    return start, min(end, size - 1)
+
+
+class FileRangeResponse(Response):
+    """Sends `count` bytes of the file at `path` from `offset`.
+
+    Uses the ASGI zero-copy extensions (sendfile on the server side) when
+    the server offers them, and reads the file in chunks off the event loop
+    otherwise.
+    """
+
+    def __init__(self, path: str, offset: int, count: int, size: int,
+                 status_code: int = 200, headers: Union[dict, None] = None,
+                 media_type: Union[str, None] = None):
+        super().__init__(status_code=status_code, headers=headers,
+                         media_type=media_type)
+        self.path = path
+        self.offset = offset
+        self.count = count
+        self.size = size
+        self.headers["content-length"] = str(count)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        await send({"type": "http.response.start",
+                    "status": self.status_code,
+                    "headers": self.raw_headers})
+        if scope["method"] == "HEAD" or not self.count:
+            await send({"type": "http.response.body", "body": b""})
+            return
+        extensions = scope.get("extensions") or {}
+        if "http.response.pathsend" in extensions and self.count == self.size:
+            await send({"type": "http.response.pathsend", "path": self.path})
+            return
+        if "http.response.zerocopy" in extensions:
+            with open(self.path, "rb") as file:
+                await send({"type": "http.response.zerocopy", "file": file,
+                            "offset": self.offset, "count": self.count})
+            return
+        async with await anyio.open_file(self.path, "rb") as file:
+            await file.seek(self.offset)
+            remaining = self.count
+            while remaining:
+                chunk = await file.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                await send({"type": "http.response.body", "body": chunk,
+                            "more_body": bool(remaining)})
+            if remaining:
+                await send({"type": "http.response.body", "body": b""})
+
+
+async def file_response(request: Request, path: str, media_type: str,
+                        validators: conditional.Validators) -> Response:
+    """Answer a GET or HEAD for a file: 304 when the client's copy is
+    current, 206 for a satisfiable single `Range`, 416 for one that is
+    not, and the whole file otherwise. Raises FileNotFoundError."""
+    if validators.matches(request):
+        return validators.not_modified()
+    stat = await anyio.to_thread.run_sync(os.stat, path)
+    headers = {**validators.headers(), "Accept-Ranges": "bytes",
+               "X-Content-Type-Options": "nosniff"}
+    size = stat.st_size
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    # A range is only valid against the representation the client has.
+    if range_header is not None and (if_range is None
+                                     or if_range.strip() == validators.etag):
+        try:
+            byte_range = parse_range(range_header, size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416,
+                            headers={**headers,
+                                     "Content-Range": f"bytes */{size}"})
+        if byte_range is not None:
+            start, end = byte_range
+            headers["Content-Range"] = f"bytes {start}-{end}/{size}"
+            return FileRangeResponse(path, start, end - start + 1, size,
+                                     status_code=206, headers=headers,
+                                     media_type=media_type)
+    return FileRangeResponse(path, 0, size, size, headers=headers,
+                             media_type=media_type)
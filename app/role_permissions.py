@@ -1,14 +1,19 @@
 from app.functions.dependencies import RoleChecker
+from app.permissions import ADMIN, CLIENT, MODERATOR
 
-allow_create_users = RoleChecker(['admin'])
-allow_update_users = RoleChecker(['admin', 'moderator'])
-allow_delete_users = RoleChecker(["admin"])
-allow_view_users_list = RoleChecker(['admin', 'moderator', 'client'])
+allow_create_users = RoleChecker([ADMIN])
+allow_update_users = RoleChecker([ADMIN, MODERATOR])
+allow_delete_users = RoleChecker([ADMIN])
+allow_view_users_list = RoleChecker([ADMIN, MODERATOR, CLIENT])
 
-allow_create_drafts = RoleChecker(['client'])
-allow_update_drafts = RoleChecker(['client'])
-allow_delete_drafts = RoleChecker(["client", 'admin', 'moderator'])
+allow_create_drafts = RoleChecker([CLIENT])
+allow_update_drafts = RoleChecker([CLIENT])
+allow_delete_drafts = RoleChecker([CLIENT, ADMIN, MODERATOR])
 
-allow_create_advertisements = RoleChecker(['client'])
-allow_update_advertisements = RoleChecker(['client'])
-allow_delete_advertisements = RoleChecker(["client", 'admin', 'moderator'])
+allow_create_advertisements = RoleChecker([CLIENT])
+allow_update_advertisements = RoleChecker([CLIENT])
+allow_delete_advertisements = RoleChecker([CLIENT, ADMIN, MODERATOR])
+allow_export_advertisements = RoleChecker([ADMIN])
+allow_moderate_drafts = RoleChecker([ADMIN, MODERATOR])
+allow_change_advertisement_states = RoleChecker([ADMIN, MODERATOR])
+allow_view_stats = RoleChecker([ADMIN, MODERATOR])
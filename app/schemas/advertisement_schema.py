@@ -1,6 +1,6 @@
-from typing import Union
+from typing import Literal, Union
 from datetime import datetime
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist, validator
 from .user_schema import UserToFeed
 
 
@@ -28,12 +28,51 @@ class Advertisement(AdvertisementBase):
         orm_mode = True
 
 
+class Attachment(BaseModel):
+    id: int
+    content_type: str
+    size: int
+    width: Union[int, None] = None
+    height: Union[int, None] = None
+    url: str
+    thumbnail_url: Union[str, None] = None
+
+    class Config:
+        orm_mode = True
+
+
 class AdvertisementToFeed(AdvertisementBase):
     id: int
     owner: UserToFeed
     created_at: datetime
     updated_at: Union[datetime, None] = None
     state: str
+    attachments: list[Attachment] = []
+
+    @validator("attachments")
+    def only_published_attachments(cls, attachments, values):
+        # Like the attachments listing: those of unpublished ads are only
+        # shown to the people who may manage them, never in the feed.
+        return attachments if values.get("state") == "active" else []
 
     class Config:
         orm_mode = True
+
+
+class AdvertisementStateChange(BaseModel):
+    ids: conlist(int, min_items=1, max_items=100000)
+    state: Literal['active', 'draft', 'removed']
+
+
+class AdvertisementStateOutcome(BaseModel):
+    id: int
+    outcome: Literal['updated', 'unchanged', 'not_found']
+
+
+class AdvertisementCounts(BaseModel):
+    total: int
+    by_state: dict[str, int]
+
+
+class AdvertisementStats(AdvertisementCounts):
+    by_region: dict[str, int]
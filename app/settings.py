@@ -0,0 +1,116 @@
+import os
+from functools import lru_cache
+from typing import Union
+from pydantic import BaseSettings, Field
+
+
+class Settings(BaseSettings):
+    database_url: str = "sqlite:///./advertisements.db"
+    db_echo: bool = False
+    db_pool_size: int = 5
+    db_max_overflow: int = 10
+    db_pool_recycle: int = 1800
+    db_pool_pre_ping: bool = True
+
+    # Applied on every new connection to a file-backed SQLite database.
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size: int = 256 * 1024 * 1024
+    sqlite_cache_size: int = -64000
+    sqlite_busy_timeout: int = 5000
+
+    feed_cache_size: int = 256
+    feed_cache_ttl: float = 30
+    principal_cache_size: int = 10000
+    principal_cache_ttl: float = 60
+    # max-age for feed responses; they are revalidated with ETags after it.
+    feed_max_age: int = 0
+
+    # Admission control per route class (auth, reads, writes, admin): up to
+    # ADMISSION_<CLASS>_CONCURRENCY requests run at once, up to
+    # ADMISSION_<CLASS>_QUEUE more wait at most ADMISSION_QUEUE_TIMEOUT
+    # seconds, and the rest get 503 with Retry-After.
+    admission_control: bool = True
+    admission_auth_concurrency: int = 8
+    admission_auth_queue: int = 64
+    admission_reads_concurrency: int = 100
+    admission_reads_queue: int = 500
+    admission_writes_concurrency: int = 32
+    admission_writes_queue: int = 128
+    admission_admin_concurrency: int = 4
+    admission_admin_queue: int = 16
+    admission_queue_timeout: float = 5
+    admission_retry_after: int = 1
+    # Per-user token bucket: RATE_LIMIT_PER_SECOND requests on average, with
+    # bursts of RATE_LIMIT_BURST; unset to turn it off.
+    rate_limit_per_second: Union[float, None] = None
+    rate_limit_burst: int = 50
+
+    # On startup: open the connection pool, run the hot queries once (which
+    # also fills the feed cache) and start the hashing workers.
+    startup_warmup: bool = True
+
+    bcrypt_rounds: int = 12
+    hashing_workers: int = Field(default_factory=lambda: os.cpu_count() or 1)
+
+    query_budget_strict: bool = False
+    # Statements slower than this are logged to app.db.slow_query; unset to
+    # turn the log off.
+    slow_query_ms: Union[float, None] = 200
+    server_timing: bool = True
+
+    bulk_insert_batch_size: int = 500
+    bulk_max_item_bytes: int = 64 * 1024
+
+    export_batch_size: int = 1000
+
+    # Commit concurrent ad and token inserts together: a batch is committed
+    # when it has GROUP_COMMIT_MAX_BATCH writes or its first write has
+    # waited GROUP_COMMIT_WINDOW_MS.
+    group_commit: bool = False
+    group_commit_window_ms: float = 2
+    group_commit_max_batch: int = 64
+
+    # Optional read replica for GET endpoints. Reads go to the primary while
+    # the replica is unreachable or more than REPLICA_MAX_LAG_SECONDS behind
+    # (checked at most every REPLICA_CHECK_INTERVAL seconds), and for
+    # REPLICA_STICKY_SECONDS after a client's own write.
+    replica_database_url: Union[str, None] = None
+    replica_max_lag_seconds: float = 5
+    replica_check_interval: float = 1
+    replica_sticky_seconds: float = 5
+
+    # Uploaded images, stored once per content under ATTACHMENTS_DIR.
+    attachments_dir: str = "./attachments"
+    attachment_max_bytes: int = 10 * 1024 * 1024
+    attachments_per_advertisement: int = 10
+    # Serve attachments through this internal nginx location
+    # (X-Accel-Redirect) instead of from the app.
+    attachments_accel_redirect: Union[str, None] = None
+    thumbnail_size: int = 320
+    thumbnail_workers: int = 1
+
+    state_change_batch_size: int = 5000
+
+    # Serve list endpoints from column tuples encoded with orjson instead of
+    # ORM objects validated through the response models.
+    fast_serialization: bool = False
+
+    class Config:
+        env_file = ".env"
+
+
+@lru_cache()
+def get_settings() -> Settings:
+    return Settings()
+
+
+settings = get_settings()
+
+
+def use_settings(new: Settings) -> Settings:
+    """Make `new` the settings every module reads (they all share the
+    `settings` instance) and return a copy of the ones it replaces."""
+    previous = settings.copy()
+    settings.__dict__.update(new.__dict__)
+    return previous
@@ -0,0 +1,98 @@
+"""Diff two `benchmarks.load` reports.
+
+    python -m benchmarks.compare base.json head.json [--threshold 10]
+
+Prints every metric side by side with the relative change and exits with
+status 1 when a scenario regressed: a latency percentile grew, or
+throughput dropped, by more than --threshold percent, or it issues more SQL
+statements per request, or it has new errors.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when higher is better
+METRICS = {
+    "p50_ms": False,
+    "p95_ms": False,
+    "p99_ms": False,
+    "throughput_rps": True,
+    "sql_per_request": False,
+    "errors": False,
+}
+# Latency and throughput are noisy; statement counts and errors are exact.
+EXACT_METRICS = {"sql_per_request", "errors"}
+
+
+def load(path: str) -> dict:
+    with open(path) as report:
+        return json.load(report)
+
+
+def change(base: float, head: float):
+    if not base:
+        return None
+    return (head - base) / base * 100
+
+
+def regressed(metric: str, base: float, head: float, threshold: float) -> bool:
+    if metric in EXACT_METRICS:
+        return round(head, 2) > round(base, 2)
+    delta = change(base, head)
+    if delta is None:
+        return False
+    return -delta > threshold if METRICS[metric] else delta > threshold
+
+
+def compare(base: dict, head: dict, threshold: float):
+    rows = []
+    regressions = []
+    for scenario in sorted(set(base["results"]) | set(head["results"])):
+        before = base["results"].get(scenario)
+        after = head["results"].get(scenario)
+        if before is None or after is None:
+            rows.append((scenario, "-", None, None, "only in " + (
+                "head" if before is None else "base")))
+            continue
+        for metric in METRICS:
+            delta = change(before[metric], after[metric])
+            flag = ""
+            if regressed(metric, before[metric], after[metric], threshold):
+                flag = "REGRESSED"
+                regressions.append(f"{scenario}.{metric}")
+            rows.append((scenario, metric, before[metric], after[metric],
+                         flag if delta is None else f"{delta:+.1f}% {flag}"))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("base")
+    parser.add_argument("head")
+    parser.add_argument("--threshold", type=float, default=10.0,
+                        help="allowed latency/throughput change in percent")
+    args = parser.parse_args()
+
+    base, head = load(args.base), load(args.head)
+    for side, report in (("base", base), ("head", head)):
+        meta = report["meta"]
+        print(f"{side}: {meta.get('git_revision') or 'unknown revision'} "
+              f"at {meta.get('started_at')}, seed {meta.get('seed')}")
+    for key, what in (("seed", "datasets"), ("run", "run options"),
+                      ("settings", "settings")):
+        if base["meta"].get(key) != head["meta"].get(key):
+            print(f"warning: the runs used different {what}")
+
+    rows, regressions = compare(base, head, args.threshold)
+    print(f"{'scenario':<14}{'metric':<17}{'base':>12}{'head':>12}  change")
+    for scenario, metric, before, after, note in rows:
+        before = "" if before is None else f"{before:.2f}"
+        after = "" if after is None else f"{after:.2f}"
+        print(f"{scenario:<14}{metric:<17}{before:>12}{after:>12}  {note}")
+    if regressions:
+        print("regressions: " + ", ".join(regressions))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
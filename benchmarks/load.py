@@ -0,0 +1,321 @@
+"""Drive the real app in-process and report latency per endpoint.
+
+    python -m benchmarks.load [--requests 500] [--concurrency 8] \\
+        [--scenarios feed,auth] [--no-cache] [--output run.json]
+
+Seeds a fresh SQLite database with `benchmarks.seed` (see its options, they
+are accepted here too), sends requests to `main.app` through httpx's ASGI
+transport -- no server, no network -- and reports p50/p95/p99 latency,
+throughput and SQL statements per request for every scenario. The JSON
+written to --output is what `python -m benchmarks.compare` diffs.
+
+Settings are read from the environment as usual, so e.g.
+`FAST_SERIALIZATION=true BCRYPT_ROUNDS=10 python -m benchmarks.load` runs
+the same scenarios against another configuration.
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass
+from datetime import datetime
+from typing import Callable
+from benchmarks.seed import PASSWORD, Dataset, SeedConfig, generate, user_email, zipf_weights
+
+REQUEST_ID_HEADER = "x-benchmark-request"
+
+
+@dataclass
+class Scenario:
+    name: str
+    # (dataset, rng, state) -> (method, url, httpx request kwargs)
+    request: Callable
+    # Optional async (client, dataset, rng) -> state, run once before warmup.
+    setup: Callable = None
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+class Picker:
+    """Skewed choices over the seeded data: heavy users and crowded regions
+    come up more often, like they do in real traffic."""
+
+    def __init__(self, dataset: Dataset, skew: float):
+        self.dataset = dataset
+        self.token_users = [user_id for user_id in dataset.client_ids
+                            if user_id in dataset.tokens]
+        self.user_weights = zipf_weights(len(self.token_users), skew)
+        self.region_weights = zipf_weights(len(dataset.regions), skew)
+
+    def client(self, rng) -> int:
+        return rng.choices(self.token_users, weights=self.user_weights)[0]
+
+    def region(self, rng) -> str:
+        return rng.choices(self.dataset.regions, weights=self.region_weights)[0]
+
+    def token(self, user_id: int) -> str:
+        return self.dataset.tokens[user_id]
+
+
+async def feed_cursors(client, dataset, rng, pages: int = 20):
+    cursors = []
+    after = None
+    for _ in range(pages):
+        response = await client.get("/", params={"limit": 100, **(
+            {"after": after} if after else {})})
+        after = response.headers.get("x-next-cursor")
+        if not after:
+            break
+        cursors.append(after)
+    return cursors
+
+
+def scenarios(picker: Picker) -> list[Scenario]:
+    def user_ads(dataset, rng, state):
+        user_id = picker.client(rng)
+        return "GET", f"/users/{user_id}/advertisements/", {
+            "headers": bearer(picker.token(user_id))}
+
+    def create_ad(dataset, rng, state):
+        user_id = picker.client(rng)
+        title = " ".join(rng.choices(dataset.words, k=3))
+        return "POST", f"/users/{user_id}/advertisements/", {
+            "headers": bearer(picker.token(user_id)),
+            "json": {"title": title, "body": f"{title}, benchmark"}}
+
+    def auth(dataset, rng, state):
+        return "POST", "/auth", {"data": {
+            "username": user_email(picker.client(rng)),
+            "password": dataset.password}}
+
+    return [
+        Scenario("feed", lambda dataset, rng, state: (
+            "GET", "/", {"params": {"limit": 100}})),
+        Scenario("feed_cursor", lambda dataset, rng, state: (
+            "GET", "/", {"params": {"limit": 100,
+                                    "after": rng.choice(state)}}),
+                 setup=feed_cursors),
+        Scenario("feed_region", lambda dataset, rng, state: (
+            "GET", "/", {"params": {"limit": 100,
+                                    "region": picker.region(rng)}})),
+        Scenario("search", lambda dataset, rng, state: (
+            "GET", "/advertisements/search",
+            {"params": {"q": rng.choice(dataset.words), "limit": 20}})),
+        Scenario("user_me", lambda dataset, rng, state: (
+            "GET", "/user/me",
+            {"headers": bearer(picker.token(picker.client(rng)))})),
+        Scenario("user_ads", user_ads),
+        Scenario("create_ad", create_ad),
+        Scenario("auth", auth),
+    ]
+
+
+def counting_app(app, statement_counts: dict):
+    """Wrap `app` so the SQL statements of each benchmark request can be
+    looked up by the id the client sent in REQUEST_ID_HEADER."""
+    from app.db.query_counter import track_request_queries
+
+    header = REQUEST_ID_HEADER.encode()
+
+    async def wrapped(scope, receive, send):
+        if scope["type"] != "http":
+            return await app(scope, receive, send)
+        request_id = dict(scope["headers"]).get(header)
+        with track_request_queries() as counter:
+            await app(scope, receive, send)
+        if request_id is not None:
+            statement_counts[request_id.decode()] = counter.count
+
+    return wrapped
+
+
+def percentile(sorted_values: list[float], fraction: float) -> float:
+    # Nearest-rank percentile, which is stable for small samples.
+    index = max(0, min(len(sorted_values) - 1,
+                       round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+async def run_scenario(client, scenario: Scenario, dataset: Dataset,
+                       statement_counts: dict, requests: int,
+                       concurrency: int, warmup: int, rng) -> dict:
+    state = await scenario.setup(client, dataset, rng) if scenario.setup else None
+
+    async def send(request_id: str):
+        method, url, kwargs = scenario.request(dataset, rng, state)
+        headers = {**kwargs.pop("headers", {}), REQUEST_ID_HEADER: request_id}
+        start = time.perf_counter()
+        response = await client.request(method, url, headers=headers, **kwargs)
+        elapsed = time.perf_counter() - start
+        return elapsed, statement_counts.pop(request_id, 0), response.status_code
+
+    for number in range(warmup):
+        await send(f"{scenario.name}-warmup-{number}")
+
+    samples = []
+    sequence = iter(range(requests))
+
+    async def worker():
+        for number in sequence:
+            samples.append(await send(f"{scenario.name}-{number}"))
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed for elapsed, _, _ in samples)
+    statements = [count for _, count, _ in samples]
+    return {
+        "requests": len(samples),
+        "errors": sum(status >= 400 for _, _, status in samples),
+        "concurrency": concurrency,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000,
+        "max_ms": latencies[-1] * 1000,
+        "throughput_rps": len(samples) / wall,
+        "sql_per_request": statistics.fmean(statements),
+        "sql_max": max(statements),
+    }
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(args, config: SeedConfig) -> dict:
+    import fastapi
+    import sqlalchemy
+    from app.settings import settings
+
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "fastapi": fastapi.__version__,
+        "sqlalchemy": sqlalchemy.__version__,
+        "seed": asdict(config),
+        "run": {
+            "requests": args.requests,
+            "concurrency": args.concurrency,
+            "warmup": args.warmup,
+            "no_cache": args.no_cache,
+        },
+        "settings": settings.dict(exclude={"database_url"}),
+    }
+
+
+def print_header(stream=sys.stderr):
+    print(f"{'scenario':<14}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+          f"{'req/s':>10}{'sql/req':>9}{'errors':>8}", file=stream)
+
+
+def print_row(name: str, result: dict, stream=sys.stderr):
+    print(f"{name:<14}{result['p50_ms']:>10.2f}{result['p95_ms']:>10.2f}"
+          f"{result['p99_ms']:>10.2f}{result['throughput_rps']:>10.1f}"
+          f"{result['sql_per_request']:>9.2f}{result['errors']:>8}",
+          file=stream)
+
+
+async def run(args, config: SeedConfig) -> dict:
+    import httpx
+    import main
+    from app.db import models
+    from app.db.database import engine
+    from app.functions import hashing
+
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        dataset = generate(connection, config,
+                           hashing.pwd_context.hash(PASSWORD))
+    engine.dispose()
+
+    picker = Picker(dataset, config.skew)
+    selected = [scenario for scenario in scenarios(picker)
+                if not args.scenarios or scenario.name in args.scenarios]
+    statement_counts = {}
+    transport = httpx.ASGITransport(app=counting_app(main.app,
+                                                     statement_counts))
+    rng = random.Random(config.seed)
+    results = {}
+    # The lifespan puts the app's database, caches and workers in place and
+    # shuts them down afterwards.
+    async with main.app.router.lifespan_context(main.app):
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://benchmark") as client:
+            print_header()
+            for scenario in selected:
+                results[scenario.name] = await run_scenario(
+                    client, scenario, dataset, statement_counts,
+                    requests=args.requests, concurrency=args.concurrency,
+                    warmup=args.warmup, rng=rng)
+                print_row(scenario.name, results[scenario.name])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url",
+                        help="empty database to seed; a temporary SQLite "
+                        "file by default")
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--scenarios", type=lambda value: value.split(","),
+                        help="comma-separated scenario names; all by default")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="disable the feed and principal caches")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--users", type=int, default=SeedConfig.users)
+    parser.add_argument("--groups", type=int, default=SeedConfig.groups)
+    parser.add_argument("--ads", type=int, default=SeedConfig.ads)
+    parser.add_argument("--tokens", type=int, default=SeedConfig.tokens)
+    parser.add_argument("--skew", type=float, default=SeedConfig.skew)
+    parser.add_argument("--seed", type=int, default=SeedConfig.seed)
+    args = parser.parse_args()
+
+    # Settings are read when the app is imported, so the environment has to
+    # be in place first.
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        directory = tempfile.mkdtemp(prefix="benchmark-")
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/benchmark.db"
+    if args.no_cache:
+        os.environ["FEED_CACHE_TTL"] = "0"
+        os.environ["PRINCIPAL_CACHE_TTL"] = "0"
+
+    config = SeedConfig(users=args.users, groups=args.groups, ads=args.ads,
+                        tokens=args.tokens, skew=args.skew, seed=args.seed)
+    results = asyncio.run(run(args, config))
+    report = {"meta": metadata(args, config), "results": results}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,192 @@
+"""Synthetic data generator for benchmarks.
+
+    python -m benchmarks.seed --database-url sqlite:///./bench.db \\
+        [--users 1000] [--groups 20] [--ads 50000] [--tokens 2000] \\
+        [--skew 1.1] [--seed 42]
+
+Everything is derived from --seed, so two runs with the same arguments
+produce the same rows (timestamps are laid out from a fixed epoch, only
+token expiry is relative to now). Ads per user and users per group follow a
+Zipf-like distribution controlled by --skew (0 is uniform), so a few heavy
+users and crowded regions dominate, as they do in production.
+"""
+import argparse
+import os
+import random
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+from sqlalchemy import insert, select
+from app.db import models
+from app.functions import counters
+
+EPOCH = datetime(2024, 1, 1)
+PASSWORD = "benchmark-password"
+WORDS = ("bike", "sofa", "apartment", "laptop", "guitar", "camera", "desk",
+         "garden", "lessons", "repair", "vintage", "kids", "phone", "car",
+         "tickets", "kitchen", "books", "puppy", "tent", "piano")
+# Share of ads in each state; the rest are active.
+DRAFT_SHARE = 0.1
+REMOVED_SHARE = 0.05
+BATCH_SIZE = 5000
+
+
+@dataclass
+class SeedConfig:
+    users: int = 1000
+    groups: int = 20
+    ads: int = 50000
+    tokens: int = 2000
+    skew: float = 1.1
+    seed: int = 42
+
+
+@dataclass
+class Dataset:
+    """Handles a load run needs on top of what is in the database."""
+    admin_id: int
+    moderator_id: int
+    # Client ids ordered from the heaviest poster down.
+    client_ids: list[int]
+    regions: list[str]
+    # Valid bearer tokens by user id.
+    tokens: dict[int, str] = field(default_factory=dict)
+    password: str = PASSWORD
+    words: tuple = WORDS
+
+
+def user_email(user_id: int) -> str:
+    return f"user{user_id}@bench.example"
+
+
+def zipf_weights(n: int, skew: float) -> list[float]:
+    return [1 / (rank ** skew) for rank in range(1, n + 1)]
+
+
+def spread(total: int, weights: list[float]) -> list[int]:
+    # Deterministic apportionment: floor of each share, remainders go to the
+    # largest weights first.
+    scale = total / sum(weights)
+    counts = [int(weight * scale) for weight in weights]
+    for i in range(total - sum(counts)):
+        counts[i % len(counts)] += 1
+    return counts
+
+
+def chunks(rows: list, size: int = BATCH_SIZE):
+    for start in range(0, len(rows), size):
+        yield rows[start:start + size]
+
+
+def insert_rows(connection, table, rows: list):
+    for chunk in chunks(rows):
+        connection.execute(insert(table), chunk)
+
+
+def generate(connection, config: SeedConfig, hashed_password: str) -> Dataset:
+    """Insert a dataset through `connection` (committed by the caller)."""
+    rng = random.Random(config.seed)
+    now = datetime.now()
+
+    group_ids = range(1, config.groups + 1)
+    insert_rows(connection, models.Group.__table__, [{
+        "id": group_id,
+        "region": f"region-{group_id}",
+        "created_at": EPOCH,
+    } for group_id in group_ids])
+
+    # Ids 1 and 2 are the admin and the moderator, clients follow.
+    user_ids = range(1, config.users + 3)
+    roles = {1: "admin", 2: "moderator"}
+    insert_rows(connection, models.User.__table__, [{
+        "id": user_id,
+        "email": user_email(user_id),
+        "hashed_password": hashed_password,
+        "is_active": True,
+        "role": roles.get(user_id, "client"),
+        "created_at": EPOCH + timedelta(minutes=user_id),
+    } for user_id in user_ids])
+
+    group_weights = zipf_weights(config.groups, config.skew)
+    memberships = [{"user_id": 1, "group_id": 1}, {"user_id": 2, "group_id": 1}]
+    for user_id in user_ids[2:]:
+        group_id = rng.choices(group_ids, weights=group_weights)[0]
+        memberships.append({"user_id": user_id, "group_id": group_id})
+    insert_rows(connection, models.UserGroup.__table__, memberships)
+
+    client_ids = list(user_ids[2:])
+    ads = []
+    # About one ad a minute on average, interleaved across users.
+    span = config.ads * 60
+    per_user = spread(config.ads, zipf_weights(len(client_ids), config.skew))
+    for user_id, count in zip(client_ids, per_user):
+        for _ in range(count):
+            seconds = rng.randrange(span)
+            roll = rng.random()
+            state = ("removed" if roll < REMOVED_SHARE else
+                     "draft" if roll < REMOVED_SHARE + DRAFT_SHARE else
+                     "active")
+            title = " ".join(rng.choices(WORDS, k=3))
+            ads.append({
+                "title": title,
+                "body": f"{title}. " + " ".join(rng.choices(WORDS, k=40)),
+                "owner_id": user_id,
+                "state": state,
+                "created_at": EPOCH + timedelta(seconds=seconds),
+            })
+    # Insert in creation order so ids follow created_at like real traffic.
+    ads.sort(key=lambda row: row["created_at"])
+    insert_rows(connection, models.Advertisement.__table__, ads)
+    counters.rebuild(connection)
+
+    tokens = {}
+    token_rows = []
+    for i in range(config.tokens):
+        user_id = client_ids[i % len(client_ids)] if i >= 2 else user_ids[i]
+        value = uuid.UUID(int=rng.getrandbits(128), version=4).hex
+        # Every fourth token is expired, so lookups see both kinds.
+        expired = i % 4 == 3
+        token_rows.append({
+            "token": value,
+            "user_id": user_id,
+            "expires": (now - timedelta(hours=1) if expired else
+                        now + timedelta(days=1)),
+        })
+        if not expired:
+            tokens.setdefault(user_id, value)
+    insert_rows(connection, models.Token.__table__, token_rows)
+
+    return Dataset(admin_id=1,
+                   moderator_id=2,
+                   client_ids=client_ids,
+                   regions=[f"region-{group_id}" for group_id in group_ids],
+                   tokens=tokens)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url", required=True)
+    parser.add_argument("--users", type=int, default=SeedConfig.users)
+    parser.add_argument("--groups", type=int, default=SeedConfig.groups)
+    parser.add_argument("--ads", type=int, default=SeedConfig.ads)
+    parser.add_argument("--tokens", type=int, default=SeedConfig.tokens)
+    parser.add_argument("--skew", type=float, default=SeedConfig.skew)
+    parser.add_argument("--seed", type=int, default=SeedConfig.seed)
+    args = parser.parse_args()
+    os.environ["DATABASE_URL"] = args.database_url
+
+    from app.db.database import engine
+    from app.functions.hashing import pwd_context
+
+    config = SeedConfig(users=args.users, groups=args.groups, ads=args.ads,
+                        tokens=args.tokens, skew=args.skew, seed=args.seed)
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        if connection.execute(select(models.User.id).limit(1)).first():
+            parser.error("the database already has users")
+        generate(connection, config, pwd_context.hash(PASSWORD))
+    print(f"seeded {config}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+"""Compare the default and the fast (FAST_SERIALIZATION) response paths.
+
+    python -m benchmarks.serialization [--ads 5000] [--page 100] [--rounds 200]
+
+Seeds a throwaway SQLite database, renders the same feed and user-list pages
+through both paths, checks that the bodies are byte-identical and reports
+the time per page.
+"""
+import argparse
+import atexit
+import os
+import shutil
+import statistics
+import tempfile
+import time
+from types import SimpleNamespace
+
+DB_DIR = tempfile.mkdtemp(prefix="serialization-bench-")
+atexit.register(shutil.rmtree, DB_DIR, ignore_errors=True)
+os.environ["DATABASE_URL"] = f"sqlite:///{DB_DIR}/bench.db"
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from fastapi.responses import JSONResponse  # noqa: E402
+from app.db import models  # noqa: E402
+from app.db.database import SessionLocal, engine  # noqa: E402
+from app.functions import advertisement_functions, serialization, user_functions  # noqa: E402
+from app.schemas import advertisement_schema, user_schema  # noqa: E402
+from benchmarks.seed import SeedConfig, generate  # noqa: E402
+
+
+def seed(ads: int, users: int):
+    config = SeedConfig(users=users, ads=ads, tokens=0)
+    with engine.begin() as connection:
+        dataset = generate(connection, config, hashed_password="")
+    # The user functions only look at the principal's role, id and groups.
+    return SimpleNamespace(id=dataset.admin_id, role="admin", groups=[])
+
+
+def default_feed(db, limit):
+    ads = advertisement_functions.all_advertisements(db, limit=limit)
+    items = [advertisement_schema.AdvertisementToFeed.from_orm(ad) for ad in ads]
+    return JSONResponse(content=jsonable_encoder(items)).body
+
+
+def fast_feed(db, limit):
+    rows = advertisement_functions.all_advertisements(db, limit=limit, rows=True)
+    attachments = advertisement_functions.feed_attachments(
+        db, [row.id for row in rows])
+    return serialization.dumps(serialization.feed_items(rows, attachments))
+
+
+def default_users(db, limit, admin):
+    users = user_functions.get_users(db, current_user=admin, limit=limit)
+    items = [user_schema.User.from_orm(user) for user in users]
+    return JSONResponse(content=jsonable_encoder(items)).body
+
+
+def fast_users(db, limit, admin):
+    rows, groups = user_functions.get_user_rows(db, current_user=admin,
+                                                limit=limit)
+    return serialization.dumps(serialization.user_items(rows, groups))
+
+
+def measure(render, rounds: int):
+    # A fresh session per round, like a request, so the default path does
+    # not get to reuse objects already in the identity map.
+    timings = []
+    for _ in range(rounds):
+        with SessionLocal() as db:
+            start = time.perf_counter()
+            body = render(db)
+            timings.append(time.perf_counter() - start)
+    return body, timings
+
+
+def report(name, default, fast, rounds):
+    default_body, default_times = measure(default, rounds)
+    fast_body, fast_times = measure(fast, rounds)
+    assert default_body == fast_body, f"{name}: bodies differ"
+    default_ms = statistics.median(default_times) * 1000
+    fast_ms = statistics.median(fast_times) * 1000
+    print(f"{name:<8} default {default_ms:8.3f} ms  fast {fast_ms:8.3f} ms  "
+          f"x{default_ms / fast_ms:.1f}  ({len(fast_body)} bytes)")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ads", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--page", type=int, default=100)
+    parser.add_argument("--rounds", type=int, default=200)
+    args = parser.parse_args()
+
+    models.Base.metadata.create_all(engine)
+    admin = seed(args.ads, args.users)
+
+    print(f"serialization: {serialization.orjson and 'orjson' or 'json'}, "
+          f"page size {args.page}, median of {args.rounds} rounds")
+    report("feed", lambda db: default_feed(db, args.page),
+           lambda db: fast_feed(db, args.page), args.rounds)
+    report("users", lambda db: default_users(db, args.page, admin),
+           lambda db: fast_users(db, args.page, admin), args.rounds)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""Measure how long a fresh process takes to serve its first requests.
+
+    python -m benchmarks.startup [--runs 5] [--output run.json]
+
+Seeds a temporary SQLite database with `benchmarks.seed` (its options are
+accepted here too), then starts --runs new processes with the warm-up
+disabled (STARTUP_WARMUP=false) and --runs with it enabled. Each process
+imports `main`, runs the app's lifespan startup and times the first and
+second feed, login and /user/me requests through httpx's ASGI transport.
+Medians are printed per mode; with warm-up on, startup takes longer and the
+first requests should cost about as much as the second ones.
+"""
+import argparse
+import asyncio
+import atexit
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+from datetime import datetime
+from benchmarks.seed import PASSWORD, SeedConfig, generate, user_email
+
+MODES = {"cold": "false", "warm": "true"}
+PHASES = ("import", "startup", "feed", "feed_again", "auth", "auth_again",
+          "user_me", "user_me_again")
+
+
+def bearer(token: str) -> dict:
+    return {"Authorization": f"Bearer {token}"}
+
+
+async def measure(user_id: int, token: str) -> dict:
+    """Run in a fresh process: time importing the app, starting it and its
+    first requests, in milliseconds."""
+    import httpx
+
+    timings = {}
+    start = time.perf_counter()
+    import main
+    timings["import"] = (time.perf_counter() - start) * 1000
+
+    requests = [
+        ("feed", "GET", "/", {"params": {"limit": 100}}),
+        ("auth", "POST", "/auth", {"data": {"username": user_email(user_id),
+                                            "password": PASSWORD}}),
+        ("user_me", "GET", "/user/me", {"headers": bearer(token)}),
+    ]
+    start = time.perf_counter()
+    async with main.app.router.lifespan_context(main.app):
+        timings["startup"] = (time.perf_counter() - start) * 1000
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport,
+                                     base_url="http://benchmark") as client:
+            for suffix in ("", "_again"):
+                for name, method, url, kwargs in requests:
+                    start = time.perf_counter()
+                    response = await client.request(method, url, **kwargs)
+                    timings[name + suffix] = (time.perf_counter() - start) * 1000
+                    if response.status_code >= 400:
+                        raise RuntimeError(f"{method} {url} answered "
+                                           f"{response.status_code}")
+    return timings
+
+
+def seed(config: SeedConfig):
+    from sqlalchemy import create_engine
+    from app.db import models
+    from app.functions import hashing
+
+    engine = create_engine(os.environ["DATABASE_URL"])
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        dataset = generate(connection, config,
+                           hashing.pwd_context.hash(PASSWORD))
+    engine.dispose()
+    return next(iter(dataset.tokens.items()))
+
+
+def run_child(mode: str, user_id: int, token: str) -> dict:
+    environment = {**os.environ, "STARTUP_WARMUP": MODES[mode]}
+    completed = subprocess.run(
+        [sys.executable, "-m", "benchmarks.startup", "--child",
+         "--user-id", str(user_id), "--token", token],
+        env=environment, capture_output=True, text=True, check=True)
+    return json.loads(completed.stdout)
+
+
+def git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def metadata(args, config: SeedConfig) -> dict:
+    import fastapi
+    import sqlalchemy
+    from app.settings import settings
+
+    return {
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "git_revision": git_revision(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "fastapi": fastapi.__version__,
+        "sqlalchemy": sqlalchemy.__version__,
+        "seed": asdict(config),
+        "run": {"runs": args.runs},
+        "settings": settings.dict(exclude={"database_url", "startup_warmup"}),
+    }
+
+
+def print_table(results: dict, stream=sys.stderr):
+    print(f"{'median ms':<14}" + "".join(f"{mode:>10}" for mode in results),
+          file=stream)
+    for phase in PHASES:
+        print(f"{phase:<14}" + "".join(
+            f"{results[mode][phase]:>10.2f}" for mode in results),
+            file=stream)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--database-url",
+                        help="empty database to seed; a temporary SQLite "
+                        "file by default")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="processes started per mode")
+    parser.add_argument("--output", help="write the JSON report here")
+    parser.add_argument("--users", type=int, default=SeedConfig.users)
+    parser.add_argument("--groups", type=int, default=SeedConfig.groups)
+    parser.add_argument("--ads", type=int, default=SeedConfig.ads)
+    parser.add_argument("--tokens", type=int, default=SeedConfig.tokens)
+    parser.add_argument("--skew", type=float, default=SeedConfig.skew)
+    parser.add_argument("--seed", type=int, default=SeedConfig.seed)
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--user-id", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--token", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        json.dump(asyncio.run(measure(args.user_id, args.token)), sys.stdout)
+        return
+
+    # The children inherit the environment, and with it the database.
+    if args.database_url:
+        os.environ["DATABASE_URL"] = args.database_url
+    else:
+        directory = tempfile.mkdtemp(prefix="benchmark-")
+        atexit.register(shutil.rmtree, directory, ignore_errors=True)
+        os.environ["DATABASE_URL"] = f"sqlite:///{directory}/benchmark.db"
+
+    config = SeedConfig(users=args.users, groups=args.groups, ads=args.ads,
+                        tokens=args.tokens, skew=args.skew, seed=args.seed)
+    user_id, token = seed(config)
+    samples = {mode: [] for mode in MODES}
+    # Alternate the modes so drift (caches, CPU frequency) hits both alike.
+    for _ in range(args.runs):
+        for mode in MODES:
+            samples[mode].append(run_child(mode, user_id, token))
+    results = {mode: {phase: statistics.median(run[phase] for run in runs)
+                      for phase in PHASES}
+               for mode, runs in samples.items()}
+    print_table(results)
+    report = {"meta": metadata(args, config), "results": results,
+              "samples": samples}
+    if args.output:
+        with open(args.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == "__main__":
+    main()
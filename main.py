@@ -1,277 +1,622 @@
-from fastapi import Depends, FastAPI, HTTPException
+from datetime import datetime
+from typing import Union
+from fastapi import APIRouter, BackgroundTasks, Depends, FastAPI, HTTPException, Path, Query, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from sqlalchemy.ext.asyncio import AsyncSession
 from app.schemas import user_schema, advertisement_schema
-from app.functions import user_functions, advertisement_functions, dependencies
+from app.functions import user_functions, advertisement_functions, attachments, dependencies, hashing, ingestion, export, serialization
 from app.db import models
-from app.db.database import engine
-from app import role_permissions as rp
-
-
-models.Base.metadata.create_all(bind=engine)
-
-app = FastAPI()
-
-
-@app.get("/", response_model=list[advertisement_schema.AdvertisementToFeed])
-def read_feed(skip: int = 0,
-              limit: int = 100,
-              db: Session = Depends(dependencies.get_db)):
-    users = advertisement_functions.all_advertisements(db,
-                                                       skip=skip,
-                                                       limit=limit)
-    return users
-
-
-@app.post("/users/", response_model=user_schema.User, dependencies=[Depends(rp.allow_create_users)])
-def create_user(user: user_schema.UserCreate,
-                db: Session = Depends(dependencies.get_db),
-                current_user: models.User = Depends(
-                    dependencies.get_current_user),
-                ):
-    db_user = user_functions.get_user_by_email(db, email=user.email)
+from app.db.query_counter import QueryBudget
+from app import admission, conditional, lifespan, metrics, permissions, role_permissions as rp
+from app.settings import Settings, settings
+
+
+router = APIRouter()
+
+
+@router.get("/metrics", include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(metrics.registry.render(),
+                             media_type="text/plain; version=0.0.4")
+
+
+def set_next_cursor(response: Response, ads: list, limit: int):
+    cursor = advertisement_functions.next_cursor(ads, limit)
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+
+
+def set_total_count(response: Response, total: int):
+    response.headers["X-Total-Count"] = str(total)
+
+
+@router.get("/", response_model=list[advertisement_schema.AdvertisementToFeed],
+         dependencies=[Depends(QueryBudget(5))])
+async def read_feed(request: Request,
+                    skip: int = 0,
+                    limit: int = 100,
+                    after: Union[str, None] = None,
+                    region: Union[str, None] = None,
+                    db: AsyncSession = Depends(dependencies.get_async_read_db),
+                    current_user: Union[models.User, None] = Depends(
+                        dependencies.get_optional_user)):
+    region = region or advertisement_functions.default_region(current_user)
+    body, cursor, total, validators = await advertisement_functions.feed_page_async(db,
+                                                                 skip=skip,
+                                                                 limit=limit,
+                                                                 after=after,
+                                                                 region=region)
+    if validators.matches(request):
+        return validators.not_modified()
+    response = Response(content=body, media_type="application/json")
+    if cursor:
+        response.headers["X-Next-Cursor"] = cursor
+    set_total_count(response, total)
+    validators.apply(response)
+    return response
+
+
+@router.get("/advertisements/search",
+         response_model=list[advertisement_schema.AdvertisementToFeed],
+         dependencies=[Depends(QueryBudget(2))])
+async def search_advertisements(q: str = Query(..., min_length=1, max_length=200,
+                                              regex=r"^\s*\S"),
+                                skip: int = 0,
+                                limit: int = 100,
+                                db: AsyncSession = Depends(dependencies.get_async_read_db)):
+    return await advertisement_functions.search_advertisements_async(db,
+                                                                     q=q,
+                                                                     skip=skip,
+                                                                     limit=limit)
+
+
+@router.post("/advertisements/state",
+          response_model=list[advertisement_schema.AdvertisementStateOutcome],
+          dependencies=[Depends(rp.allow_change_advertisement_states)])
+async def change_advertisement_states(change: advertisement_schema.AdvertisementStateChange,
+                                      db: AsyncSession = Depends(dependencies.get_async_db),
+                                      current_user: models.User = Depends(
+                                          dependencies.get_current_user)):
+    return await advertisement_functions.change_advertisement_states_async(
+        db, ids=change.ids, state=change.state, current_user=current_user)
+
+
+@router.get("/advertisements/export",
+         dependencies=[Depends(rp.allow_export_advertisements)])
+async def export_advertisements(export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+                                owner_id: Union[int, None] = None,
+                                state: Union[str, None] = None,
+                                created_from: Union[datetime, None] = None,
+                                created_to: Union[datetime, None] = None,
+                                db: AsyncSession = Depends(dependencies.get_async_read_db)):
+    rows = export.export_advertisements(db,
+                                        export_format=export_format,
+                                        batch_size=settings.export_batch_size,
+                                        owner_id=owner_id,
+                                        state=state,
+                                        created_from=created_from,
+                                        created_to=created_to)
+    return StreamingResponse(rows,
+                             media_type=export.EXPORT_MEDIA_TYPES[export_format],
+                             headers=export.content_disposition(export_format))
+
+
+@router.get("/stats", response_model=advertisement_schema.AdvertisementStats,
+         dependencies=[Depends(rp.allow_view_stats), Depends(QueryBudget(4))])
+async def read_stats(db: AsyncSession = Depends(dependencies.get_async_read_db)):
+    return await advertisement_functions.get_stats_async(db)
+
+
+@router.post("/users/", response_model=user_schema.User, dependencies=[Depends(rp.allow_create_users)])
+async def create_user(user: user_schema.UserCreate,
+                      db: AsyncSession = Depends(dependencies.get_async_db),
+                      current_user: models.User = Depends(
+                          dependencies.get_current_user),
+                      ):
+    db_user = await user_functions.get_user_by_email_async(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=200, detail="Email already registered")
-    return user_functions.create_user(db=db, user=user)
+    hashed_password = await hashing.hash_password_async(user.password)
+    return await user_functions.create_user_async(db,
+                                                  user=user,
+                                                  hashed_password=hashed_password)
 
 
-@app.post("/register", response_model=user_schema.User)
-def create_user(user: user_schema.UserRegister,
-                db: Session = Depends(dependencies.get_db),
-                ):
-    db_user = user_functions.get_user_by_email(db, email=user.email)
+@router.post("/register", response_model=user_schema.User)
+async def create_user(user: user_schema.UserRegister,
+                      db: AsyncSession = Depends(dependencies.get_async_db),
+                      ):
+    db_user = await user_functions.get_user_by_email_async(db, email=user.email)
     if db_user:
         raise HTTPException(status_code=200, detail="Email already registered")
-    return user_functions.register(db=db, user=user)
+    hashed_password = await hashing.hash_password_async(user.password)
+    return await user_functions.register_async(db,
+                                               user=user,
+                                               hashed_password=hashed_password)
 
 
-@app.put("/users/{user_id}", response_model=user_schema.User, dependencies=[Depends(rp.allow_update_users)])
-def update_user(user_id: int,
-                user_in: user_schema.UserUpdate,
-                db: Session = Depends(dependencies.get_db),
-                current_user: models.User = Depends(
-                    dependencies.get_current_user)):
-    db_user = user_functions.get_user_by_email(db, email=user_in.email)
+@router.put("/users/{user_id}", response_model=user_schema.User, dependencies=[Depends(rp.allow_update_users)])
+async def update_user(user_id: int,
+                      user_in: user_schema.UserUpdate,
+                      db: AsyncSession = Depends(dependencies.get_async_db),
+                      current_user: models.User = Depends(
+                          dependencies.get_current_user)):
+    db_user = await user_functions.get_user_by_email_async(db, email=user_in.email)
     if db_user:
         raise HTTPException(status_code=200, detail="Email already registered")
-    return user_functions.update_user(db=db, user_id=user_id, user_in=user_in)
+    hashed_password = await hashing.hash_password_async(user_in.password)
+    return await user_functions.update_user_async(db,
+                                                  user_id=user_id,
+                                                  user_in=user_in,
+                                                  hashed_password=hashed_password)
 
 
-@app.delete("/users/{user_id}", response_model=user_schema.User, dependencies=[Depends(rp.allow_delete_users)])
-def delete_user(user_id: int, db: Session = Depends(dependencies.get_db)):
-    db_user = user_functions.get_user(db, user_id=user_id)
+@router.delete("/users/{user_id}", response_model=user_schema.User, dependencies=[Depends(rp.allow_delete_users)])
+async def delete_user(user_id: int,
+                      db: AsyncSession = Depends(dependencies.get_async_db)):
+    db_user = await user_functions.get_user_async(db, user_id=user_id)
     if not db_user or not db_user.is_active:
         raise HTTPException(status_code=404, detail="User not found")
-    return user_functions.delete_user(db=db, user=db_user)
+    return await user_functions.delete_user_async(db, user=db_user)
 
 
-@app.get("/users/", response_model=list[user_schema.User], dependencies=[Depends(rp.allow_view_users_list)])
-def read_users(skip: int = 0,
-               limit: int = 100,
-               db: Session = Depends(dependencies.get_db),
-               current_user: models.User = Depends(
-                   dependencies.get_current_user)):
-    users = user_functions.get_users(db=db, skip=skip, limit=limit, current_user=current_user)
+@router.get("/users/", response_model=list[user_schema.User],
+         dependencies=[Depends(rp.allow_view_users_list), Depends(QueryBudget(4))])
+async def read_users(skip: int = 0,
+                     limit: int = 100,
+                     db: AsyncSession = Depends(dependencies.get_async_read_db),
+                     current_user: models.User = Depends(
+                         dependencies.get_current_user)):
+    if settings.fast_serialization:
+        rows, groups = await user_functions.get_user_rows_async(
+            db, skip=skip, limit=limit, current_user=current_user)
+        return serialization.json_response(serialization.user_items(rows, groups))
+    users = await user_functions.get_users_async(db, skip=skip, limit=limit, current_user=current_user)
     return users
 
 
-@app.get("/users/{user_id}", response_model=user_schema.User)
-def read_user(user_id: int,
-              db: Session = Depends(dependencies.get_db),
-              current_user: models.User = Depends(
-                  dependencies.get_current_user)):
-    db_user = user_functions.get_user(db, user_id=user_id)
+@router.get("/users/{user_id}", response_model=user_schema.User,
+         dependencies=[Depends(QueryBudget(4))])
+async def read_user(user_id: int,
+                    request: Request,
+                    response: Response,
+                    db: AsyncSession = Depends(dependencies.get_async_read_db),
+                    current_user: models.User = Depends(
+                        dependencies.get_current_user)):
+    if conditional.is_conditional(request):
+        validators = await user_functions.get_user_validators_async(
+            db, user_id=user_id)
+        if validators is not None and validators.matches(request):
+            return validators.not_modified()
+    db_user = await user_functions.get_user_async(db, user_id=user_id)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
+    user_functions.user_validators(
+        db_user, ((group.id, group.region) for group in db_user.groups)).apply(response)
     return db_user
 
 
-@app.post("/users/{user_id}/advertisements/",
+@router.get("/users/{user_id}/stats",
+         response_model=advertisement_schema.AdvertisementCounts,
+         dependencies=[Depends(QueryBudget(4))])
+async def read_user_stats(user_id: int,
+                          db: AsyncSession = Depends(dependencies.get_async_read_db),
+                          current_user: models.User = Depends(
+                              dependencies.get_current_user)):
+    has_access = await user_functions.check_moderator_access_async(
+        db, user_id=user_id, current_user=current_user)
+    if not has_access:
+        raise HTTPException(status_code=404, detail="not found")
+    return await advertisement_functions.get_stats_async(db, user_id=user_id)
+
+
+@router.post("/users/{user_id}/advertisements/",
           response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_create_advertisements)])
-def create_user_advertisement(
+async def create_user_advertisement(
         user_id: int,
         advertisement: advertisement_schema.AdvertisementCreate,
-        db: Session = Depends(dependencies.get_db),
+        db: AsyncSession = Depends(dependencies.get_async_db),
         current_user: models.User = Depends(dependencies.get_current_user)):
-    return advertisement_functions.create_user_advertisement(
-        db=db, advertisement=advertisement, user_id=user_id, current_user=current_user)
+    return await advertisement_functions.create_user_advertisement_async(
+        db, advertisement=advertisement, user_id=user_id, current_user=current_user)
 
 
-@app.get("/users/{user_id}/advertisements/",
-         response_model=list[advertisement_schema.Advertisement])
-def read_user_advertisements(user_id: int,
-                             skip: int = 0,
-                             limit: int = 100,
-                             db: Session = Depends(dependencies.get_db),
-                             current_user: models.User = Depends(
-                                 dependencies.get_current_user)):
-    ads = advertisement_functions.get_advertisements(db,
-                                                     skip=skip,
-                                                     limit=limit,
-                                                     user_id=user_id)
+@router.post("/users/{user_id}/advertisements/bulk",
+          dependencies=[Depends(rp.allow_create_advertisements)])
+async def bulk_create_advertisements(
+        user_id: int,
+        request: Request,
+        db: AsyncSession = Depends(dependencies.get_async_db),
+        current_user: models.User = Depends(dependencies.get_current_user)):
+    """Create advertisements from an NDJSON (or JSON array) request body.
+
+    The body is read and inserted batch by batch; the response is one NDJSON
+    result per input line, in input order: `{"line": n, "id": ...}` or
+    `{"line": n, "errors": [...]}`. If the body cannot be read to the end
+    (malformed or truncated JSON, an oversized line), a last
+    `{"errors": [...]}` says why; the lines reported before it are
+    committed, the rest of the body is not processed.
+    """
+    if user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="not found")
+    content_type = request.headers.get("content-type", "")
+    results = ingestion.ingest_advertisements(
+        db,
+        user_id=user_id,
+        chunks=request.stream(),
+        json_array=content_type.startswith("application/json"),
+        batch_size=settings.bulk_insert_batch_size,
+        max_item_bytes=settings.bulk_max_item_bytes)
+    spool = await ingestion.spool_results(results)
+    return StreamingResponse(ingestion.iter_spool(spool),
+                             media_type="application/x-ndjson")
+
+
+@router.get("/users/{user_id}/advertisements/export")
+async def export_user_advertisements(
+        user_id: int,
+        export_format: str = Query("ndjson", alias="format", regex="^(ndjson|csv)$"),
+        state: Union[str, None] = None,
+        created_from: Union[datetime, None] = None,
+        created_to: Union[datetime, None] = None,
+        db: AsyncSession = Depends(dependencies.get_async_read_db),
+        current_user: models.User = Depends(dependencies.get_current_user)):
+    principal = permissions.principal_of(current_user)
+    if user_id != principal.id and not principal.is_admin:
+        raise HTTPException(status_code=404, detail="not found")
+    rows = export.export_advertisements(db,
+                                        export_format=export_format,
+                                        batch_size=settings.export_batch_size,
+                                        owner_id=user_id,
+                                        state=state,
+                                        created_from=created_from,
+                                        created_to=created_to)
+    return StreamingResponse(rows,
+                             media_type=export.EXPORT_MEDIA_TYPES[export_format],
+                             headers=export.content_disposition(export_format))
+
+
+@router.get("/users/{user_id}/advertisements/",
+         response_model=list[advertisement_schema.Advertisement],
+         dependencies=[Depends(QueryBudget(4))])
+async def read_user_advertisements(user_id: int,
+                                   response: Response,
+                                   skip: int = 0,
+                                   limit: int = 100,
+                                   after: Union[str, None] = None,
+                                   db: AsyncSession = Depends(dependencies.get_async_read_db),
+                                   current_user: models.User = Depends(
+                                       dependencies.get_current_user)):
+    ads = await advertisement_functions.get_advertisements_async(db,
+                                                                 skip=skip,
+                                                                 limit=limit,
+                                                                 after=after,
+                                                                 user_id=user_id,
+                                                                 rows=settings.fast_serialization)
+    total = await advertisement_functions.count_advertisements_async(
+        db, user_id=user_id)
+    if settings.fast_serialization:
+        response = serialization.json_response(
+            serialization.advertisement_items(ads))
+        set_next_cursor(response, ads, limit)
+        set_total_count(response, total)
+        return response
+    set_next_cursor(response, ads, limit)
+    set_total_count(response, total)
     return ads
 
 
-@app.get("/users/{user_id}/drafts/",
+@router.get("/users/{user_id}/drafts/",
          response_model=list[advertisement_schema.Advertisement])
-def read_user_drafts(user_id: int,
-                     skip: int = 0,
-                     limit: int = 100,
-                     db: Session = Depends(dependencies.get_db),
-                     current_user: models.User = Depends(
-                         dependencies.get_current_user)):
-    moderator_has_acces = user_functions.check_moderator_access(user_id=user_id, current_user=current_user)
+async def read_user_drafts(user_id: int,
+                           response: Response,
+                           skip: int = 0,
+                           limit: int = 100,
+                           after: Union[str, None] = None,
+                           db: AsyncSession = Depends(dependencies.get_async_read_db),
+                           current_user: models.User = Depends(
+                               dependencies.get_current_user)):
+    moderator_has_acces = await user_functions.check_moderator_access_async(
+        db, user_id=user_id, current_user=current_user)
     if not moderator_has_acces:
         raise HTTPException(status_code=404, detail="Drafts not found")
-    drafts = advertisement_functions.get_drafts(db,
-                                                skip=skip,
-                                                limit=limit,
-                                                user_id=user_id,
-                                                current_user=current_user)
+    drafts = await advertisement_functions.get_drafts_async(db,
+                                                            skip=skip,
+                                                            limit=limit,
+                                                            after=after,
+                                                            user_id=user_id,
+                                                            current_user=current_user)
+    set_next_cursor(response, drafts, limit)
+    set_total_count(response, await advertisement_functions.count_advertisements_async(
+        db, user_id=user_id, state='draft'))
     return drafts
 
 
-@app.post("/users/{user_id}/drafts/",
-          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_create_drafts)])
-def create_user_draft(user_id: int,
-                      draft: advertisement_schema.AdvertisementCreate,
-                      db: Session = Depends(dependencies.get_db),
-                      current_user: models.User = Depends(
-                          dependencies.get_current_user)):
-    return advertisement_functions.create_user_draft(db=db,
-                                                     draft=draft,
-                                                     user_id=user_id,
-                                                     current_user=current_user
-                                                     )
+@router.get("/moderation/drafts/",
+         response_model=list[advertisement_schema.Advertisement],
+         dependencies=[Depends(rp.allow_moderate_drafts), Depends(QueryBudget(4))])
+async def read_moderation_queue(response: Response,
+                                limit: int = 100,
+                                after: Union[str, None] = None,
+                                db: AsyncSession = Depends(dependencies.get_async_db),
+                                current_user: models.User = Depends(
+                                    dependencies.get_current_user)):
+    drafts, depth = await advertisement_functions.get_moderation_queue_async(
+        db, current_user=current_user, limit=limit, after=after)
+    set_next_cursor(response, drafts, limit)
+    response.headers["X-Queue-Depth"] = str(depth)
+    set_total_count(response, depth)
+    return drafts
 
 
-@app.get("/users/{user_id}/advertisements/{advertisement_id}",
+@router.post("/users/{user_id}/drafts/",
+          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_create_drafts)])
+async def create_user_draft(user_id: int,
+                            draft: advertisement_schema.AdvertisementCreate,
+                            db: AsyncSession = Depends(dependencies.get_async_db),
+                            current_user: models.User = Depends(
+                                dependencies.get_current_user)):
+    return await advertisement_functions.create_user_draft_async(db,
+                                                                 draft=draft,
+                                                                 user_id=user_id,
+                                                                 current_user=current_user
+                                                                 )
+
+
+@router.get("/users/{user_id}/advertisements/{advertisement_id}",
          response_model=advertisement_schema.Advertisement)
-def read_advertisement(advertisement_id: int,
-                       user_id: int,
-                       db: Session = Depends(dependencies.get_db),
-                       current_user: models.User = Depends(
-                           dependencies.get_current_user)):
-    advertisement = advertisement_functions.get_advertisement(
+async def read_advertisement(advertisement_id: int,
+                             user_id: int,
+                             request: Request,
+                             response: Response,
+                             db: AsyncSession = Depends(dependencies.get_async_read_db),
+                             current_user: models.User = Depends(
+                                 dependencies.get_current_user)):
+    if conditional.is_conditional(request):
+        validators = await advertisement_functions.get_advertisement_validators_async(
+            db, advertisement_id=advertisement_id, owner_id=user_id)
+        if validators is not None and validators.matches(request):
+            return validators.not_modified()
+    advertisement = await advertisement_functions.get_advertisement_async(
         db, advertisement_id=advertisement_id, owner_id=user_id)
     if advertisement is None:
         raise HTTPException(status_code=404, detail="Advertisement not found")
+    advertisement_functions.advertisement_validators(advertisement).apply(response)
     return advertisement
 
 
-@app.get("/users/{user_id}/drafts/{draft_id}",
+@router.post("/users/{user_id}/advertisements/{advertisement_id}/attachments",
+          response_model=advertisement_schema.Attachment,
+          dependencies=[Depends(rp.allow_update_advertisements)])
+async def upload_attachment(user_id: int,
+                            advertisement_id: int,
+                            request: Request,
+                            background_tasks: BackgroundTasks,
+                            db: AsyncSession = Depends(dependencies.get_async_db),
+                            current_user: models.User = Depends(
+                                dependencies.get_current_user)):
+    """Attach an image sent as the raw request body (not multipart)."""
+    if user_id != current_user.id:
+        raise HTTPException(status_code=404, detail="not found")
+    advertisement = await advertisement_functions.get_advertisement_async(
+        db, advertisement_id=advertisement_id, owner_id=user_id)
+    if advertisement is None or advertisement.state == 'removed':
+        raise HTTPException(status_code=404, detail="Advertisement not found")
+    if await attachments.count_attachments_async(
+            db, advertisement_id=advertisement_id) >= settings.attachments_per_advertisement:
+        raise HTTPException(
+            status_code=409,
+            detail=f"At most {settings.attachments_per_advertisement} attachments per advertisement")
+    content_length = request.headers.get("content-length", "")
+    if content_length.isdigit() and int(content_length) > settings.attachment_max_bytes:
+        raise HTTPException(
+            status_code=413,
+            detail=f"Attachments are limited to {settings.attachment_max_bytes} bytes")
+    # Hand the connection back while the body streams in.
+    await db.commit()
+    sha256, content_type, size = await attachments.store_upload(
+        request.stream(), max_bytes=settings.attachment_max_bytes)
+    attachment = await attachments.create_attachment_async(
+        db, advertisement_id=advertisement_id, sha256=sha256,
+        content_type=content_type, size=size)
+    background_tasks.add_task(attachments.generate_thumbnail, attachment.id,
+                              sha256, content_type)
+    return attachment
+
+
+@router.get("/users/{user_id}/advertisements/{advertisement_id}/attachments",
+         response_model=list[advertisement_schema.Attachment],
+         dependencies=[Depends(QueryBudget(3))])
+async def read_attachments(user_id: int,
+                           advertisement_id: int,
+                           db: AsyncSession = Depends(dependencies.get_async_read_db),
+                           current_user: models.User = Depends(
+                               dependencies.get_current_user)):
+    return await attachments.get_attachments_async(
+        db, advertisement_id=advertisement_id, owner_id=user_id,
+        current_user=current_user)
+
+
+@router.delete("/users/{user_id}/advertisements/{advertisement_id}/attachments/{attachment_id}",
+            response_model=advertisement_schema.Attachment,
+            dependencies=[Depends(rp.allow_update_advertisements)])
+async def delete_attachment(user_id: int,
+                            advertisement_id: int,
+                            attachment_id: int,
+                            db: AsyncSession = Depends(dependencies.get_async_db),
+                            current_user: models.User = Depends(
+                                dependencies.get_current_user)):
+    attachment = None
+    if user_id == current_user.id:
+        attachment = await attachments.get_attachment_async(
+            db, attachment_id=attachment_id,
+            advertisement_id=advertisement_id, owner_id=user_id)
+    if attachment is None:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+    return await attachments.delete_attachment_async(db, attachment=attachment)
+
+
+@router.api_route("/attachments/{file_name}", methods=["GET", "HEAD"],
+               include_in_schema=False)
+async def read_attachment_file(request: Request,
+                               file_name: str = Path(
+                                   ..., regex=r"^[0-9a-f]{64}\.(jpg|png|gif|webp)$")):
+    try:
+        return await attachments.file_response(request, file_name)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Attachment not found")
+
+
+@router.get("/users/{user_id}/drafts/{draft_id}",
          response_model=advertisement_schema.Advertisement)
-def read_draft(draft_id: int,
-               user_id: int,
-               db: Session = Depends(dependencies.get_db),
-               current_user: models.User = Depends(
-                   dependencies.get_current_user)):
-    draft = advertisement_functions.get_draft(db,
-                                              draft_id=draft_id,
-                                              owner_id=user_id)
+async def read_draft(draft_id: int,
+                     user_id: int,
+                     request: Request,
+                     response: Response,
+                     db: AsyncSession = Depends(dependencies.get_async_read_db),
+                     current_user: models.User = Depends(
+                         dependencies.get_current_user)):
+    if conditional.is_conditional(request):
+        validators = await advertisement_functions.get_advertisement_validators_async(
+            db, advertisement_id=draft_id, owner_id=user_id)
+        if validators is not None and validators.matches(request):
+            return validators.not_modified()
+    draft = await advertisement_functions.get_draft_async(db,
+                                                          draft_id=draft_id,
+                                                          owner_id=user_id)
     if draft is None:
         raise HTTPException(status_code=404, detail="Draft not found")
+    advertisement_functions.advertisement_validators(draft).apply(response)
     return draft
 
 
-@app.put("/users/{user_id}/advertisements/{advertisement_id}",
+@router.put("/users/{user_id}/advertisements/{advertisement_id}",
          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_update_advertisements)])
-def update_advertisement(
+async def update_advertisement(
         advertisement_id: int,
         user_id: int,
         advertisement_in: advertisement_schema.AdvertisementUpdate,
-        db: Session = Depends(dependencies.get_db),
+        db: AsyncSession = Depends(dependencies.get_async_db),
         current_user: models.User = Depends(dependencies.get_current_user)):
 
-    db_advertisement = advertisement_functions.get_advertisement(
+    db_advertisement = await advertisement_functions.get_advertisement_async(
         db, advertisement_id=advertisement_id, owner_id=user_id)
     if db_advertisement is None:
         raise HTTPException(status_code=404, detail="Advertisement not found")
 
-    return advertisement_functions.update_advertisement(
+    return await advertisement_functions.update_advertisement_async(
         db,
         db_advertisement=db_advertisement,
         owner_id=user_id,
-        advertisement_in=advertisement_in)
+        advertisement_in=advertisement_in,
+        current_user=current_user)
 
-@app.delete("/users/{user_id}/advertisements/{advertisement_id}",
+@router.delete("/users/{user_id}/advertisements/{advertisement_id}",
          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_delete_advertisements)])
-def update_advertisement(
+async def update_advertisement(
         advertisement_id: int,
         user_id: int,
-        db: Session = Depends(dependencies.get_db),
+        db: AsyncSession = Depends(dependencies.get_async_db),
         current_user: models.User = Depends(dependencies.get_current_user)):
 
-    db_advertisement = advertisement_functions.get_advertisement(
+    db_advertisement = await advertisement_functions.get_advertisement_async(
         db, advertisement_id=advertisement_id, owner_id=user_id)
     if db_advertisement is None:
         raise HTTPException(status_code=404, detail="Advertisement not found")
 
-    return advertisement_functions.delete_advertisement(
+    return await advertisement_functions.delete_advertisement_async(
         db,
         db_advertisement=db_advertisement,
         owner_id=user_id,
-        advertisement_id=advertisement_id)
+        advertisement_id=advertisement_id,
+        current_user=current_user)
 
-@app.put("/users/{user_id}/drafts/{draft_id}",
+@router.put("/users/{user_id}/drafts/{draft_id}",
          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_update_drafts)])
-def update_draft(draft_id: int,
-                 user_id: int,
-                 draft_in: advertisement_schema.AdvertisementUpdate,
-                 db: Session = Depends(dependencies.get_db),
-                 current_user: models.User = Depends(
-                     dependencies.get_current_user)):
-    db_draft = advertisement_functions.get_draft(db,
-                                                 draft_id=draft_id,
-                                                 owner_id=user_id)
+async def update_draft(draft_id: int,
+                       user_id: int,
+                       draft_in: advertisement_schema.AdvertisementUpdate,
+                       db: AsyncSession = Depends(dependencies.get_async_db),
+                       current_user: models.User = Depends(
+                           dependencies.get_current_user)):
+    db_draft = await advertisement_functions.get_draft_async(db,
+                                                             draft_id=draft_id,
+                                                             owner_id=user_id)
     if db_draft is None:
         raise HTTPException(status_code=404, detail="Draft not found")
 
-    return advertisement_functions.update_draft(db,
-                                                db_draft=db_draft,
-                                                owner_id=user_id,
-                                                draft_in=draft_in)
+    return await advertisement_functions.update_draft_async(db,
+                                                            db_draft=db_draft,
+                                                            owner_id=user_id,
+                                                            draft_in=draft_in,
+                                                            current_user=current_user)
 
 
-@app.delete("/users/{user_id}/drafts/{draft_id}",
+@router.delete("/users/{user_id}/drafts/{draft_id}",
          response_model=advertisement_schema.Advertisement, dependencies=[Depends(rp.allow_delete_advertisements)])
-def update_advertisement(
+async def update_advertisement(
         draft_id: int,
         user_id: int,
-        db: Session = Depends(dependencies.get_db),
+        db: AsyncSession = Depends(dependencies.get_async_db),
         current_user: models.User = Depends(dependencies.get_current_user)):
 
-    db_draft = advertisement_functions.get_draft(
+    db_draft = await advertisement_functions.get_draft_async(
         db, draft_id=draft_id, owner_id=user_id)
     if db_draft is None:
         raise HTTPException(status_code=404, detail="Draft not found")
 
-    return advertisement_functions.delete_advertisement(
+    return await advertisement_functions.delete_advertisement_async(
         db,
         db_advertisement=db_draft,
         owner_id=user_id,
-        advertisement_id=draft_id)
+        advertisement_id=draft_id,
+        current_user=current_user)
 
 
-@app.post("/auth", response_model=user_schema.TokenBase)
-def auth(form_data: OAuth2PasswordRequestForm = Depends(),
-         db: Session = Depends(dependencies.get_db)):
-    user = user_functions.get_user_by_email(db=db, email=form_data.username)
+@router.post("/auth", response_model=user_schema.TokenBase)
+async def auth(form_data: OAuth2PasswordRequestForm = Depends(),
+               db: AsyncSession = Depends(dependencies.get_async_db)):
+    user = await user_functions.get_user_by_email_async(
+        db, email=form_data.username)
 
     if not user:
         raise HTTPException(status_code=400,
                             detail="Incorrect email or password")
 
-    if not user_functions.verify_password(
-            plain_password=form_data.password,
-            hashed_password=user.hashed_password):
+    verified, new_hash = await hashing.verify_and_update_async(
+        form_data.password, user.hashed_password)
+    if not verified:
         raise HTTPException(status_code=400,
                             detail="Incorrect email or password")
+    if new_hash:
+        await user_functions.update_password_hash_async(
+            db, user=user, hashed_password=new_hash)
 
-    return user_functions.create_user_token(db=db, user_id=user.id)
+    return await user_functions.create_user_token_async(db, user_id=user.id)
 
 
-@app.get("/user/me", response_model=user_schema.User)
-def read_current_user(current_user: user_schema.User = Depends(
+@router.get("/user/me", response_model=user_schema.User,
+         dependencies=[Depends(QueryBudget(2))])
+async def read_current_user(current_user: user_schema.User = Depends(
     dependencies.get_current_user)):
     return current_user
+
+
+def create_app(settings: Settings = settings) -> FastAPI:
+    """The app, with its database, caches, group committer and rate limiter
+    built from `settings`; they are in use while its lifespan runs."""
+    app = FastAPI(lifespan=lifespan.lifespan)
+    app.state.resources = lifespan.Resources.build(settings)
+    if settings.admission_control:
+        app.add_middleware(admission.AdmissionMiddleware,
+                           gates=admission.gates_from_settings(settings),
+                           timeout=settings.admission_queue_timeout,
+                           retry_after=settings.admission_retry_after)
+    # Added last so it wraps admission control and counts shed requests too.
+    app.add_middleware(metrics.MetricsMiddleware)
+    app.include_router(router)
+    return app
+
+
+app = create_app()
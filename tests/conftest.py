@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+
+# Settings are read when the app is imported, so the environment has to be
+# in place before anything from app/ or main is.
+_directory = tempfile.mkdtemp(prefix="tests-")
+os.environ["DATABASE_URL"] = f"sqlite:///{_directory}/test.db"
+os.environ["ATTACHMENTS_DIR"] = f"{_directory}/attachments"
+# Every feed request hits the database, so a regression shows up in the
+# count.
+os.environ["FEED_CACHE_TTL"] = "0"
+os.environ["QUERY_BUDGET_STRICT"] = "true"
+os.environ["BCRYPT_ROUNDS"] = "4"
+os.environ["STARTUP_WARMUP"] = "false"
+
+import pytest  # noqa: E402
+from fastapi.testclient import TestClient  # noqa: E402
+from benchmarks.seed import PASSWORD, SeedConfig, generate  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def dataset():
+    from app.db import models
+    from app.db.database import engine
+    from app.functions import hashing
+
+    models.Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        dataset = generate(connection,
+                           SeedConfig(users=20, groups=3, ads=300, tokens=40),
+                           hashing.pwd_context.hash(PASSWORD))
+    yield dataset
+    engine.dispose()
+    shutil.rmtree(_directory, ignore_errors=True)
+
+
+@pytest.fixture(scope="session")
+def client(dataset):
+    import main
+
+    with TestClient(main.app) as client:
+        yield client
+
+
+def bearer(dataset, user_id: int) -> dict:
+    return {"Authorization": f"Bearer {dataset.tokens[user_id]}"}
@@ -0,0 +1,31 @@
+from fastapi.testclient import TestClient
+from sqlalchemy import create_engine
+from app import cache
+from app.db import database, models
+from app.settings import Settings, settings
+
+
+def test_create_app_uses_its_settings(client, tmp_path):
+    import main
+
+    other = Settings(database_url=f"sqlite:///{tmp_path}/other.db",
+                     feed_cache_ttl=60, startup_warmup=False)
+    engine = create_engine(other.database_url)
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
+    feed_cache = cache.feed_cache
+
+    with TestClient(main.create_app(other)) as other_client:
+        response = other_client.get("/")
+        assert response.status_code == 200
+        assert response.json() == []
+        assert response.headers["X-Total-Count"] == "0"
+        assert settings.database_url == other.database_url
+        assert cache.feed_cache is not feed_cache
+        assert cache.feed_cache.ttl == 60
+
+    # The app that was running before has its own back.
+    assert settings.database_url != other.database_url
+    assert cache.feed_cache is feed_cache
+    assert str(database.engine.url) == settings.database_url
+    assert len(client.get("/").json()) == 100
@@ -0,0 +1,45 @@
+import io
+import pytest
+from PIL import Image
+from app.settings import settings
+from tests.conftest import bearer
+
+
+def png() -> bytes:
+    buffer = io.BytesIO()
+    Image.new("RGB", (4, 4), "red").save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def draft(client, dataset):
+    owner_id = dataset.client_ids[0]
+    draft = client.post(f"/users/{owner_id}/drafts/",
+                        json={"title": "sofa", "body": "sofa, unpublished"},
+                        headers=bearer(dataset, owner_id)).json()
+    uploaded = client.post(
+        f"/users/{owner_id}/advertisements/{draft['id']}/attachments",
+        content=png(), headers=bearer(dataset, owner_id))
+    assert uploaded.status_code == 200, uploaded.text
+    return owner_id, draft["id"], uploaded.json()
+
+
+def test_draft_attachments_are_private(client, dataset, draft):
+    owner_id, draft_id, _ = draft
+    url = f"/users/{owner_id}/advertisements/{draft_id}/attachments"
+    owner = client.get(url, headers=bearer(dataset, owner_id))
+    assert len(owner.json()) == 1
+    other = client.get(url, headers=bearer(dataset, dataset.client_ids[1]))
+    assert other.status_code == 200
+    assert other.json() == []
+
+
+@pytest.mark.parametrize("fast_serialization", [False, True])
+def test_draft_attachments_stay_out_of_the_feed(client, draft, monkeypatch,
+                                                 fast_serialization):
+    monkeypatch.setattr(settings, "fast_serialization", fast_serialization)
+    _, draft_id, attachment = draft
+    feed = client.get("/", params={"limit": 100}).json()
+    listed = {ad["id"]: ad for ad in feed}
+    assert listed[draft_id]["attachments"] == []
+    assert attachment["url"] not in str(feed)
@@ -0,0 +1,36 @@
+import pytest
+from app import cache
+from tests.conftest import bearer
+
+
+@pytest.mark.parametrize("token", ["nope", ""])
+def test_feed_ignores_unknown_tokens(client, token):
+    response = client.get("/", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+
+
+def test_feed_signed_in(client, dataset):
+    response = client.get("/", headers=bearer(dataset, dataset.client_ids[0]))
+    assert response.status_code == 200
+
+
+@pytest.fixture
+def feed_cache():
+    previous = cache.feed_cache
+    cache.set_feed_cache(cache.LRUCache(ttl=60))
+    yield cache.feed_cache
+    cache.set_feed_cache(previous)
+
+
+def test_total_is_current_on_cached_cursor_pages(client, dataset, feed_cache):
+    head = client.get("/", params={"limit": 10})
+    after = head.headers["x-next-cursor"]
+    page = client.get("/", params={"limit": 10, "after": after})
+    total = int(page.headers["x-total-count"])
+    user_id = dataset.client_ids[0]
+    created = client.post(f"/users/{user_id}/advertisements/",
+                          json={"title": "tent", "body": "tent, barely used"},
+                          headers=bearer(dataset, user_id))
+    assert created.status_code == 200
+    page = client.get("/", params={"limit": 10, "after": after})
+    assert int(page.headers["x-total-count"]) == total + 1
@@ -0,0 +1,68 @@
+import asyncio
+import json
+import pytest
+from app.functions import ingestion
+from tests.conftest import bearer
+
+
+def collect(items) -> list:
+    async def run():
+        return [item async for item in items]
+    return asyncio.run(run())
+
+
+async def chunked(*chunks: bytes):
+    for chunk in chunks:
+        yield chunk
+
+
+def test_ndjson_rejects_oversized_lines_within_a_chunk():
+    with pytest.raises(ingestion.PayloadError, match="line 2 exceeds"):
+        collect(ingestion.iter_ndjson(
+            chunked(b'{"body": "a"}\n' + b"x" * 100 + b"\n{}\n"), 50))
+
+
+@pytest.mark.parametrize("payload, message", [
+    (b'[{"body": "a"}, {"body": "b"', "item 2 is not valid JSON"),
+    (b'[{"body": "a"}, {"body": "b"}', "unterminated JSON array"),
+    (b'[{"body": "a"} {"body": "b"}]', "expected ',' or ']' after item 1"),
+    (b'[{"body": "a"},]', "item 2 is not valid JSON"),
+    (b'[{"body": "a"}, {"body": "\xff"}]', "payload is not valid UTF-8"),
+    (b'[{"body": "a"}] {}', "unexpected data after the JSON array"),
+])
+def test_json_array_payload_errors(payload, message):
+    with pytest.raises(ingestion.PayloadError, match=message):
+        collect(ingestion.iter_json_array(
+            chunked(payload[:7], payload[7:]), 1000))
+
+
+def test_json_array():
+    items = collect(ingestion.iter_json_array(
+        chunked(b'[{"body": "a"},', b' {"bo', b'dy": "b"} ]'), 1000))
+    assert items == [(1, {"body": "a"}), (2, {"body": "b"})]
+
+
+def bulk(client, dataset, body: bytes, content_type: str) -> list:
+    user_id = dataset.client_ids[0]
+    response = client.post(f"/users/{user_id}/advertisements/bulk",
+                           content=body,
+                           headers={**bearer(dataset, user_id),
+                                    "Content-Type": content_type})
+    assert response.status_code == 200, response.text
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+def test_results_follow_input_order(client, dataset):
+    body = b'{"body": "a"}\n{"title": 1}\n{"body": "b"}\nnot json\n\xff\n'
+    results = bulk(client, dataset, body, "application/x-ndjson")
+    assert [result["line"] for result in results] == [1, 2, 3, 4, 5]
+    assert [("id" in result) for result in results] == [
+        True, False, True, False, False]
+
+
+def test_truncated_array_ends_with_a_payload_error(client, dataset):
+    results = bulk(client, dataset, b'[{"body": "a"}, {"body": "b"',
+                   "application/json")
+    assert "id" in results[0] and results[0]["line"] == 1
+    assert "line" not in results[-1]
+    assert "item 2 is not valid JSON" in results[-1]["errors"][0]["msg"]
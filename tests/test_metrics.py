@@ -0,0 +1,28 @@
+from app import cache
+from tests.conftest import bearer
+
+
+def cache_stat(client, stat: str, name: str) -> float:
+    prefix = f'{stat}{{cache="{name}"}} '
+    for line in client.get("/metrics").text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    raise AssertionError(f"no {prefix!r} on /metrics")
+
+
+def test_cache_counters(client, dataset):
+    headers = bearer(dataset, dataset.client_ids[0])
+    cache.principal_cache.clear()
+    before = {(stat, name): cache_stat(client, stat, name)
+              for stat in ("cache_hits_total", "cache_misses_total")
+              for name in ("feed", "principal")}
+    client.get("/user/me", headers=headers)
+    client.get("/user/me", headers=headers)
+    client.get("/")
+    assert cache_stat(client, "cache_misses_total", "principal") == (
+        before["cache_misses_total", "principal"] + 1)
+    assert cache_stat(client, "cache_hits_total", "principal") == (
+        before["cache_hits_total", "principal"] + 1)
+    assert cache_stat(client, "cache_misses_total", "feed") > (
+        before["cache_misses_total", "feed"])
+    assert cache_stat(client, "cache_entries", "principal") >= 1
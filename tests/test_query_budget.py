@@ -0,0 +1,96 @@
+"""The number of SQL statements a listing issues must not grow with the
+number of rows it returns; these fail on a regression to N+1 queries.
+
+The caller's principal is looked up once beforehand, so it is served by
+its cache as it is in production, unless `cold` asks for a cache miss; the
+routes' QueryBudget is strict here, so it has to allow for that too.
+"""
+from sqlalchemy import select
+from app import cache
+from app.db import models
+from app.db.database import engine
+from app.db.query_counter import assert_max_queries
+from tests.conftest import bearer
+
+
+def get(client, url: str, max_queries: int, cold: bool = False, **kwargs):
+    if cold:
+        cache.principal_cache.clear()
+    elif "headers" in kwargs:
+        client.get("/user/me", headers=kwargs["headers"])
+    with assert_max_queries(max_queries):
+        response = client.get(url, **kwargs)
+    assert response.status_code == 200, response.text
+    return response
+
+
+def test_feed(client, dataset):
+    response = get(client, "/", 3, params={"limit": 100})
+    assert len(response.json()) == 100
+
+
+def test_feed_signed_in(client, dataset):
+    user_id = dataset.client_ids[0]
+    response = get(client, "/", 3, params={"limit": 100},
+                   headers=bearer(dataset, user_id))
+    assert len(response.json()) > 1
+
+
+def test_feed_cursor_page(client, dataset):
+    first = client.get("/", params={"limit": 20})
+    response = get(client, "/", 3, params={
+        "limit": 20, "after": first.headers["x-next-cursor"]})
+    assert len(response.json()) == 20
+
+
+def test_users(client, dataset):
+    response = get(client, "/users/", 2,
+                   headers=bearer(dataset, dataset.admin_id))
+    assert len(response.json()) == len(dataset.client_ids) + 2
+
+
+def test_user_advertisements(client, dataset):
+    user_id = dataset.client_ids[0]
+    response = get(client, f"/users/{user_id}/advertisements/", 2,
+                   headers=bearer(dataset, user_id))
+    assert len(response.json()) > 1
+
+
+def test_drafts(client, dataset):
+    user_id = dataset.client_ids[0]
+    response = get(client, f"/users/{user_id}/drafts/", 3,
+                   headers=bearer(dataset, user_id))
+    assert len(response.json()) > 1
+
+
+def test_moderation_queue(client, dataset):
+    response = get(client, "/moderation/drafts/", 4,
+                   headers=bearer(dataset, dataset.moderator_id))
+    assert len(response.json()) > 1
+
+
+def test_feed_cold_principal(client, dataset):
+    get(client, "/", 5, cold=True, params={"limit": 100},
+        headers=bearer(dataset, dataset.client_ids[0]))
+
+
+def test_users_cold_principal(client, dataset):
+    get(client, "/users/", 4, cold=True,
+        headers=bearer(dataset, dataset.admin_id))
+
+
+def test_user_advertisements_cold_principal(client, dataset):
+    user_id = dataset.client_ids[0]
+    get(client, f"/users/{user_id}/advertisements/", 4, cold=True,
+        headers=bearer(dataset, user_id))
+
+
+def test_user_stats_cold_principal(client, dataset):
+    # A member of the moderator's group, so the access check runs a query.
+    with engine.connect() as connection:
+        user_id = connection.scalar(select(models.UserGroup.user_id).where(
+            models.UserGroup.group_id == 1,
+            models.UserGroup.user_id != dataset.moderator_id,
+            models.UserGroup.user_id != dataset.admin_id))
+    get(client, f"/users/{user_id}/stats", 4, cold=True,
+        headers=bearer(dataset, dataset.moderator_id))
@@ -0,0 +1,9 @@
+from sqlalchemy import create_engine
+from app.db import models
+
+
+def test_create_all_twice(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path}/schema.db")
+    models.Base.metadata.create_all(engine)
+    models.Base.metadata.create_all(engine)
+    engine.dispose()
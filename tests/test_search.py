@@ -0,0 +1,13 @@
+import pytest
+
+
+@pytest.mark.parametrize("q", ["", "   ", "\t\n"])
+def test_search_without_terms(client, q):
+    response = client.get("/advertisements/search", params={"q": q})
+    assert response.status_code == 422
+
+
+def test_search(client, dataset):
+    response = client.get("/advertisements/search",
+                          params={"q": f' {dataset.words[0]} "'})
+    assert response.status_code == 200